@@ -0,0 +1,129 @@
+"""Admission control, a concurrency budget per route class so expensive reads can't starve the saves
+
+Every `/surftimer/` request belongs to a route class: `runs` for the endpoints that save player times, `admin`
+for rebuilds and recomputes, `read` for other `GET` requests and `write` for the rest. `ROUTES` overrides the
+class of a path. A class runs at most `LIMITS[class]` requests at once, up to `QUEUES[class]` more wait in line
+for `TIMEOUTS[class]` seconds. A request that finds the line full or waits too long gets `503` with `Retry-After`
+right away instead of slowing down everything else. `runs` has its own budget, no other class can take it.
+
+The slot is held until the response is sent, streamed responses included. Budgets are per worker.
+"""
+
+import asyncio
+from collections import deque
+
+from fastapi import status
+from fastapi.responses import JSONResponse
+
+from globals import admission_config
+from metrics import ADMISSION_QUEUED, ADMISSION_SHED
+from tracing import span
+
+
+class Budget:
+    """`limit` concurrent requests and a line of at most `queue` waiting ones, served in arrival order"""
+
+    __slots__ = ("limit", "queue", "active", "waiters")
+
+    def __init__(self, limit: int, queue: int):
+        self.limit = limit
+        self.queue = queue
+        self.active = 0
+        self.waiters = deque()
+
+    async def acquire(self, timeout: float) -> bool:
+        """`True` once the request holds a slot, `False` when it has to be shed"""
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return True
+        if len(self.waiters) >= self.queue:
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            # The slot can be handed over just as the timeout fires
+            return waiter.done() and not waiter.cancelled()
+        except asyncio.CancelledError:
+            # The client went away, pass on a slot that was already handed over
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    self.waiters.remove(waiter)
+                except ValueError:
+                    pass
+
+    def release(self):
+        """Hands the slot to the next waiting request or frees it"""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+_budgets = {}
+
+
+def route_class(method: str, path: str):
+    """Route class of a request, `None` for paths outside `/surftimer/` which are never limited"""
+    if path in admission_config["ROUTES"]:
+        return admission_config["ROUTES"][path]
+    if not path.startswith("/surftimer/"):
+        return None
+    return "read" if method in ("GET", "HEAD") else "write"
+
+
+def get_budget(name: str) -> Budget:
+    budget = _budgets.get(name)
+    if budget is None:
+        budget = _budgets[name] = Budget(
+            admission_config["LIMITS"][name], admission_config["QUEUES"][name]
+        )
+    return budget
+
+
+class AdmissionMiddleware:
+    """Admits a request when its route class has a free slot, waits in line or sheds it with `503`\n
+    A plain ASGI middleware so the slot is only released once the whole response was sent
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or admission_config["ENABLED"] == 0:
+            return await self.app(scope, receive, send)
+
+        name = route_class(scope["method"], scope["path"])
+        if name is None:
+            return await self.app(scope, receive, send)
+
+        budget = get_budget(name)
+        ADMISSION_QUEUED.labels(name).inc()
+        try:
+            with span("admission", name):
+                admitted = await budget.acquire(admission_config["TIMEOUTS"][name])
+        finally:
+            ADMISSION_QUEUED.labels(name).dec()
+
+        if not admitted:
+            ADMISSION_SHED.labels(name).inc()
+            response = JSONResponse(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                content={"message": "Overloaded", "route_class": name},
+                headers={"retry-after": str(admission_config["RETRY_AFTER"])},
+            )
+            return await response(scope, receive, send)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            budget.release()
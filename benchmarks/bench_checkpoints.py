@@ -0,0 +1,247 @@
+"""Row against packed checkpoint storage: saving a run, reading it back, batch reads and table size
+
+Run from the repository root against the stand-ins from `benchmarks/docker-compose.yml`:
+```
+    python -m benchmarks.bench_checkpoints --runs 5000 --cps 30
+```
+The database is re-created from `schema.sql`, then `--runs` runs of `--cps` checkpoints are saved both ways:
+one `sql_insertCheckpoint` per checkpoint in a transaction, as `savemaptime` does with `"STORAGE": "rows"`,
+and one `sql_insertPackedCheckpoints` per run. Reads time `sql_getMapCheckpointsData` against
+`sql_getPackedCheckpoints` + `unpack_rows` and check both return the same rows, batch reads load the
+checkpoints of `--batch` runs into `CheckpointArrays` like `/surftimer/checkpointsplits`.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timezone
+
+from benchmarks import dataset
+from benchmarks.loadtest import git_commit
+from checkpoints import pack, unpack_rows
+from splits import CheckpointArrays
+from surftimer import queries
+
+
+def make_checkpoints(rng: random.Random, cps: int) -> list:
+    """Rows shaped like `Checkpoints` rows, velocities as the `DECIMAL(12, 6)` strings MySQL stores"""
+    run_time = 0
+    checkpoints = []
+    for cp in range(1, cps + 1):
+        run_time += rng.randint(300, 2000)
+        checkpoints.append(
+            {
+                "cp": cp,
+                "run_time": run_time,
+                **{
+                    name: dataset.velocity(rng)
+                    for name in (
+                        "start_vel_x",
+                        "start_vel_y",
+                        "start_vel_z",
+                        "end_vel_x",
+                        "end_vel_y",
+                        "end_vel_z",
+                    )
+                },
+                "attempts": rng.randint(0, 5),
+                "end_touch": rng.randint(0, 200000),
+            }
+        )
+    return checkpoints
+
+
+def row_statements(maptime_id: int, checkpoints: list) -> list:
+    return [
+        queries.sql_insertCheckpoint.format(
+            maptime_id,
+            checkpoint["cp"],
+            checkpoint["run_time"],
+            checkpoint["start_vel_x"],
+            checkpoint["start_vel_y"],
+            checkpoint["start_vel_z"],
+            checkpoint["end_vel_x"],
+            checkpoint["end_vel_y"],
+            checkpoint["end_vel_z"],
+            checkpoint["attempts"],
+            checkpoint["end_touch"],
+        )
+        for checkpoint in checkpoints
+    ]
+
+
+def packed_statements(maptime_id: int, checkpoints: list) -> list:
+    return [
+        queries.sql_insertPackedCheckpoints.format(
+            maptime_id, len(checkpoints), pack(checkpoints).hex()
+        )
+    ]
+
+
+def save_runs(mydb, runs: dict, statements) -> list:
+    """Saves every run in its own transaction, returns the time of each save"""
+    mycursor = mydb.cursor()
+    timings = []
+    for maptime_id, checkpoints in runs.items():
+        tic = time.perf_counter()
+        mydb.start_transaction()
+        for statement in statements(maptime_id, checkpoints):
+            mycursor.execute(statement)
+        mydb.commit()
+        timings.append(time.perf_counter() - tic)
+    mycursor.close()
+    return timings
+
+
+def read_rows(mycursor, maptime_id: int) -> list:
+    mycursor.execute(queries.sql_getMapCheckpointsData.format(maptime_id))
+    return mycursor.fetchall()
+
+
+def read_packed(mycursor, maptime_id: int) -> list:
+    mycursor.execute(queries.sql_getPackedCheckpoints.format(maptime_id))
+    row = mycursor.fetchone()
+    return unpack_rows(maptime_id, row["data"])
+
+
+def read_rows_batch(mycursor, maptime_ids: list) -> CheckpointArrays:
+    mycursor.execute(
+        queries.sql_getCheckpointsByRuns.format(", ".join(map(str, maptime_ids)))
+    )
+    return CheckpointArrays.from_rows(mycursor.fetchall())
+
+
+def read_packed_batch(mycursor, maptime_ids: list) -> CheckpointArrays:
+    mycursor.execute(
+        queries.sql_getPackedCheckpoints.format(", ".join(map(str, maptime_ids)))
+    )
+    return CheckpointArrays.from_packed(mycursor.fetchall())
+
+
+def time_reads(mydb, read, keys: list) -> list:
+    mycursor = mydb.cursor(dictionary=True)
+    read(mycursor, keys[0])  # Warm up
+    timings = []
+    for key in keys:
+        tic = time.perf_counter()
+        read(mycursor, key)
+        timings.append(time.perf_counter() - tic)
+    mycursor.close()
+    return timings
+
+
+def table_size(mydb, table: str) -> dict:
+    mycursor = mydb.cursor(dictionary=True)
+    mycursor.execute(f"ANALYZE TABLE `{table}`")
+    mycursor.fetchall()
+    mycursor.execute(
+        """SELECT `TABLE_ROWS` AS `rows`, `DATA_LENGTH` AS `data`, `INDEX_LENGTH` AS `index`
+        FROM information_schema.TABLES WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = %s""",
+        (table,),
+    )
+    size = mycursor.fetchone()
+    mycursor.close()
+    return {key: int(value) for key, value in size.items()}
+
+
+def summary(timings: list) -> dict:
+    return {
+        "median_ms": round(statistics.median(timings) * 1000, 3),
+        "p95_ms": round(sorted(timings)[int(len(timings) * 0.95)] * 1000, 3),
+    }
+
+
+def same_rows(rows: list, packed: list) -> bool:
+    """Rows from both storages match apart from the `Checkpoints` row `id`"""
+    strip = lambda row: {key: value for key, value in row.items() if key != "id"}
+    return [strip(row) for row in rows] == [strip(row) for row in packed]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default="benchmarks/config.bench.json")
+    parser.add_argument("--runs", type=int, default=5000)
+    parser.add_argument("--cps", type=int, default=30)
+    parser.add_argument("--reads", type=int, default=500)
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--output", default="benchmarks/results")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        db = json.load(f)["DATABASE"]
+
+    rng = random.Random(args.seed)
+    runs = {
+        maptime_id: make_checkpoints(rng, args.cps)
+        for maptime_id in range(1, args.runs + 1)
+    }
+    sample = rng.sample(list(runs), min(args.reads, len(runs)))
+    batches = [
+        rng.sample(list(runs), min(args.batch, len(runs)))
+        for _ in range(max(1, args.reads // 10))
+    ]
+
+    dataset.reset_database(db)
+    mydb = dataset.connect(db)
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "runs": args.runs,
+        "cps": args.cps,
+        "save": {
+            "rows": summary(save_runs(mydb, runs, row_statements)),
+            "packed": summary(save_runs(mydb, runs, packed_statements)),
+        },
+        "size": {
+            "rows": table_size(mydb, "Checkpoints"),
+            "packed": table_size(mydb, "PackedCheckpoints"),
+        },
+        "read": {
+            "rows": summary(time_reads(mydb, read_rows, sample)),
+            "packed": summary(time_reads(mydb, read_packed, sample)),
+        },
+        "batch_read": {
+            "rows": summary(time_reads(mydb, read_rows_batch, batches)),
+            "packed": summary(time_reads(mydb, read_packed_batch, batches)),
+        },
+    }
+
+    mycursor = mydb.cursor(dictionary=True)
+    result["same_rows"] = all(
+        same_rows(read_rows(mycursor, maptime_id), read_packed(mycursor, maptime_id))
+        for maptime_id in sample
+    )
+    mycursor.close()
+    mydb.close()
+
+    print(f"{'':<12} {'rows':>24} {'packed':>24}")
+    for name in ("save", "read", "batch_read"):
+        cells = [
+            f"{result[name][storage]['median_ms']:.3f} / {result[name][storage]['p95_ms']:.3f} ms"
+            for storage in ("rows", "packed")
+        ]
+        print(f"{name:<12} {cells[0]:>24} {cells[1]:>24}")
+    cells = [
+        f"{(result['size'][storage]['data'] + result['size'][storage]['index']) / 2**20:.1f} MiB"
+        for storage in ("rows", "packed")
+    ]
+    print(f"{'size':<12} {cells[0]:>24} {cells[1]:>24}")
+    print(f"same rows: {result['same_rows']}")
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(
+        args.output,
+        f"checkpoints-{result['commit']}-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}.json",
+    )
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"\nSaved {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Compares the encoders from `encoders.py` on realistic `MapTimes` rows
+
+Run from the repository root:
+```
+    python -m benchmarks.bench_encoders --rows 20000 --repeat 5
+```
+Every encoder's output is decoded and compared against the `simplejson` reference before timing,
+MessagePack is compared with `Decimal` values as `float` since that is how it packs them.
+"""
+
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from encoders import ENCODERS, SimpleJsonEncoder, get_encoder
+
+
+def velocity(rng: random.Random) -> Decimal:
+    return Decimal(f"{rng.uniform(-3500, 3500):.6f}")
+
+
+def make_maptimes_rows(count: int, seed: int = 1337, checkpoints: int = 0):
+    """Rows shaped like `sql_getMapRecordAndTotals` results (`MapTimes.*` + `Player.name`)"""
+    rng = random.Random(seed)
+    epoch = datetime(2024, 1, 1)
+    rows = []
+    for i in range(count):
+        row = {
+            "id": i + 1,
+            "player_id": rng.randint(1, count // 4 + 1),
+            "map_id": 1,
+            "style": 0,
+            "type": 0,
+            "stage": 0,
+            "run_time": rng.randint(1000, 90000),
+            "start_vel_x": velocity(rng),
+            "start_vel_y": velocity(rng),
+            "start_vel_z": velocity(rng),
+            "end_vel_x": velocity(rng),
+            "end_vel_y": velocity(rng),
+            "end_vel_z": velocity(rng),
+            "run_date": int((epoch + timedelta(seconds=i * 37)).timestamp()),
+            "replay_frames": "",
+            "name": f"Surfer Ünïcode {i}",
+            "last_seen": epoch + timedelta(minutes=i),
+        }
+        if checkpoints:
+            row["checkpoints"] = [
+                {
+                    "cp": cp,
+                    "run_time": cp * 1000 + rng.randint(0, 999),
+                    "start_vel_x": velocity(rng),
+                    "start_vel_y": velocity(rng),
+                    "start_vel_z": velocity(rng),
+                    "end_vel_x": velocity(rng),
+                    "end_vel_y": velocity(rng),
+                    "end_vel_z": velocity(rng),
+                    "end_touch": 0,
+                    "attempts": rng.randint(1, 5),
+                }
+                for cp in range(1, checkpoints + 1)
+            ]
+        rows.append(row)
+    return rows
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--checkpoints", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_maptimes_rows(args.rows, checkpoints=args.checkpoints)
+    reference = SimpleJsonEncoder()
+    expected = {
+        "json": reference.loads(reference.dumps(rows)),
+        "msgpack": json.loads(reference.dumps(rows)),
+    }
+
+    results = {}
+    for name in ENCODERS:
+        try:
+            encoder = get_encoder(name)
+        except ImportError:
+            encoder = None
+        if encoder is None or encoder.name != name:
+            print(f"{name:<12} not installed, skipped")
+            continue
+        encoded = encoder.dumps(rows)
+        assert (
+            encoder.loads(encoded) == expected[encoder.format]
+        ), f"{name} output differs"
+        results[name] = best_of(lambda: encoder.dumps(rows), args.repeat)
+        print(
+            f"{name:<12} {results[name] * 1000:9.2f} ms"
+            f"  {len(encoded) / 1024:9.1f} KiB"
+            f"  {results[name] / args.rows * 1e6:7.2f} us/row"
+        )
+
+    if SimpleJsonEncoder.name in results:
+        for name, elapsed in results.items():
+            print(f"{name:<12} x{results[SimpleJsonEncoder.name] / elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    main()
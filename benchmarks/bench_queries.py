@@ -0,0 +1,432 @@
+"""Times every named query in `surftimer/queries.py` and its candidate rewrites on seeded datasets
+
+Run from the repository root against the stand-ins from `benchmarks/docker-compose.yml`:
+```
+    python -m benchmarks.bench_queries --scales 10000,100000,1000000 --repeat 5
+```
+For every scale (number of `MapTimes`) the database is re-created with `benchmarks.dataset`, then each
+query runs with parameters picked from the seeded data: a run in the middle of the leaderboard of the
+most popular map. Write queries run inside a transaction that is rolled back.
+
+A rewrite in `CANDIDATES` must return the same rows as the query it replaces, otherwise it is reported
+as `mismatch`. The result holds the median/min time, the `EXPLAIN FORMAT=JSON` plan and a summary of
+the access path per query and scale, plus how the time grows between scales (`1.0` is linear).
+Pass an older result with `--compare` to exit with `1` when a query got slower by more than `--threshold`.
+"""
+
+import argparse
+import json
+import math
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+import mysql.connector
+
+from benchmarks import dataset
+from benchmarks.loadtest import git_commit
+from surftimer import queries
+
+
+# Rewrites to compare with the query in `queries.py` of the same name
+CANDIDATES = {
+    "sql_getDataByRank": {
+        # The query before the window rewrite, counts the leaderboard again for every run in it
+        "correlated": """SELECT Player.name, mainquery.* FROM MapTimes AS mainquery
+                    INNER JOIN Player ON mainquery.player_id = Player.id
+                    WHERE
+                        mainquery.map_id = {} AND mainquery.style = {} AND mainquery.type = {} AND mainquery.stage = {}
+                        AND (
+                            SELECT COUNT(*) FROM MapTimes AS subquery
+                            WHERE subquery.map_id = mainquery.map_id AND subquery.style = mainquery.style
+                                AND subquery.type = mainquery.type AND subquery.stage = mainquery.stage
+                                AND subquery.run_time <= mainquery.run_time
+                        ) = {};""",
+    },
+}
+
+# Queries that can't run as they are, with the reason
+SKIPPED = {
+    "sql_insertPlayerProfile": "contains a C# `{MySqlHelper.EscapeString(name)}` placeholder",
+}
+
+# Statements run untimed before a write query, in the transaction that is rolled back after it
+SETUP = {
+    "sql_rebuildMapRecords": "DELETE FROM `MapRecords` WHERE `map_id` = 1",
+}
+
+
+def pick_params(mydb) -> dict:
+    """A run in the middle of the main leaderboard of the most popular map and ids around it"""
+    mycursor = mydb.cursor(dictionary=True)
+    mycursor.execute(
+        "SELECT COUNT(*) AS total FROM MapTimes WHERE map_id = 1 AND style = 0 AND type = 0 AND stage = 0"
+    )
+    total = mycursor.fetchone()["total"]
+    mycursor.execute(
+        f"""SELECT MapTimes.*, Player.steam_id FROM MapTimes JOIN Player ON MapTimes.player_id = Player.id
+        WHERE map_id = 1 AND style = 0 AND type = 0 AND stage = 0
+        ORDER BY run_time LIMIT 1 OFFSET {total // 2}"""
+    )
+    run = mycursor.fetchone()
+    mycursor.execute(
+        "SELECT COUNT(*) AS `rank` FROM MapTimes WHERE map_id = 1 AND style = 0 AND type = 0 AND stage = 0 AND run_time <= %s",
+        (run["run_time"],),
+    )
+    run["rank"] = mycursor.fetchone()["rank"]
+    mycursor.execute(
+        "SELECT maptime_id FROM Checkpoints ORDER BY maptime_id DESC LIMIT 1"
+    )
+    row = mycursor.fetchone()
+    run["checkpoint_maptime_id"] = row["maptime_id"] if row else run["id"]
+    run["leaderboard_size"] = total
+    mycursor.close()
+    return run
+
+
+def query_args(run: dict) -> dict:
+    """`.format()` arguments for every query in `queries.py`"""
+    velocities = ("1.5", "-2.25", "0", "3500.000001", "-3500", "12.5")
+    return {
+        "sql_getMapInfo": ("surf_bench_00001",),
+        "sql_insertMap": (
+            "surf_bench_new",
+            "bench",
+            3,
+            0,
+            1,
+            1,
+            1700000000,
+            1700000000,
+        ),
+        "sql_updateMap": (1700000000, 0, 1, "bench", 3, 1, 1),
+        "sql_flushMaps": (
+            "SELECT 1 AS id, 1700000000 AS last_played, 0 AS stages, 1 AS bonuses, "
+            "'bench' AS author, 3 AS tier, 1 AS ranked",
+        ),
+        "sql_getMapRunsData": (1,),
+        "sql_getStageRecords": (10, 1, 0),
+        "sql_getSplitRuns": (1, 0, run["id"], run["player_id"]),
+        "sql_getCheckpointsByRuns": (f"{run['id']}, {run['checkpoint_maptime_id']}",),
+        "sql_updateMapRecord": (0, 1, 0, 0, 0),
+        "sql_deleteMapRecords": ("`map_id` = 1",),
+        "sql_rebuildMapRecords": ("`map_id` = 1",),
+        "sql_getPointsMaps": ("`updated_at` >= `points_at`",),
+        "sql_getPointsRuns": ("1, 2",),
+        "sql_getMapPointsPlayers": ("1, 2",),
+        "sql_deleteMapPoints": ("1, 2",),
+        "sql_deletePlayerPoints": (0, run["player_id"]),
+        "sql_insertMapPoints": (f"(1, 0, {run['player_id']}, {run['id']}, 1, 100)",),
+        "sql_updatePlayerPoints": (0, run["player_id"]),
+        "sql_markMapPoints": (1700000000, "1, 2"),
+        "sql_getPointsKeys": (0,),
+        "sql_getPlayerPoints": (0, run["player_id"]),
+        "sql_getPointsPage": (0, 2**62, 2**62, 0, 51),
+        "sql_getLeaderboardPage": (
+            1,
+            0,
+            0,
+            0,
+            run["run_time"],
+            run["run_time"],
+            run["id"],
+            51,
+        ),
+        "sql_getLeaderboardTotals": (1, 0, 0, 0),
+        "sql_getMapExport": (1,),
+        "sql_getLeaderboardKeys": (1, 0, 0, 0),
+        "sql_getLeaderboardRuns": (", ".join(str(run["id"] + i) for i in range(11)),),
+        "sql_getPlayerRun": (run["player_id"], 1, 0, 0, 0),
+        "sql_getMapCheckpointsData": (run["checkpoint_maptime_id"],),
+        "sql_getCheckpointRows": (run["checkpoint_maptime_id"],),
+        "sql_getPackedCheckpoints": (run["checkpoint_maptime_id"],),
+        "sql_getMapRecordAndTotals": (1, 0),
+        "sql_getDataByRank": (1, 0, 0, 0, run["rank"]),
+        "sql_getPlayerMapData": (run["player_id"], 1),
+        "sql_getSpecificPlayerStatsData": (run["player_id"], 1, 0, 0),
+        "sql_insertMapTime": (run["player_id"], 1, 0, 0, 0, run["run_time"] - 1)
+        + velocities
+        + (1700000000, ""),
+        "sql_insertCheckpoint": (run["checkpoint_maptime_id"], 1, 1000)
+        + velocities
+        + (1, 0),
+        "sql_insertPackedCheckpoints": (run["checkpoint_maptime_id"], 1, "00" * 64),
+        "sql_deleteCheckpoints": (run["checkpoint_maptime_id"],),
+        "sql_deletePackedCheckpoints": (run["checkpoint_maptime_id"],),
+        "sql_getPlayerProfileData": (run["steam_id"],),
+        "sql_updatePlayerProfile": ("DE", 1700000000, run["player_id"]),
+        "sql_flushPlayerProfiles": (
+            f"SELECT {run['player_id']} AS id, 'DE' AS country, 1700000000 AS last_seen, 3 AS connections",
+        ),
+        "sql_getPlayerSummary": (run["steam_id"],),
+        "sql_getTopPlayers": (1, 0, 0, 0, 10),
+        "sql_updatePlayerSummary": (run["player_id"], 0, 1, 0, 0, 1, 0, 0, 0, 1),
+        "sql_getSteamIds": (run["player_id"],),
+        "sql_getRunByPlayer": (run["player_id"], 1, 0, 0),
+        "sql_getRunById": (run["id"],),
+    }
+
+
+def named_queries() -> dict:
+    return {
+        name: query for name, query in vars(queries).items() if name.startswith("sql_")
+    }
+
+
+def is_select(query: str) -> bool:
+    return query.lstrip().upper().startswith("SELECT")
+
+
+def plan_summary(plan) -> list:
+    """`table access_type key rows` for every table in an `EXPLAIN FORMAT=JSON` plan"""
+    tables = []
+
+    def walk(node):
+        if isinstance(node, dict):
+            table = node.get("table")
+            if isinstance(table, dict) and "table_name" in table:
+                tables.append(
+                    f"{table['table_name']} {table.get('access_type', '?')} "
+                    f"{table.get('key', '-')} rows={table.get('rows_examined_per_scan', '?')}"
+                )
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(plan)
+    return tables
+
+
+def run_query(mydb, query: str, repeat: int, setup: str = None):
+    """Median and min time in ms and the rows of the last run, writes are rolled back"""
+    mycursor = mydb.cursor(dictionary=True)
+    timings = []
+    rows = []
+    for _ in range(repeat + 1):  # The first run only warms up the buffer pool
+        if setup is not None:
+            mycursor.execute(setup)
+        tic = time.perf_counter()
+        mycursor.execute(query)
+        rows = mycursor.fetchall() if mycursor.with_rows else []
+        timings.append(time.perf_counter() - tic)
+        if not is_select(query):
+            mydb.rollback()
+    mycursor.close()
+    timings = timings[1:]
+    return (
+        round(statistics.median(timings) * 1000, 3),
+        round(min(timings) * 1000, 3),
+        rows,
+    )
+
+
+def explain(mydb, query: str):
+    mycursor = mydb.cursor()
+    mycursor.execute(f"EXPLAIN FORMAT=JSON {query}")
+    plan = json.loads(mycursor.fetchone()[0])
+    mycursor.close()
+    return plan
+
+
+def comparable(rows: list) -> list:
+    return sorted(json.dumps(row, sort_keys=True, default=str) for row in rows)
+
+
+def measure(mydb, name: str, query: str, args: tuple, repeat: int, reference=None):
+    """Times one query, `reference` are the rows the original query returned"""
+    sql = query.format(*args)
+    try:
+        median_ms, min_ms, rows = run_query(mydb, sql, repeat, SETUP.get(name))
+    except mysql.connector.Error as e:
+        mydb.rollback()
+        # 3024: Query execution was interrupted, maximum statement execution time exceeded
+        return {
+            "status": "timeout" if e.errno == 3024 else "error",
+            "error": str(e),
+        }, None
+
+    result = {
+        "status": "ok",
+        "median_ms": median_ms,
+        "min_ms": min_ms,
+        "rows": len(rows),
+    }
+    if reference is not None and comparable(rows) != comparable(reference):
+        result["status"] = "mismatch"
+    if is_select(sql):
+        plan = explain(mydb, sql)
+        result["plan"] = plan_summary(plan)
+        result["explain"] = plan
+    return result, rows
+
+
+def bench_scale(db: dict, scale: int, args) -> dict:
+    """Seeds `scale` `MapTimes` (unless `--no-seed`) and times every query"""
+    if not args.no_seed:
+        tic = time.perf_counter()
+        dataset.reset_database(db, indexes=not args.without_indexes)
+        dataset.generate(
+            db,
+            maps=max(20, min(2000, scale // 5000)),
+            players=max(1000, scale // 10),
+            maptimes=scale,
+            seed=args.seed,
+        )
+        print(f"Seeded {scale} MapTimes in {time.perf_counter() - tic:0.1f}s")
+
+    mydb = dataset.connect(db)
+    mycursor = mydb.cursor()
+    mycursor.execute(f"SET SESSION MAX_EXECUTION_TIME = {int(args.timeout * 1000)}")
+    mycursor.execute("ANALYZE TABLE Maps, Player, MapTimes, Checkpoints")
+    mycursor.fetchall()
+    mycursor.close()
+
+    run = pick_params(mydb)
+    all_args = query_args(run)
+    results = {}
+    for name, query in named_queries().items():
+        if name in SKIPPED:
+            results[name] = {"status": "skipped", "reason": SKIPPED[name]}
+            continue
+        if args.only and name not in args.only:
+            continue
+        results[name], rows = measure(mydb, name, query, all_args[name], args.repeat)
+        print(f"{scale:>10} {name:<40} {format_result(results[name])}")
+
+        for candidate, rewrite in CANDIDATES.get(name, {}).items():
+            label = f"{name}:{candidate}"
+            results[label], _ = measure(
+                mydb, label, rewrite, all_args[name], args.repeat, reference=rows
+            )
+            print(f"{scale:>10} {label:<40} {format_result(results[label])}")
+
+    mydb.close()
+    return {"leaderboard_size": run["leaderboard_size"], "queries": results}
+
+
+def format_result(result: dict) -> str:
+    if result["status"] != "ok":
+        return result["status"]
+    return f"{result['median_ms']:>10.3f}ms  {'; '.join(result.get('plan', []))}"
+
+
+def growth(scales: dict) -> dict:
+    """log-log slope of the median time between the smallest and largest scale per query"""
+    curves = {}
+    for scale, result in scales.items():
+        for name, measured in result["queries"].items():
+            if measured["status"] == "ok":
+                curves.setdefault(name, []).append((int(scale), measured["median_ms"]))
+
+    slopes = {}
+    for name, points in curves.items():
+        if len(points) < 2:
+            continue
+        (small, small_ms), (large, large_ms) = min(points), max(points)
+        if small_ms > 0 and large > small:
+            slopes[name] = round(
+                math.log(large_ms / small_ms) / math.log(large / small), 3
+            )
+    return {"curves": curves, "slopes": slopes}
+
+
+def compare(result: dict, baseline: dict, threshold: float, min_ms: float) -> bool:
+    """Prints the difference to `baseline`, returns `True` if a query got slower by more than `threshold`"""
+    regressed = False
+    print(f"\nCompared to {baseline['commit']} ({baseline['timestamp']})")
+    for scale, current in result["scales"].items():
+        previous = baseline["scales"].get(scale)
+        if previous is None:
+            continue
+        for name, measured in current["queries"].items():
+            before = previous["queries"].get(name)
+            if not before or before["status"] != "ok":
+                continue
+            if measured["status"] != "ok":
+                print(f"{scale:>10} {name:<40} {measured['status']}  <-- REGRESSION")
+                regressed = True
+                continue
+            change = measured["median_ms"] / max(before["median_ms"], 1e-9) - 1
+            flag = ""
+            # Sub-millisecond queries are mostly noise
+            if (
+                change > threshold
+                and measured["median_ms"] - before["median_ms"] > min_ms
+            ):
+                flag = "  <-- REGRESSION"
+                regressed = True
+            print(f"{scale:>10} {name:<40} {change:+7.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default="benchmarks/config.bench.json")
+    parser.add_argument("--scales", default="10000,100000,1000000,10000000")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds per SELECT")
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument(
+        "--no-seed", action="store_true", help="Use the data already in the database"
+    )
+    parser.add_argument(
+        "--without-indexes",
+        action="store_true",
+        help="Only create the tables, for comparing with the indexes from `schema.sql`",
+    )
+    parser.add_argument("--only", nargs="*", help="Query names to run")
+    parser.add_argument("--output", default="benchmarks/results")
+    parser.add_argument("--compare", help="Earlier result file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--min-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        db = json.load(f)["DATABASE"]
+
+    scales = [int(scale) for scale in args.scales.split(",")]
+    if args.no_seed:
+        mydb = dataset.connect(db)
+        mycursor = mydb.cursor()
+        mycursor.execute("SELECT COUNT(*) FROM MapTimes")
+        scales = [mycursor.fetchone()[0]]
+        mydb.close()
+
+    results = {str(scale): bench_scale(db, scale, args) for scale in scales}
+    result = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "repeat": args.repeat,
+        "seed": args.seed,
+        "scales": results,
+        "growth": growth(results),
+    }
+
+    if result["growth"]["slopes"]:
+        print("\nGrowth between the smallest and largest scale (1.0 = linear)")
+        for name, slope in sorted(
+            result["growth"]["slopes"].items(), key=lambda x: -x[1]
+        ):
+            print(f"{name:<40} {slope:>6.2f}")
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(
+        args.output,
+        f"queries-{result['commit']}-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}.json",
+    )
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2, default=str)
+    print(f"\nSaved {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(result, json.load(f), args.threshold, args.min_ms):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
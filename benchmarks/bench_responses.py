@@ -0,0 +1,112 @@
+"""CPU spent turning database rows into a response body, FastAPI's `response_model` path against the lean path
+
+Run from the repository root:
+```
+    python -m benchmarks.bench_responses --rows 1000 --repeat 20
+```
+`response_model` paths do what FastAPI does for an endpoint returning plain data: validate the rows against
+the response model, serialize them in JSON mode and render a `JSONResponse`. The lean path is what the
+endpoints do now, encode the rows straight to bytes with the configured encoder and return a `Response`,
+FastAPI then skips the response model which is only used for the OpenAPI schema.
+"""
+
+import argparse
+import random
+import time
+from decimal import Decimal
+from typing import Any, Dict, List
+
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from encoders import SimpleJsonEncoder, get_encoder
+from models import LeaderboardRun
+
+
+def velocity(rng: random.Random) -> Decimal:
+    return Decimal(f"{rng.uniform(-3500, 3500):.6f}")
+
+
+def make_leaderboard_rows(count: int, seed: int = 1337):
+    """Rows shaped like `sql_getLeaderboardPage` results"""
+    rng = random.Random(seed)
+    return [
+        {
+            "id": i + 1,
+            "player_id": rng.randint(1, count * 4),
+            "name": f"Surfer Ünïcode {i}",
+            "map_id": 1,
+            "style": 0,
+            "type": 0,
+            "stage": 0,
+            "run_time": 20000 + i * 7,
+            "start_vel_x": velocity(rng),
+            "start_vel_y": velocity(rng),
+            "start_vel_z": velocity(rng),
+            "end_vel_x": velocity(rng),
+            "end_vel_y": velocity(rng),
+            "end_vel_z": velocity(rng),
+            "run_date": 1700000000 + i * 37,
+            "position": i + 1,
+        }
+        for i in range(count)
+    ]
+
+
+def response_model_path(adapter: TypeAdapter):
+    def render(rows):
+        value = adapter.validate_python(rows)
+        return JSONResponse(adapter.dump_python(value, mode="json")).body
+
+    return render
+
+
+def lean_path(encoder):
+    def render(rows):
+        return encoder.dumps(rows)
+
+    return render
+
+
+def cpu_best_of(fn, rows, repeat: int) -> float:
+    """Lowest process CPU time of `repeat` runs"""
+    best = float("inf")
+    for _ in range(repeat):
+        tic = time.process_time()
+        fn(rows)
+        best = min(best, time.process_time() - tic)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = make_leaderboard_rows(args.rows)
+    paths = {
+        "response_model=List[Dict[str, Any]]": response_model_path(
+            TypeAdapter(List[Dict[str, Any]])
+        ),
+        "response_model=List[LeaderboardRun]": response_model_path(
+            TypeAdapter(List[LeaderboardRun])
+        ),
+        "lean simplejson": lean_path(SimpleJsonEncoder()),
+        "lean orjson": lean_path(get_encoder("orjson")),
+    }
+
+    results = {}
+    for name, render in paths.items():
+        results[name] = cpu_best_of(render, rows, args.repeat)
+
+    lean = results["lean orjson"]
+    print(f"{'path':<40} {'ms/1k rows':>12} {'saved by lean':>14}")
+    for name, elapsed in results.items():
+        per_1k = elapsed / args.rows * 1000 * 1000
+        saved = (elapsed - lean) / args.rows * 1000 * 1000
+        print(f"{name:<40} {per_1k:>12.3f} {saved:>12.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
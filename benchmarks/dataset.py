@@ -0,0 +1,263 @@
+"""Seeds a MySQL database with a synthetic, reproducible SurfTimer dataset
+
+Run from the repository root against the stand-ins from `benchmarks/docker-compose.yml`:
+```
+    python -m benchmarks.dataset --config benchmarks/config.bench.json --maps 200 --players 20000 --maptimes 500000
+```
+`MapTimes` are spread over the maps with a Zipf distribution so a few maps are very popular,
+like on a real server. A summary of the generated ids is written to `--summary` for the load test.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import time
+
+import mysql.connector
+
+import surftimer.queries
+from schema import apply_schema
+
+
+BATCH_SIZE = 5000
+
+sql_insertMaps = """INSERT INTO `Maps` (`id`, `name`, `author`, `tier`, `stages`, `bonuses`, `ranked`, `date_added`, `last_played`)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+sql_insertPlayers = """INSERT INTO `Player` (`id`, `name`, `steam_id`, `country`, `join_date`, `last_seen`, `connections`)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)"""
+sql_insertMapTimes = """INSERT INTO `MapTimes` (`id`, `player_id`, `map_id`, `style`, `type`, `stage`, `run_time`,
+                    `start_vel_x`, `start_vel_y`, `start_vel_z`, `end_vel_x`, `end_vel_y`, `end_vel_z`, `run_date`, `replay_frames`)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+sql_insertCheckpoints = """INSERT INTO `Checkpoints` (`maptime_id`, `cp`, `run_time`, `start_vel_x`, `start_vel_y`, `start_vel_z`,
+                    `end_vel_x`, `end_vel_y`, `end_vel_z`, `attempts`, `end_touch`)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+
+
+def connect(db: dict, database: bool = True):
+    return mysql.connector.connect(
+        host=db["HOST"],
+        port=db["PORT"],
+        user=db["USERNAME"],
+        password=db["PASSWORD"],
+        database=db["DB"] if database else None,
+        autocommit=False,
+    )
+
+
+def reset_database(db: dict, indexes: bool = True):
+    """Drops and re-creates the database from `schema.sql`"""
+    mydb = connect(db, database=False)
+    mycursor = mydb.cursor()
+    mycursor.execute(f"DROP DATABASE IF EXISTS `{db['DB']}`")
+    mycursor.execute(f"CREATE DATABASE `{db['DB']}` DEFAULT CHARSET utf8mb4")
+    mycursor.execute(f"USE `{db['DB']}`")
+    apply_schema(mydb, indexes=indexes)
+    mydb.close()
+
+
+def insert_batches(mydb, query: str, rows):
+    """`executemany` in batches, mysql-connector turns each batch into a single multi-row `INSERT`"""
+    mycursor = mydb.cursor()
+    batch = []
+    total = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            mycursor.executemany(query, batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        mycursor.executemany(query, batch)
+        total += len(batch)
+    mydb.commit()
+    return total
+
+
+def velocity(rng: random.Random) -> str:
+    return f"{rng.uniform(-3500, 3500):.6f}"
+
+
+def zipf_counts(total: int, buckets: int, skew: float):
+    """Splits `total` over `buckets` with weights `1 / rank ** skew`"""
+    weights = [1 / (rank + 1) ** skew for rank in range(buckets)]
+    scale = total / sum(weights)
+    return [max(1, round(weight * scale)) for weight in weights]
+
+
+def generate(
+    db: dict,
+    maps: int,
+    players: int,
+    maptimes: int,
+    checkpoints: bool = True,
+    styles: int = 3,
+    skew: float = 1.0,
+    seed: int = 1337,
+):
+    """Generates the dataset and returns a summary the load test uses to build requests"""
+    rng = random.Random(seed)
+    now = int(time.time())
+    mydb = connect(db)
+
+    map_rows = []
+    for map_id in range(1, maps + 1):
+        map_rows.append(
+            (
+                map_id,
+                f"surf_bench_{map_id:05d}",
+                f"mapper_{rng.randint(1, 300)}",
+                rng.randint(1, 8),
+                rng.choice((0, 0, 0, rng.randint(2, 30))),  # Most maps are linear
+                rng.choice((0, 0, 1, 1, 2, 3)),
+                1,
+                now - rng.randint(0, 3 * 365 * 86400),
+                now - rng.randint(0, 30 * 86400),
+            )
+        )
+    insert_batches(mydb, sql_insertMaps, map_rows)
+
+    player_rows = (
+        (
+            player_id,
+            f"surfer_{player_id}",
+            76561197960265728 + player_id,
+            rng.choice(("DE", "US", "GB", "PL", "RU", "FR", "BR", "SE", "CN", "AU")),
+            now - rng.randint(0, 3 * 365 * 86400),
+            now - rng.randint(0, 30 * 86400),
+            rng.randint(1, 500),
+        )
+        for player_id in range(1, players + 1)
+    )
+    insert_batches(mydb, sql_insertPlayers, player_rows)
+
+    maptime_id = 0
+    cp_total = 0
+    mapruns = []
+
+    def maptime_rows():
+        nonlocal maptime_id
+        for map_row, count in zip(map_rows, zipf_counts(maptimes, maps, skew)):
+            map_id, _, _, tier, stages, bonuses = map_row[:6]
+            base = 20000 + tier * 15000  # Run time of a good run in ticks
+            # (style, type, stage) groups with the share of the runs they get
+            groups = [(0, 0, 0, 0.5)]
+            for stage in range(1, stages + 1):
+                groups.append((0, 2, stage, 0.3 / stages))
+            for bonus in range(1, bonuses + 1):
+                groups.append((0, 1, bonus, 0.1 / bonuses))
+            for style in range(1, styles):
+                groups.append((style, 0, 0, 0.1 / max(styles - 1, 1)))
+
+            for style, run_type, stage, share in groups:
+                group_count = min(players, max(1, round(count * share)))
+                group_base = base if run_type == 0 else base // max(stages, 1)
+                for player_id in rng.sample(range(1, players + 1), group_count):
+                    maptime_id += 1
+                    run_time = int(group_base * math.exp(abs(rng.gauss(0, 0.35))))
+                    if run_type == 0 and style == 0 and stages and checkpoints:
+                        mapruns.append((maptime_id, run_time, stages))
+                    yield (
+                        maptime_id,
+                        player_id,
+                        map_id,
+                        style,
+                        run_type,
+                        stage,
+                        run_time,
+                        velocity(rng),
+                        velocity(rng),
+                        velocity(rng),
+                        velocity(rng),
+                        velocity(rng),
+                        velocity(rng),
+                        now - rng.randint(0, 365 * 86400),
+                        "",
+                    )
+
+    maptimes_total = insert_batches(mydb, sql_insertMapTimes, maptime_rows())
+
+    def checkpoint_rows():
+        nonlocal cp_total
+        for run_id, run_time, stages in mapruns:
+            for cp in range(1, stages + 1):
+                cp_total += 1
+                yield (
+                    run_id,
+                    cp,
+                    run_time * cp // (stages + 1),
+                    velocity(rng),
+                    velocity(rng),
+                    velocity(rng),
+                    velocity(rng),
+                    velocity(rng),
+                    velocity(rng),
+                    rng.randint(1, 5),
+                    0,
+                )
+
+    insert_batches(mydb, sql_insertCheckpoints, checkpoint_rows())
+
+    mycursor = mydb.cursor()
+    mycursor.execute(surftimer.queries.sql_rebuildMapRecords.format("TRUE"))
+    mydb.commit()
+    mydb.close()
+
+    return {
+        "seed": seed,
+        "maps": maps,
+        "players": players,
+        "maptimes": maptimes_total,
+        "checkpoints": cp_total,
+        "map_names": [row[1] for row in map_rows],
+        "map_stages": [row[4] for row in map_rows],
+        "map_bonuses": [row[5] for row in map_rows],
+        "steam_id_base": 76561197960265728,
+        "checkpoint_maptime_ids": [run[0] for run in mapruns[:5000]],
+        "max_maptime_id": maptime_id,
+        "skew": skew,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default="benchmarks/config.bench.json")
+    parser.add_argument("--maps", type=int, default=200)
+    parser.add_argument("--players", type=int, default=20000)
+    parser.add_argument("--maptimes", type=int, default=500000)
+    parser.add_argument("--styles", type=int, default=3)
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument("--no-checkpoints", action="store_true")
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--summary", default="benchmarks/results/dataset.json")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        db = json.load(f)["DATABASE"]
+
+    tic = time.perf_counter()
+    reset_database(db)
+    summary = generate(
+        db,
+        args.maps,
+        args.players,
+        args.maptimes,
+        checkpoints=not args.no_checkpoints,
+        styles=args.styles,
+        skew=args.skew,
+        seed=args.seed,
+    )
+
+    os.makedirs(os.path.dirname(args.summary), exist_ok=True)
+    with open(args.summary, "w") as f:
+        json.dump(summary, f)
+
+    print(
+        f"{summary['maptimes']} MapTimes, {summary['checkpoints']} Checkpoints "
+        f"in {time.perf_counter() - tic:0.1f}s, summary in {args.summary}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+"""Drives realistic traffic against the API and reports latency percentiles and throughput per endpoint
+
+Run from the repository root after seeding a dataset with `benchmarks.dataset`:
+```
+    python -m benchmarks.loadtest --mix storm --duration 30 --concurrency 64
+```
+Without `--url` the API is started with uvicorn using `--config` (the local stand-ins by default).
+Results are written to `--output` as JSON, pass an older result with `--compare` to see the difference
+and get a non-zero exit code when an endpoint regressed by more than `--threshold`.
+
+Traffic mixes:
+- `storm`   a map change, every server loads the same few maps and all connected players at once
+- `finish`  finish bursts, map/stage times being saved followed by the personal best reads
+- `profile` web profile pages, player profiles, all runs of a player and leaderboards
+- `mixed`   all of the above
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Traffic:
+    """Builds requests for the generated dataset, `hot_maps` are the maps a storm goes to"""
+
+    def __init__(self, dataset: dict, rng: random.Random, hot_maps: int = 3):
+        self.dataset = dataset
+        self.rng = rng
+        self.hot_maps = hot_maps
+        # Same popularity as the generated `MapTimes`
+        self.map_weights = [
+            1 / (rank + 1) ** dataset["skew"] for rank in range(dataset["maps"])
+        ]
+
+    def map_id(self, hot: bool = False) -> int:
+        if hot:
+            return self.rng.randint(1, min(self.hot_maps, self.dataset["maps"]))
+        return self.rng.choices(range(1, self.dataset["maps"] + 1), self.map_weights)[0]
+
+    def player_id(self) -> int:
+        return self.rng.randint(1, self.dataset["players"])
+
+    def velocities(self) -> dict:
+        return {
+            f"{edge}_vel_{axis}": round(self.rng.uniform(-3500, 3500), 6)
+            for edge in ("start", "end")
+            for axis in ("x", "y", "z")
+        }
+
+    # Requests, each returns `(name, method, url, json body)`
+    def mapinfo(self, hot=False):
+        map_id = self.map_id(hot)
+        name = self.dataset["map_names"][map_id - 1]
+        return "mapinfo", "GET", f"/surftimer/mapinfo?mapname={name}", None
+
+    def maprunsdata(self, hot=False):
+        return (
+            "maprunsdata",
+            "GET",
+            f"/surftimer/maprunsdata?id={self.map_id(hot)}",
+            None,
+        )
+
+    def maptotals(self, hot=False):
+        url = f"/surftimer/maptotals?map_id={self.map_id(hot)}&style=0"
+        return "maptotals", "GET", url, None
+
+    def mapcheckpointsdata(self, hot=False):
+        ids = self.dataset["checkpoint_maptime_ids"] or [1]
+        url = f"/surftimer/mapcheckpointsdata?maptime_id={self.rng.choice(ids)}"
+        return "mapcheckpointsdata", "GET", url, None
+
+    def playersurfprofile(self, hot=False):
+        steam_id = self.dataset["steam_id_base"] + self.player_id()
+        return (
+            "playersurfprofile",
+            "GET",
+            f"/surftimer/playersurfprofile/{steam_id}",
+            None,
+        )
+
+    def playermapdata(self, hot=False):
+        url = f"/surftimer/playermapdata?player_id={self.player_id()}&map_id={self.map_id(hot)}"
+        return "playermapdata", "GET", url, None
+
+    def runbyplayer(self, hot=False):
+        url = (
+            f"/surftimer/runbyplayer?player_id={self.player_id()}"
+            f"&map_id={self.map_id(hot)}&type=0&style=0"
+        )
+        return "runbyplayer", "GET", url, None
+
+    def runbyid(self, hot=False):
+        run_id = self.rng.randint(1, self.dataset["max_maptime_id"])
+        return "runbyid", "GET", f"/surftimer/runbyid?run_id={run_id}", None
+
+    def maprunbyrank(self, hot=False):
+        url = f"/surftimer/getmaprunbyrank?map_id={self.map_id(hot)}&style=0&rank={self.rng.randint(1, 10)}"
+        return "getmaprunbyrank", "GET", url, None
+
+    def savemaptime(self, hot=False):
+        map_id = self.map_id(hot)
+        stages = self.dataset["map_stages"][map_id - 1]
+        run_time = self.rng.randint(20000, 200000)
+        body = {
+            "player_id": self.player_id(),
+            "map_id": map_id,
+            "run_time": run_time,
+            "style": 0,
+            "type": 0,
+            "stage": 0,
+            "replay_frames": "",
+            "checkpoints": [
+                {
+                    "cp": cp,
+                    "run_time": run_time * cp // (stages + 1),
+                    "end_touch": 0,
+                    "attempts": self.rng.randint(1, 5),
+                    **self.velocities(),
+                }
+                for cp in range(1, stages + 1)
+            ],
+            **self.velocities(),
+        }
+        return "savemaptime", "POST", "/surftimer/savemaptime", body
+
+    def savestagetime(self, hot=False):
+        map_id = self.map_id(hot)
+        body = {
+            "player_id": self.player_id(),
+            "map_id": map_id,
+            "run_time": self.rng.randint(2000, 30000),
+            "style": 0,
+            "type": 2,
+            "stage": self.rng.randint(
+                1, max(self.dataset["map_stages"][map_id - 1], 1)
+            ),
+            "replay_frames": "",
+            **self.velocities(),
+        }
+        return "savestagetime", "POST", "/surftimer/savestagetime", body
+
+
+# mix: [(weight, request builder, goes to the hot maps)]
+MIXES = {
+    "storm": [
+        (10, Traffic.mapinfo, True),
+        (10, Traffic.maprunsdata, True),
+        (25, Traffic.playersurfprofile, False),
+        (30, Traffic.playermapdata, True),
+        (15, Traffic.runbyplayer, True),
+        (10, Traffic.mapcheckpointsdata, False),
+    ],
+    "finish": [
+        (25, Traffic.savemaptime, False),
+        (25, Traffic.savestagetime, False),
+        (25, Traffic.runbyplayer, False),
+        (15, Traffic.maprunsdata, False),
+        (10, Traffic.mapcheckpointsdata, False),
+    ],
+    "profile": [
+        (30, Traffic.playersurfprofile, False),
+        (30, Traffic.playermapdata, False),
+        (15, Traffic.maptotals, False),
+        (15, Traffic.runbyid, False),
+        (10, Traffic.maprunbyrank, False),
+    ],
+}
+MIXES["mixed"] = MIXES["storm"] + MIXES["finish"] + MIXES["profile"]
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(
+        len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1)
+    )
+    return sorted_values[index]
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 2),
+        "mean_ms": (
+            round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0
+        ),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+async def run_load(url, mix, dataset, duration, warmup, concurrency, seed, headers):
+    """Runs `concurrency` workers for `warmup + duration` seconds, only requests finished after the warmup count"""
+    weights = [weight for weight, _, _ in MIXES[mix]]
+    builders = [(builder, hot) for _, builder, hot in MIXES[mix]]
+    samples = {}
+    errors = {}
+    start = time.perf_counter()
+    measure_from = start + warmup
+    stop = measure_from + duration
+
+    async def worker(worker_id: int, client: httpx.AsyncClient):
+        traffic = Traffic(dataset, random.Random(seed + worker_id))
+        while time.perf_counter() < stop:
+            builder, hot = traffic.rng.choices(builders, weights)[0]
+            name, method, path, body = builder(traffic, hot)
+            tic = time.perf_counter()
+            try:
+                response = await client.request(method, path, json=body)
+                failed = response.status_code >= 500
+            except httpx.HTTPError:
+                failed = True
+            toc = time.perf_counter()
+            if toc < measure_from:
+                continue
+            if failed:
+                errors[name] = errors.get(name, 0) + 1
+            else:
+                samples.setdefault(name, []).append(toc - tic)
+
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+    async with httpx.AsyncClient(
+        base_url=url, limits=limits, timeout=30, headers=headers
+    ) as client:
+        await asyncio.gather(*(worker(i, client) for i in range(concurrency)))
+
+    elapsed = time.perf_counter() - measure_from
+    endpoints = {
+        name: summarize(samples.get(name, []), errors.get(name, 0), elapsed)
+        for name in sorted(set(samples) | set(errors))
+    }
+    everything = [latency for values in samples.values() for latency in values]
+    return endpoints, summarize(everything, sum(errors.values()), elapsed)
+
+
+def start_api(config_path: str, port: int, workers: int):
+    """Starts uvicorn in a scratch directory holding the config and empty request logs"""
+    workdir = tempfile.mkdtemp(prefix="surftimer-bench-")
+    shutil.copy(config_path, os.path.join(workdir, "config.json"))
+    for log in ("requests.json", "denied.json"):
+        with open(os.path.join(workdir, log), "w") as f:
+            f.write("[]")
+
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--app-dir",
+            ROOT,
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+            "--no-access-log",
+        ],
+        cwd=workdir,
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            httpx.get(f"{url}/ping", params={"client_unix": time.time()}, timeout=1)
+            return process, url, workdir
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("The API did not start, check the uvicorn output above")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> bool:
+    """Prints the difference to `baseline`, returns `True` if any endpoint regressed by more than `threshold`"""
+    regressed = False
+    print(f"\nCompared to {baseline['commit']} ({baseline['timestamp']})")
+    for name, current in result["endpoints"].items():
+        previous = baseline["endpoints"].get(name)
+        if not previous or not previous["p95_ms"] or not previous["rps"]:
+            continue
+        p95 = current["p95_ms"] / previous["p95_ms"] - 1
+        rps = current["rps"] / previous["rps"] - 1
+        flag = ""
+        if p95 > threshold:
+            flag = "  <-- REGRESSION"
+            regressed = True
+        print(f"{name:<20} p95 {p95:+7.1%}  rps {rps:+7.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mix", choices=sorted(MIXES), default="mixed")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--url", help="Benchmark an API that is already running")
+    parser.add_argument("--config", default="benchmarks/config.bench.json")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--dataset", default="benchmarks/results/dataset.json")
+    parser.add_argument("--accept", default="application/json")
+    parser.add_argument("--accept-encoding", default="identity")
+    parser.add_argument("--output", default="benchmarks/results")
+    parser.add_argument("--compare", help="Earlier result file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args()
+
+    with open(args.dataset) as f:
+        dataset = json.load(f)
+
+    process = workdir = None
+    url = args.url
+    if url is None:
+        process, url, workdir = start_api(args.config, args.port, args.workers)
+
+    try:
+        endpoints, total = asyncio.run(
+            run_load(
+                url,
+                args.mix,
+                dataset,
+                args.duration,
+                args.warmup,
+                args.concurrency,
+                args.seed,
+                {"accept": args.accept, "accept-encoding": args.accept_encoding},
+            )
+        )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "mix": args.mix,
+        "duration": args.duration,
+        "concurrency": args.concurrency,
+        "workers": args.workers,
+        "accept": args.accept,
+        "accept_encoding": args.accept_encoding,
+        "dataset": {
+            key: dataset[key]
+            for key in ("seed", "maps", "players", "maptimes", "checkpoints")
+        },
+        "endpoints": endpoints,
+        "total": total,
+    }
+
+    print(
+        f"{'endpoint':<20} {'count':>8} {'err':>5} {'rps':>9} {'p50':>9} {'p95':>9} {'p99':>9}"
+    )
+    for name, stats in list(endpoints.items()) + [("TOTAL", total)]:
+        print(
+            f"{name:<20} {stats['count']:>8} {stats['errors']:>5} {stats['rps']:>9.1f} "
+            f"{stats['p50_ms']:>8.1f}ms {stats['p95_ms']:>8.1f}ms {stats['p99_ms']:>8.1f}ms"
+        )
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(
+        args.output,
+        f"loadtest-{args.mix}-{result['commit']}-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}.json",
+    )
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"\nSaved {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(result, json.load(f), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Checkpoint reads from the configured storage (`checkpoints.py`)
+
+With `"STORAGE": "packed"` the `PackedCheckpoints` row of a run is read first and runs without one, not migrated
+yet, are read from `Checkpoints`. A save writes the run's checkpoints to one storage and deletes them from the
+other in the same transaction, so a run never has checkpoints in both. Every endpoint returning checkpoints reads
+them through here so both storages return the same rows, `id` is `None` for packed checkpoints.
+"""
+
+import surftimer.queries
+from checkpoints import unpack_rows
+from globals import checkpoint_config
+from splits import CheckpointArrays
+from sql import selectQuery
+
+
+def _ids(maptime_ids: list) -> str:
+    return ", ".join(map(str, maptime_ids)) or "NULL"
+
+
+def get_checkpoints(maptime_ids: list) -> dict:
+    """`{maptime_id: rows}` in `cp` order, the rows `sql_getCheckpointRows` returns, runs without checkpoints are left out"""
+    runs = {}
+    missing = maptime_ids
+    if checkpoint_config["STORAGE"] == "packed" and maptime_ids:
+        for row in selectQuery(
+            surftimer.queries.sql_getPackedCheckpoints.format(_ids(maptime_ids))
+        ):
+            runs[row["maptime_id"]] = unpack_rows(row["maptime_id"], row["data"])
+        missing = [maptime_id for maptime_id in maptime_ids if maptime_id not in runs]
+    if missing:
+        for row in selectQuery(
+            surftimer.queries.sql_getCheckpointRows.format(_ids(missing))
+        ):
+            runs.setdefault(row["maptime_id"], []).append(row)
+    return runs
+
+
+def get_checkpoint_arrays(maptime_ids: list) -> CheckpointArrays:
+    """Checkpoints of the runs as `CheckpointArrays`, read like `get_checkpoints`"""
+    parts = []
+    missing = maptime_ids
+    if checkpoint_config["STORAGE"] == "packed":
+        packed = selectQuery(
+            surftimer.queries.sql_getPackedCheckpoints.format(_ids(maptime_ids))
+        )
+        found = {row["maptime_id"] for row in packed}
+        missing = [maptime_id for maptime_id in maptime_ids if maptime_id not in found]
+        parts.append(CheckpointArrays.from_packed(packed))
+    if missing or not parts:
+        parts.append(
+            CheckpointArrays.from_rows(
+                selectQuery(
+                    surftimer.queries.sql_getCheckpointsByRuns.format(_ids(missing))
+                )
+            )
+        )
+    return CheckpointArrays.concatenate(parts) if len(parts) > 1 else parts[0]
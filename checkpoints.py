@@ -0,0 +1,86 @@
+"""Packed checkpoint storage, all checkpoints of a run in one fixed-width binary row of `PackedCheckpoints`
+
+Enabled with `"CHECKPOINTS": {"STORAGE": "packed"}` in `config.json`, `"rows"` keeps one `Checkpoints` row per cp.
+Every checkpoint takes `DTYPE.itemsize` (64) little-endian bytes. Velocities are `DECIMAL(12, 6)` columns and are
+stored as integer millionths so they decode to the exact `Decimal` values MySQL returns for the row storage.
+Runs that have no packed row yet are read from `Checkpoints`, see `migrate_checkpoints.py` for moving them over.
+Only NumPy is needed here so the migration and the benchmarks can use it without the API config.
+"""
+
+from decimal import ROUND_HALF_UP, Decimal
+
+import numpy as np
+
+
+VELOCITIES = (
+    "start_vel_x",
+    "start_vel_y",
+    "start_vel_z",
+    "end_vel_x",
+    "end_vel_y",
+    "end_vel_z",
+)
+VELOCITY_SCALE = 1_000_000
+DTYPE = np.dtype(
+    [("cp", "<i4"), ("run_time", "<i4")]
+    + [(name, "<i8") for name in VELOCITIES]
+    + [("end_touch", "<i4"), ("attempts", "<i4")]
+)
+
+
+def _scaled(value) -> int:
+    """Velocity in millionths, rounded half away from zero like MySQL rounds `DECIMAL(12, 6)`"""
+    return int(
+        (Decimal(value) * VELOCITY_SCALE).to_integral_value(rounding=ROUND_HALF_UP)
+    )
+
+
+def pack(checkpoints: list) -> bytes:
+    """Packs `Checkpoint` models or `Checkpoints` rows, in `cp` order"""
+    array = np.zeros(len(checkpoints), dtype=DTYPE)
+    for index, checkpoint in enumerate(checkpoints):
+        if not isinstance(checkpoint, dict):
+            checkpoint = checkpoint.model_dump()
+        array[index] = (
+            checkpoint["cp"],
+            checkpoint["run_time"],
+            *(_scaled(checkpoint[name]) for name in VELOCITIES),
+            checkpoint["end_touch"],
+            checkpoint["attempts"],
+        )
+    array.sort(order="cp", kind="stable")
+    return array.tobytes()
+
+
+def unpack(data: bytes) -> np.ndarray:
+    """Structured array of `DTYPE`, shares the memory of `data`"""
+    return np.frombuffer(data, dtype=DTYPE)
+
+
+def unpack_rows(maptime_id: int, data: bytes) -> list:
+    """The rows `sql_getMapCheckpointsData` returns for the run, `id` is `None` as packed checkpoints have no row id"""
+    array = unpack(data)
+    # `scaleb` keeps the 6 decimals, `Decimal("1.500000")` like the `DECIMAL(12, 6)` column
+    velocities = {
+        name: [Decimal(value).scaleb(-6) for value in array[name].tolist()]
+        for name in VELOCITIES
+    }
+    return [
+        {
+            "id": None,
+            "maptime_id": maptime_id,
+            "cp": cp,
+            "run_time": run_time,
+            **{name: velocities[name][index] for name in VELOCITIES},
+            "attempts": attempts,
+            "end_touch": end_touch,
+        }
+        for index, (cp, run_time, attempts, end_touch) in enumerate(
+            zip(
+                array["cp"].tolist(),
+                array["run_time"].tolist(),
+                array["attempts"].tolist(),
+                array["end_touch"].tolist(),
+            )
+        )
+    ]
@@ -0,0 +1,103 @@
+"""Response compression negotiated through `Accept-Encoding`
+
+`gzip` is always available, `br` and `zstd` are used when `brotli` and `zstandard` are installed.
+When the client accepts several of them we prefer `zstd`, then `br`, then `gzip`.
+"""
+
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli is optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional
+    zstandard = None
+
+
+def _gzip(body: bytes, level: int) -> bytes:
+    # `mtime=0` keeps the output identical for identical bodies
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def _brotli(body: bytes, level: int) -> bytes:
+    return brotli.compress(body, quality=level)
+
+
+def _zstd(body: bytes, level: int) -> bytes:
+    # Compressor objects are not thread safe, these calls may run in the threadpool
+    return zstandard.ZstdCompressor(level=level).compress(body)
+
+
+# coding: (compress function, default level), in order of preference
+CODECS = {}
+if zstandard is not None:
+    CODECS["zstd"] = (_zstd, 3)
+if brotli is not None:
+    CODECS["br"] = (_brotli, 5)
+CODECS["gzip"] = (_gzip, 6)
+
+
+def negotiate_encoding(accept_encoding: str, codings=CODECS) -> str:
+    """Returns the preferred coding the client accepts or `None` for an uncompressed response\n
+    `Accept-Encoding: gzip, br, zstd;q=0` returns `"br"` if `brotli` is installed, `"gzip"` otherwise
+    """
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for entry in accept_encoding.split(","):
+        coding, *params = entry.strip().split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    wildcard = accepted.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for coding in codings:
+        quality = accepted.get(coding, wildcard)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+
+    return best
+
+
+def compress(body: bytes, coding: str, levels: dict = None) -> bytes:
+    """Compresses `body` with `coding`, `levels` overrides the default level per coding"""
+    compress_function, level = CODECS[coding]
+    if levels and coding in levels:
+        level = levels[coding]
+    return compress_function(body, level)
+
+
+def compress_stream(chunks, coding: str, levels: dict = None):
+    """Compresses an iterable of `bytes` chunk by chunk, the output is a single `coding` stream"""
+    level = CODECS[coding][1]
+    if levels and coding in levels:
+        level = levels[coding]
+
+    if coding == "gzip":
+        # `wbits=31` writes the gzip header, with `mtime=0` like `_gzip`
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+    elif coding == "br":
+        compressor = brotli.Compressor(quality=level)
+        process, finish = compressor.process, compressor.finish
+    else:
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        process, finish = compressor.compress, compressor.flush
+
+    for chunk in chunks:
+        compressed = process(chunk)
+        if compressed:
+            yield compressed
+    yield finish()
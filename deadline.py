@@ -0,0 +1,231 @@
+"""Request deadlines and cancellation of abandoned reads
+
+Every `GET` request under `/surftimer/` gets a deadline: `ROUTES[path]` seconds or `DEFAULT`, shortened by the
+`HEADER` the client can send with the milliseconds it is going to wait, at most `MAX`. A route with 0 has no
+deadline unless the client sends one. The deadline is passed down to MySQL, `selectQuery` and `streamQuery` add a
+`MAX_EXECUTION_TIME` hint with the time that is left so the server aborts the query instead of running it to
+completion, and a read past its deadline doesn't send its next query at all. Redis calls go through
+`DeadlineConnection`: a call isn't sent after the deadline and waits for its reply at most the time that is left,
+`REDIS.SOCKET_TIMEOUT` still bounds it without a deadline.
+
+The request is cancelled when the client disconnects or the deadline passes while it waits, e.g. for an admission
+slot or a threadpool, so an abandoned request gives its slot and connection back. A passed deadline is answered
+with `504`, a disconnected client with `499`. MySQL queries and Redis calls block the event loop while they run,
+a request is only cancelled between them: the hint and the Redis timeout are what stop a running call.
+
+Writes are never cancelled or cut short, a save the plugin gave up on is still saved.
+"""
+
+import asyncio
+import time
+from contextvars import ContextVar
+
+import redis
+from fastapi import status
+from fastapi.responses import JSONResponse
+from redis.connection import SENTINEL
+
+from metrics import REQUESTS_ABANDONED
+
+
+deadline_config = {
+    "ENABLED": 1,
+    "DEFAULT": 5,
+    "MAX": 30,
+    "HEADER": "X-Request-Timeout-Ms",
+    "ROUTES": {
+        "/surftimer/mapexport": 0,
+        "/surftimer/maptotals": 30,
+    },
+}
+
+# MySQL's `ER_QUERY_TIMEOUT`, the query ran longer than its `MAX_EXECUTION_TIME`
+QUERY_TIMEOUT_ERRNO = 3024
+
+# `time.monotonic()` by which the current request has to be answered, `None` without a deadline
+_deadline = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed, answered with `504`"""
+
+
+def remaining():
+    """Seconds left until the deadline of the current request, `None` without a deadline"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check_deadline():
+    """Raises `DeadlineExceeded` when the deadline of the current request passed"""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded()
+
+
+def _call_timeout(timeout):
+    """`timeout` shortened to the time left, raises `DeadlineExceeded` when the deadline passed"""
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded()
+    return left if timeout is None else min(timeout, left)
+
+
+class DeadlineConnection(redis.Connection):
+    """Redis connection whose calls end with the deadline of the current request\n
+    A call past the deadline is not sent, connecting and waiting for the reply time out with the deadline and raise
+    `DeadlineExceeded`. Without a deadline the connection's timeouts apply as usual
+    """
+
+    def send_packed_command(self, command, check_health=True):
+        connect_timeout = self.socket_connect_timeout
+        self.socket_connect_timeout = _call_timeout(connect_timeout)
+        try:
+            return super().send_packed_command(command, check_health)
+        except redis.TimeoutError as e:
+            check_deadline()
+            raise e
+        finally:
+            self.socket_connect_timeout = connect_timeout
+
+    def read_response(self, *args, timeout=SENTINEL, **kwargs):
+        try:
+            if remaining() is not None:
+                timeout = _call_timeout(
+                    self.socket_timeout if timeout is SENTINEL else timeout
+                )
+            return super().read_response(*args, timeout=timeout, **kwargs)
+        except DeadlineExceeded:
+            # The reply was never read, the connection can't be reused
+            self.disconnect()
+            raise
+        except redis.TimeoutError as e:
+            check_deadline()
+            raise e
+
+
+def with_execution_time(query):
+    """`query` with a `MAX_EXECUTION_TIME` hint of the milliseconds left, as it is without a deadline\n
+    Only `SELECT` statements take the hint, the `NamedQuery` name is kept for the metrics
+    """
+    left = remaining()
+    if left is None:
+        return query
+    if left <= 0:
+        raise DeadlineExceeded()
+
+    statement = query.lstrip()
+    if statement[:6].upper() != "SELECT":
+        return query
+    hinted = (
+        f"SELECT /*+ MAX_EXECUTION_TIME({max(1, int(left * 1000))}) */{statement[6:]}"
+    )
+    name = getattr(query, "name", None)
+    return type(query)(hinted, name) if name is not None else hinted
+
+
+def request_timeout(scope):
+    """Seconds the request may take or `None`, the route's deadline shortened by the client's"""
+    timeout = deadline_config["ROUTES"].get(scope["path"], deadline_config["DEFAULT"])
+    header = deadline_config["HEADER"].lower().encode("latin-1")
+    for name, value in scope["headers"]:
+        if name == header:
+            try:
+                client_timeout = int(value) / 1000
+            except ValueError:
+                break
+            if client_timeout > 0 and (not timeout or client_timeout < timeout):
+                timeout = client_timeout
+            break
+    if not timeout:
+        return None
+    return min(timeout, deadline_config["MAX"])
+
+
+class DeadlineMiddleware:
+    """Sets the deadline of a read and cancels it when the client disconnects or the deadline passes\n
+    A plain ASGI middleware, it reads the client's messages itself to notice a disconnect while the request runs
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or deadline_config["ENABLED"] == 0
+            or scope["method"] not in ("GET", "HEAD")
+            or not scope["path"].startswith("/surftimer/")
+        ):
+            return await self.app(scope, receive, send)
+
+        timeout = request_timeout(scope)
+        token = _deadline.set(None if timeout is None else time.monotonic() + timeout)
+        started = False
+        messages = asyncio.Queue()
+
+        async def send_tracked(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        async def watch():
+            # After the request body `receive` only returns once the client disconnected or the response was sent
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    return
+
+        # Tasks copy the context, the request sees the deadline set above
+        handler = asyncio.ensure_future(self.app(scope, messages.get, send_tracked))
+        watcher = asyncio.ensure_future(watch())
+        try:
+            done, _ = await asyncio.wait(
+                (handler, watcher),
+                timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if handler not in done and watcher not in done and started:
+                # Too late to answer with `504`, let the response finish unless the client goes away
+                done, _ = await asyncio.wait(
+                    (handler, watcher), return_when=asyncio.FIRST_COMPLETED
+                )
+
+            if handler in done:
+                # A query that would have started after the deadline or that MySQL aborted
+                if isinstance(handler.exception(), DeadlineExceeded) and not started:
+                    reason = "deadline"
+                else:
+                    return handler.result()
+            else:
+                reason = "disconnect" if watcher in done else "deadline"
+                handler.cancel()
+                try:
+                    await handler
+                except asyncio.CancelledError:
+                    pass
+
+            REQUESTS_ABANDONED.labels(reason).inc()
+            if started:
+                return
+            if reason == "deadline":
+                response = JSONResponse(
+                    status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                    content={"message": "Deadline Exceeded"},
+                )
+            else:
+                # Nothing reaches a client that went away, the response is for the outer middlewares and metrics
+                response = JSONResponse(
+                    status_code=499, content={"message": "Client Closed Request"}
+                )
+            await response(scope, messages.get, send)
+        finally:
+            handler.cancel()
+            watcher.cancel()
+            _deadline.reset(token)
@@ -0,0 +1,263 @@
+"""Pluggable encoders used for API responses and cached payloads
+
+Every JSON encoder produces the same document as the original `simplejson` path:
+`Decimal` values are written as exact number literals and `datetime` values
+use `custom_date_format`. Select the implementation with the `ENCODER` key
+in `config.json` (`"orjson"` by default, `"simplejson"` as the reference).
+
+Clients can ask for the same schema in MessagePack with `Accept: application/msgpack`,
+see `negotiate_encoder`.
+"""
+
+import simplejson
+from datetime import datetime
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, `get_encoder` falls back to simplejson
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, clients always get JSON without it
+    msgpack = None
+
+
+_ORDINAL_SUFFIXES = ("th", "st", "nd", "rd", "th")
+_MONTHS = (
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+)
+
+
+def ordinal(n):
+    suffix = _ORDINAL_SUFFIXES[min(n % 10, 4)]
+    if 11 <= (n % 100) <= 13:
+        suffix = "th"
+    return str(n) + suffix
+
+
+def custom_date_format(dt):
+    """`datetime(2024, 1, 2, 13, 5, 9)` becomes `"2nd of January 2024, 13:05:09"`"""
+    return (
+        f"{ordinal(dt.day)} of {_MONTHS[dt.month - 1]} {dt.year}, "
+        f"{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
+    )
+
+
+def custom_time_format(time_value):
+    # Convert to Decimal for precise arithmetic
+    time_value = Decimal(time_value)
+
+    # Calculate minutes and remaining seconds
+    minutes = int(time_value // 60)
+    seconds = time_value % 60
+
+    # Format the time
+    formatted_time = f"{minutes}:{seconds:06.4f}" if minutes > 0 else f"{seconds:.4f}"
+
+    return formatted_time
+
+
+def default_serializer(obj):
+    if isinstance(obj, datetime):
+        return custom_date_format(obj)
+    elif isinstance(obj, Decimal):
+        return custom_time_format(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class Encoder:
+    """Base class for all encoders\n
+    `dumps` returns `bytes` ready to be sent or cached, `loads` reverses it,
+    `stream` writes a list of rows incrementally from batches of rows"""
+
+    name = None
+    format = "json"
+    media_type = "application/json"
+    # Between the items of an array, used by `stream`
+    item_separator = b","
+
+    def dumps(self, data) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes):
+        raise NotImplementedError
+
+    def stream(self, batches):
+        """Yields a JSON array of all rows one batch at a time, the output is the same as `dumps(rows)`"""
+        yield b"["
+        first = True
+        for batch in batches:
+            if not batch:
+                continue
+            # The batch without its brackets
+            body = self.dumps(batch)[1:-1]
+            yield body if first else self.item_separator + body
+            first = False
+        yield b"]"
+
+
+class SimpleJsonEncoder(Encoder):
+    """Reference implementation, this is what `set_cache` has always produced"""
+
+    name = "simplejson"
+    item_separator = b", "
+
+    def dumps(self, data) -> bytes:
+        return simplejson.dumps(
+            data,
+            use_decimal=True,
+            encoding="utf-8",
+            ensure_ascii=False,
+            default=default_serializer,
+            allow_nan=True,
+        ).encode("utf-8")
+
+    def loads(self, data: bytes):
+        return simplejson.loads(data, use_decimal=True, allow_nan=True)
+
+
+class OrjsonEncoder(Encoder):
+    """`orjson` backed encoder\n
+    Types `orjson` can't write natively go through a handler table which is built once,
+    so every value costs a single dict lookup instead of an `isinstance` chain"""
+
+    name = "orjson"
+
+    def __init__(self):
+        handlers = {
+            Decimal: lambda value: orjson.Fragment(str(value)),
+            datetime: custom_date_format,
+        }
+
+        def default(obj):
+            handler = handlers.get(type(obj))
+            if handler is None:
+                raise TypeError(
+                    f"Object of type {type(obj).__name__} is not JSON serializable"
+                )
+            return handler(obj)
+
+        self._default = default
+        self._option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, data) -> bytes:
+        return orjson.dumps(data, default=self._default, option=self._option)
+
+    def loads(self, data: bytes):
+        # `orjson` reads numbers as `float`, use simplejson to keep the `Decimal` precision
+        return simplejson.loads(data, use_decimal=True, allow_nan=True)
+
+
+class MsgpackEncoder(Encoder):
+    """MessagePack encoder with the same schema as the JSON encoders\n
+    `Decimal` values are packed as `float64`, `datetime` values with `custom_date_format`
+    """
+
+    name = "msgpack"
+    format = "msgpack"
+    media_type = "application/msgpack"
+
+    def __init__(self):
+        handlers = {
+            Decimal: float,
+            datetime: custom_date_format,
+        }
+
+        def default(obj):
+            handler = handlers.get(type(obj))
+            if handler is None:
+                raise TypeError(
+                    f"Object of type {type(obj).__name__} is not MessagePack serializable"
+                )
+            return handler(obj)
+
+        self._default = default
+        self._packer = msgpack.Packer(default=default, use_bin_type=True)
+
+    def dumps(self, data) -> bytes:
+        return self._packer.pack(data)
+
+    def loads(self, data: bytes):
+        return msgpack.unpackb(data, raw=False)
+
+    def stream(self, batches):
+        """The array header needs the number of rows up front, so the rows are collected first\n
+        Runs in the threadpool, a new `Packer` is used since they are not thread safe"""
+        rows = [row for batch in batches for row in batch]
+        packer = msgpack.Packer(default=self._default, use_bin_type=True)
+        yield packer.pack_array_header(len(rows))
+        for row in rows:
+            yield packer.pack(row)
+
+
+ENCODERS = {
+    SimpleJsonEncoder.name: SimpleJsonEncoder,
+    OrjsonEncoder.name: OrjsonEncoder,
+    MsgpackEncoder.name: MsgpackEncoder,
+}
+
+# Media types accepted from clients for MessagePack, the first one is what we answer with
+MSGPACK_MEDIA_TYPES = (
+    "application/msgpack",
+    "application/x-msgpack",
+    "application/vnd.msgpack",
+)
+
+
+def get_encoder(name: str = "orjson") -> Encoder:
+    """Returns an instance of the encoder registered as `name`\n
+    Falls back to `simplejson` when `orjson` is not installed"""
+    if name == OrjsonEncoder.name and orjson is None:
+        name = SimpleJsonEncoder.name
+    if name == MsgpackEncoder.name and msgpack is None:
+        raise ImportError("`msgpack` is not installed")
+    return ENCODERS[name]()
+
+
+def negotiate_encoder(
+    accept: str, json_encoder: Encoder, msgpack_encoder: Encoder = None
+):
+    """Picks the encoder for an `Accept` header value\n
+    Returns `msgpack_encoder` only when the client ranks a MessagePack media type above JSON,
+    anything else (missing header, `*/*`, unknown types) gets `json_encoder`"""
+    if not accept or msgpack_encoder is None or "msgpack" not in accept:
+        return json_encoder
+
+    best_msgpack = 0.0
+    best_json = 0.0
+    for position, media_range in enumerate(accept.split(",")):
+        media_type, *params = media_range.strip().split(";")
+        media_type = media_type.strip().lower()
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        # Earlier entries win ties, like most clients expect
+        score = quality - position * 1e-6
+        if media_type in MSGPACK_MEDIA_TYPES:
+            best_msgpack = max(best_msgpack, score)
+        elif media_type in ("application/json", "application/*", "*/*"):
+            best_json = max(best_json, score)
+
+    return (
+        msgpack_encoder
+        if best_msgpack > 0 and best_msgpack >= best_json
+        else json_encoder
+    )
@@ -1,9 +1,26 @@
-import redis, time
+import redis, time, hashlib, itertools
 import simplejson as json
 from decimal import Decimal
 from fastapi.security import HTTPBearer
-from fastapi import Request
+from fastapi import Request, Response, status
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from datetime import datetime
+from encoders import (
+    Encoder,
+    get_encoder,
+    negotiate_encoder,
+    msgpack,
+    ordinal,
+    custom_date_format,
+    custom_time_format,
+    default_serializer,
+)
+from compression import compress, compress_stream, negotiate_encoding
+from sql import streamQuery, replicas, replica_config, read_from_primary
+from metrics import record_cache
+from tracing import span, tracing_config
+from deadline import DeadlineConnection, deadline_config
 
 
 token_auth_scheme = HTTPBearer()
@@ -21,13 +38,126 @@ with open("denied.json") as fd:
     denied = json.load(fd)
 
 
-# Initiate Redis connection
+# Initiate Redis connection, its calls end with the deadline of the request (`deadline.py`)
 redis_client = redis.Redis(
-    host=config["REDIS"]["HOST"],
-    port=config["REDIS"]["PORT"],
-    password=config["REDIS"]["PASSWORD"],
+    connection_pool=redis.ConnectionPool(
+        host=config["REDIS"]["HOST"],
+        port=config["REDIS"]["PORT"],
+        password=config["REDIS"]["PASSWORD"],
+        socket_timeout=config["REDIS"].get("SOCKET_TIMEOUT"),
+        connection_class=DeadlineConnection,
+    )
 )
 
+# Encoders used for responses and cached payloads
+json_encoder = get_encoder(config.get("ENCODER", "orjson"))
+msgpack_encoder = get_encoder("msgpack") if msgpack is not None else None
+
+# Response compression, bodies smaller than `MIN_SIZE` bytes are sent as they are
+# and bodies of `THREADPOOL_SIZE` bytes or more are compressed off the event loop
+compression_config = {
+    "ENABLED": 1,
+    "MIN_SIZE": 1024,
+    "THREADPOOL_SIZE": 65536,
+    "LEVELS": {},
+}
+compression_config.update(config.get("COMPRESSION", {}))
+
+# `STORAGE` is `"rows"` for one `Checkpoints` row per cp or `"packed"` for one `PackedCheckpoints` row per run
+checkpoint_config = {
+    "STORAGE": "rows",
+}
+checkpoint_config.update(config.get("CHECKPOINTS", {}))
+
+# Leaderboard pages, `limit` defaults to `PAGE_SIZE` and can't be more than `MAX_PAGE_SIZE`
+# `MAX_STAGE_TOP` limits the runs per stage and bonus of `/surftimer/stagerecords`
+# `MAX_SPLIT_RUNS` limits the runs compared in one `/surftimer/checkpointsplits` call
+# In-memory boards for ranks (`leaderboards.py`), `MAX_AROUND` limits the runs above and below a player
+# Boards catch up with saves from a log of the last `BOARD_LOG_SIZE` runs per map instead of reloading
+# `MAX_BUCKETS` limits the histogram buckets of `/surftimer/mapdistribution`
+leaderboard_config = {
+    "PAGE_SIZE": 50,
+    "MAX_PAGE_SIZE": 500,
+    "MAX_STAGE_TOP": 10,
+    "MAX_SPLIT_RUNS": 64,
+    "MAX_AROUND": 25,
+    "MAX_BOARDS": 64,
+    "BOARD_MAX_AGE": 30,
+    "BOARD_LOG_SIZE": 256,
+    "MAX_BUCKETS": 100,
+}
+leaderboard_config.update(config.get("LEADERBOARD", {}))
+
+# Tracing, `Server-Timing` headers and OTLP/JSON exports with per route sample rates
+tracing_config.update(config.get("TRACING", {}))
+
+# Points of a map run, multiplied by the map tier (`points.py`): `COMPLETION` for finishing, up to `POSITION`
+# depending on how many runs are slower and `TOP[rank - 1]` for the fastest runs
+# Touched maps are recomputed `BATCH_MAPS` at a time, each batch in its own transaction
+points_config = {
+    "COMPLETION": 10,
+    "POSITION": 100,
+    "TOP": [50, 40, 32, 26, 21, 17, 14, 12, 11, 10],
+    "BATCH_MAPS": 50,
+}
+points_config.update(config.get("POINTS", {}))
+
+# Coalesced `Player` connects and `Maps` updates (`write_buffer.py`), flushed every `INTERVAL` seconds
+# or once more than `MAX_PENDING` rows are pending, `MAX_ROWS` rows per statement. `INTERVAL` 0 writes right away
+write_buffer_config = {
+    "INTERVAL": 5,
+    "MAX_PENDING": 5000,
+    "MAX_ROWS": 500,
+}
+write_buffer_config.update(config.get("WRITE_BUFFER", {}))
+
+# Token bucket per client (`ratelimit.py`): `BURST` tokens refilled at `RATE` per second, a request takes
+# `COSTS[path]` tokens or 1. `KEY` is `"ip"` or `"identity"` for the `IDENTITY_HEADER` value, falling back to the IP
+# `SHARED` 1 keeps the buckets in Redis for all workers, otherwise every worker keeps `MAX_CLIENTS` buckets
+rate_limit_config = {
+    "ENABLED": 1,
+    "RATE": 50,
+    "BURST": 200,
+    "KEY": "ip",
+    "IDENTITY_HEADER": "X-Server-Id",
+    "SHARED": 0,
+    "MAX_CLIENTS": 10000,
+    "COSTS": {
+        "/surftimer/mapexport": 20,
+        "/surftimer/maptotals": 10,
+        "/surftimer/playermapdata": 5,
+        "/surftimer/checkpointsplits": 5,
+        "/surftimer/rebuildrecords": 50,
+        "/surftimer/rebuildsummaries": 50,
+        "/surftimer/recomputepoints": 20,
+    },
+}
+rate_limit_config.update(config.get("RATE_LIMIT", {}))
+
+# Admission control (`admission.py`), per route class: `LIMITS` concurrent requests, `QUEUES` more waiting at most
+# `TIMEOUTS` seconds, the rest gets `503` with `Retry-After: RETRY_AFTER`. `ROUTES` maps paths to a class,
+# other `/surftimer/` paths are `read` for `GET` and `write` otherwise. `runs` keeps its own budget for the saves
+admission_config = {
+    "ENABLED": 1,
+    "LIMITS": {"runs": 16, "write": 8, "read": 32, "admin": 1},
+    "QUEUES": {"runs": 256, "write": 32, "read": 64, "admin": 0},
+    "TIMEOUTS": {"runs": 10, "write": 2, "read": 1, "admin": 0},
+    "RETRY_AFTER": 1,
+    "ROUTES": {
+        "/surftimer/savemaptime": "runs",
+        "/surftimer/savestagetime": "runs",
+        "/surftimer/savebonustime": "runs",
+        "/surftimer/rebuildrecords": "admin",
+        "/surftimer/rebuildsummaries": "admin",
+        "/surftimer/recomputepoints": "admin",
+    },
+}
+admission_config.update(config.get("ADMISSION", {}))
+
+# Deadlines of `GET` requests (`deadline.py`): `ROUTES[path]` or `DEFAULT` seconds, shortened by the milliseconds
+# the client sends in `HEADER`, at most `MAX`. 0 is no deadline. Queries get the time left as `MAX_EXECUTION_TIME`
+deadline_config.update(config.get("DEADLINES", {}))
+
 tags_metadata = [
     {
         "name": "Map",
@@ -103,36 +233,60 @@ def append_denied_log(request: Request):
         json.dump(denied, json_file, indent=4, separators=(",", ": "))
 
 
-def set_cache(cache_key: str, data):
-    """Cache the data in Redis\n
-    `Decimal` values are converted to `String`\n
-    ### Still returns `True` if Redis functionality is disabled"""
+def response_encoder(request: Request) -> Encoder:
+    """Returns the encoder the client asked for with the `Accept` header\n
+    `application/msgpack` gets MessagePack, everything else gets JSON"""
+    return negotiate_encoder(
+        request.headers.get("accept"), json_encoder, msgpack_encoder
+    )
+
+
+def response_coding(request: Request) -> str:
+    """Returns the content coding the client accepts with `Accept-Encoding` or `None`"""
+    if compression_config["ENABLED"] == 0:
+        return None
+
+    return negotiate_encoding(request.headers.get("accept-encoding"))
+
+
+def format_cache_key(cache_key: str, encoder: Encoder, coding: str = None) -> str:
+    """Each representation is cached under its own key, `selectMapInfo:surf_beginner` becomes
+    `selectMapInfo:surf_beginner@json`, `selectMapInfo:surf_beginner@msgpack` or
+    `selectMapInfo:surf_beginner@json.gzip` for the compressed variants"""
+    if coding is None:
+        return f"{cache_key}@{encoder.format}"
+    return f"{cache_key}@{encoder.format}.{coding}"
+
+
+def set_cache(cache_key: str, data, encoder: Encoder = json_encoder):
+    """Encode the data with `encoder` and cache it in Redis\n
+    `Decimal` values are written as numbers, `datetime` values with `custom_date_format`\n
+    Returns the encoded `bytes` so they can be sent as the response body\n
+    ### Still returns the encoded data if Redis functionality is disabled"""
+    with span("encode", encoder.name):
+        encoded = encoder.dumps(data)
     if config["REDIS"]["ENABLED"] == 0:
-        return True
+        return encoded
 
-    redis_client.set(
-        cache_key,
-        json.dumps(
-            data,
-            use_decimal=True,
-            encoding="utf-8",
-            ensure_ascii=False,
-            default=default_serializer,
-            allow_nan=True,
-        ),
-        ex=config["REDIS"]["EXPIRY"],
-    )
+    with span("cache", "set"):
+        redis_client.set(
+            format_cache_key(cache_key, encoder),
+            encoded,
+            ex=config["REDIS"]["EXPIRY"],
+        )
 
-    return True
+    return encoded
 
 
-def get_cache(cache_key: str):
-    """Try and get cached data from Redis\n
+def get_cache(cache_key: str, encoder: Encoder = json_encoder):
+    """Try and get cached data in the `encoder` format from Redis\n
     ### Still returns `None` if Redis functionality is disabled"""
     if config["REDIS"]["ENABLED"] == 0:
         return None
 
-    cached_data = redis_client.get(cache_key)
+    with span("cache", "get"):
+        cached_data = redis_client.get(format_cache_key(cache_key, encoder))
+    record_cache(cache_key, bool(cached_data))
     if cached_data:
         # Return cached data
         return cached_data
@@ -140,41 +294,318 @@ def get_cache(cache_key: str):
         return None
 
 
-def ordinal(n):
-    suffix = ["th", "st", "nd", "rd", "th"][min(n % 10, 4)]
-    if 11 <= (n % 100) <= 13:
-        suffix = "th"
-    return str(n) + suffix
+async def compress_body(body: bytes, coding: str) -> bytes:
+    """Compresses the body, big bodies are compressed in the threadpool so we don't block the event loop"""
+    with span("compress", coding):
+        if len(body) >= compression_config["THREADPOOL_SIZE"]:
+            return await run_in_threadpool(
+                compress, body, coding, compression_config["LEVELS"]
+            )
+        return compress(body, coding, compression_config["LEVELS"])
+
+
+def get_versions(*scopes: str) -> list:
+    """Returns the current version stamp of every scope, e.g. `"maptimes:12"`\n
+    Missing stamps start at the current `time.time_ns()` so a flushed Redis never reuses an old stamp\n
+    The reads of a scope bumped in the last `PIN_SECONDS` go to the primary, a lagging replica would cache the
+    old rows under the new stamp\n
+    ### Returns `[]` if Redis functionality is disabled"""
+    if config["REDIS"]["ENABLED"] == 0 or not scopes:
+        return []
+
+    keys = [f"version:{scope}" for scope in scopes]
+    with span("cache", "versions"):
+        if replicas:
+            values = redis_client.mget(keys + [f"bumped:{scope}" for scope in scopes])
+            versions = values[: len(keys)]
+            if any(values[len(keys) :]):
+                read_from_primary()
+        else:
+            versions = redis_client.mget(keys)
+        if None in versions:
+            pipe = redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipe.set(key, time.time_ns(), nx=True)
+            pipe.mget(keys)
+            versions = pipe.execute()[-1]
+
+    return [int(version) for version in versions]
+
+
+def _mark_bumped(pipe, scope: str):
+    """Sends the reads of `scope` to the primary for `PIN_SECONDS`, see `get_versions`"""
+    if replicas:
+        pipe.set(f"bumped:{scope}", 1, px=int(replica_config["PIN_SECONDS"] * 1000))
+
+
+def bump_versions(*scopes: str):
+    """Bumps the version stamp of every scope after a write, this changes the `ETag`
+    and the cache key of every endpoint that depends on one of them\n
+    ### Does nothing if Redis functionality is disabled"""
+    if config["REDIS"]["ENABLED"] == 0 or not scopes:
+        return
+
+    with span("cache", "bump"):
+        pipe = redis_client.pipeline(transaction=False)
+        for scope in scopes:
+            pipe.set(f"version:{scope}", time.time_ns(), nx=True)
+            pipe.incr(f"version:{scope}")
+            _mark_bumped(pipe, scope)
+        pipe.execute()
+
+
+def bump_logged_version(scope: str, entry: str, size: int):
+    """Bumps the version stamp of `scope` like `bump_versions` and appends `entry` to the scope's change log
+    in the same transaction, so readers that are only behind by logged bumps can catch up from the log\n
+    The log keeps the last `size` entries\n
+    ### Does nothing if Redis functionality is disabled"""
+    if config["REDIS"]["ENABLED"] == 0:
+        return
+
+    with span("cache", "bump"):
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.set(f"version:{scope}", time.time_ns(), nx=True)
+        pipe.incr(f"version:{scope}")
+        pipe.incr(f"changes:{scope}")
+        pipe.rpush(f"changelog:{scope}", entry)
+        pipe.ltrim(f"changelog:{scope}", -size, -1)
+        _mark_bumped(pipe, scope)
+        pipe.execute()
+
+
+def get_version_log(scope: str):
+    """Returns the version stamp of `scope`, the number of logged bumps and the entries still in the log,
+    read in one transaction\n
+    ### Returns `None` if Redis functionality is disabled"""
+    if config["REDIS"]["ENABLED"] == 0:
+        return None
 
+    with span("cache", "versions"):
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.set(f"version:{scope}", time.time_ns(), nx=True)
+        pipe.get(f"version:{scope}")
+        pipe.get(f"changes:{scope}")
+        pipe.lrange(f"changelog:{scope}", 0, -1)
+        _, version, logged, entries = pipe.execute()
+
+    return int(version), int(logged or 0), [entry.decode() for entry in entries]
+
+
+# Pinned players by `player_id` when Redis is disabled, the deadline is a `time.monotonic()` value
+_pinned_players = {}
+
+
+def pin_player(player_id: int):
+    """Pins the reads of the player to the primary for `PIN_SECONDS` after a save, so the replicas can catch up\n
+    ### Does nothing without read replicas"""
+    if not replicas:
+        return
+    if config["REDIS"]["ENABLED"] == 1:
+        with span("cache", "pin"):
+            redis_client.set(
+                f"pinned:player:{player_id}",
+                1,
+                px=int(replica_config["PIN_SECONDS"] * 1000),
+            )
+    else:
+        _pinned_players[player_id] = time.monotonic() + replica_config["PIN_SECONDS"]
 
-def custom_date_format(dt):
-    day = ordinal(dt.day)
-    month = dt.strftime("%B")
-    year = dt.year
-    time = dt.strftime("%H:%M:%S")
-    return f"{day} of {month} {year}, {time}"
 
+def read_own_writes(player_id: int):
+    """Sends the reads of the current request to the primary while the player is pinned by `pin_player`"""
+    if not replicas:
+        return
+    if config["REDIS"]["ENABLED"] == 1:
+        with span("cache", "pin"):
+            pinned = redis_client.exists(f"pinned:player:{player_id}")
+    else:
+        pinned = _pinned_players.get(player_id, 0) > time.monotonic()
+        if not pinned:
+            _pinned_players.pop(player_id, None)
+    if pinned:
+        read_from_primary()
+
+
+def versioned_cache_key(cache_key: str, *scopes: str) -> str:
+    """Appends the version stamps of `scopes` to the cache key\n
+    `selectMapRunsData:12` becomes `selectMapRunsData:12#1718000000000000001` so entries cached
+    before a write are never read again and the `ETag` can be derived from the key alone
+    """
+    versions = get_versions(*scopes)
+    if not versions:
+        return cache_key
+    return f"{cache_key}#{'.'.join(str(version) for version in versions)}"
+
+
+def make_etag(value: bytes) -> str:
+    """Strong `ETag` for the given bytes"""
+    return f'"{hashlib.blake2b(value, digest_size=16).hexdigest()}"'
+
+
+def representation_etag(cache_key: str, encoder: Encoder, coding: str) -> str:
+    """`ETag` of a versioned cache entry, one per format and negotiated content coding\n
+    Computed from the key alone so conditional requests are answered without Redis or MySQL data
+    """
+    return make_etag(format_cache_key(cache_key, encoder, coding).encode("utf-8"))
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Checks the `If-None-Match` request header against `etag`"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        candidate.strip().removeprefix("W/") == etag
+        for candidate in if_none_match.split(",")
+    )
 
-def custom_time_format(time_value):
-    # Convert to Decimal for precise arithmetic
-    time_value = Decimal(time_value)
 
-    # Calculate minutes and remaining seconds
-    minutes = int(time_value // 60)
-    seconds = time_value % 60
+def not_modified(response: Response, etag: str):
+    """Empty `304 Not Modified` response for a matching `If-None-Match`"""
+    response.headers["etag"] = etag
+    response.headers["vary"] = "Accept, Accept-Encoding"
+    response.status_code = status.HTTP_304_NOT_MODIFIED
+    response.body = b""
+    return response
+
+
+async def send_response(
+    request: Request,
+    response: Response,
+    body: bytes,
+    encoder: Encoder,
+    cache_key: str = None,
+    status_code: int = status.HTTP_200_OK,
+    ttl: int = None,
+):
+    """Sends the encoded `body`, compressed if the client accepts it and it is at least `MIN_SIZE` bytes\n
+    When `cache_key` is given the response gets an `ETag`, a matching `If-None-Match` gets `304 Not Modified`
+    and the compressed bytes are cached next to the plain entry from `set_cache`,
+    so hot responses are compressed once and not on every request\n
+    `ttl` is the expiry of the compressed entry in milliseconds, defaults to `EXPIRY`\n
+    Returning the `Response` skips FastAPI's `response_model` validation, the rows from MySQL are trusted
+    and the model is only used for the OpenAPI schema"""
+    coding = response_coding(request)
+
+    if cache_key is not None:
+        if config["REDIS"]["ENABLED"] == 1:
+            etag = representation_etag(cache_key, encoder, coding)
+        else:
+            # Without Redis there are no version stamps shared between workers, hash the content instead
+            etag = make_etag(body + f"@{encoder.format}.{coding}".encode("utf-8"))
+        if etag_matches(request, etag):
+            return not_modified(response, etag)
+        response.headers["etag"] = etag
+
+    response.headers["content-type"] = encoder.media_type
+    response.headers["vary"] = "Accept, Accept-Encoding"
+
+    if coding is not None and len(body) >= compression_config["MIN_SIZE"]:
+        body = await compress_body(body, coding)
+        response.headers["content-encoding"] = coding
+
+        if cache_key is not None and config["REDIS"]["ENABLED"] == 1:
+            with span("cache", "set"):
+                redis_client.set(
+                    format_cache_key(cache_key, encoder, coding),
+                    body,
+                    px=ttl if ttl else config["REDIS"]["EXPIRY"] * 1000,
+                )
+
+    response.status_code = status_code
+    response.body = body
+    return response
+
+
+async def load_cached_response(
+    request: Request, response: Response, cache_key: str, encoder: Encoder
+):
+    """Try and send the cached `encoder` representation from Redis, compressed if the client accepts it\n
+    A matching `If-None-Match` is answered with `304 Not Modified` before anything is read from Redis.
+    The compressed variant and the plain entry are fetched in a single round trip, a plain entry without
+    a compressed variant is compressed and cached with the remaining expiry of the plain entry\n
+    ### Still returns `None` if Redis functionality is disabled"""
+    if config["REDIS"]["ENABLED"] == 0:
+        return None
 
-    # Format the time
-    formatted_time = f"{minutes}:{seconds:06.4f}" if minutes > 0 else f"{seconds:.4f}"
+    coding = response_coding(request)
+    etag = representation_etag(cache_key, encoder, coding)
+    if etag_matches(request, etag):
+        record_cache(cache_key, True)
+        return not_modified(response, etag)
+
+    if coding is None:
+        cached_data = get_cache(cache_key, encoder)
+        if cached_data is None:
+            return None
+        return await send_response(request, response, cached_data, encoder, cache_key)
+
+    with span("cache", "get"):
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(format_cache_key(cache_key, encoder, coding))
+        pipe.get(format_cache_key(cache_key, encoder))
+        pipe.pttl(format_cache_key(cache_key, encoder))
+        compressed_data, cached_data, ttl = pipe.execute()
+    record_cache(cache_key, bool(compressed_data or cached_data))
+
+    if compressed_data:
+        response.headers["etag"] = etag
+        response.headers["content-type"] = encoder.media_type
+        response.headers["vary"] = "Accept, Accept-Encoding"
+        response.headers["content-encoding"] = coding
+        response.status_code = status.HTTP_200_OK
+        response.body = compressed_data
+        return response
+
+    if not cached_data:
+        return None
 
-    return formatted_time
+    return await send_response(
+        request,
+        response,
+        cached_data,
+        encoder,
+        cache_key=cache_key,
+        ttl=ttl if ttl > 0 else None,
+    )
 
 
-def default_serializer(obj):
-    if isinstance(obj, datetime):
-        return custom_date_format(obj)
-    elif isinstance(obj, Decimal):
-        return custom_time_format(obj)
-    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+async def send_stream(
+    request: Request,
+    response: Response,
+    query: str,
+    encoder: Encoder,
+    cache_key: str = None,
+):
+    """Streams the rows of `query` with `encoder.stream`, compressed chunk by chunk if the client accepts it,
+    so the rows are never all in memory at once\n
+    Streams are not cached. With `cache_key` and Redis enabled they still get an `ETag` from the version stamps
+    and a matching `If-None-Match` gets `304 Not Modified` without running the query\n
+    Sends `204 No Content` if the query has no rows"""
+    coding = response_coding(request)
+    headers = {"vary": "Accept, Accept-Encoding"}
+
+    if cache_key is not None and config["REDIS"]["ENABLED"] == 1:
+        etag = representation_etag(cache_key, encoder, coding)
+        if etag_matches(request, etag):
+            return not_modified(response, etag)
+        headers["etag"] = etag
+
+    batches = streamQuery(query)
+    first_batch = next(batches, None)
+    if first_batch is None:
+        response.headers["content-type"] = "application/json"
+        response.status_code = status.HTTP_204_NO_CONTENT
+        return response
+
+    body = encoder.stream(itertools.chain([first_batch], batches))
+    if coding is not None:
+        body = compress_stream(body, coding, compression_config["LEVELS"])
+        headers["content-encoding"] = coding
+
+    return StreamingResponse(body, media_type=encoder.media_type, headers=headers)
 
 
 def json_decimal(obj):
@@ -0,0 +1,198 @@
+"""In-memory sorted leaderboards for rank lookups that don't depend on the leaderboard size
+
+A `Board` holds the `run_time` and `id` of every run of one map/style/type/stage leaderboard in sorted arrays,
+read from `idx_maptimes_leaderboard` without touching the table rows. A rank is a `bisect` and the runs around
+a player are a slice of the arrays, only the runs in the slice are read from MySQL. A saved run is found and placed
+with `bisect` on `(run_time, id)`, moving it shifts the slower runs in the flat arrays: a `memmove` of 16 bytes per
+run, kept over a tree so ranks stay a `bisect` and `distribution` can view the times without copying them.
+
+The save endpoints call `record_run`, which bumps the `maptimes:{map_id}` version stamp and logs the run. A board
+that is only behind by logged runs applies them in place, it is reloaded when the map's version changed for
+another reason or more than `BOARD_LOG_SIZE` runs ago. A loaded board applies the runs still in the log, so a
+board read from a replica that is behind has the runs saved on the primary. Without Redis the saving worker
+updates its own boards and the others reload after `BOARD_MAX_AGE` seconds. At most `MAX_BOARDS` boards are kept
+per worker, the least recently used one is dropped first.
+"""
+
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+import numpy as np
+
+import surftimer.queries
+from globals import (
+    bump_logged_version,
+    get_version_log,
+    get_versions,
+    leaderboard_config,
+)
+from sql import selectQuery
+
+
+class Board:
+    """Sorted `(run_time, id)` of a leaderboard, ties on `run_time` are ordered by `id`"""
+
+    __slots__ = ("version", "logged", "loaded_at", "times", "ids", "run_times")
+
+    def __init__(self, rows: list, version, logged: int = 0):
+        self.version = version
+        self.logged = logged
+        self.loaded_at = time.monotonic()
+        self.times = array("q", (row["run_time"] for row in rows))
+        self.ids = array("q", (row["id"] for row in rows))
+        # `run_time` by `id`, where `apply` finds the run it moves
+        self.run_times = {row["id"]: row["run_time"] for row in rows}
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def rank(self, run_time: int) -> int:
+        """Runs as fast or faster, the same rank `sql_getRunByPlayer` and friends return"""
+        return bisect_right(self.times, run_time)
+
+    def position(self, run_time: int, maptime_id: int) -> int:
+        """Index of the first run after `(run_time, maptime_id)` or the run itself"""
+        start = bisect_left(self.times, run_time)
+        end = bisect_right(self.times, run_time, lo=start)
+        return bisect_left(self.ids, maptime_id, start, end)
+
+    def index(self, run_time: int, maptime_id: int):
+        """Index of the run on the board or `None`"""
+        index = self.position(run_time, maptime_id)
+        if index < len(self.ids) and self.ids[index] == maptime_id:
+            return index
+        return None
+
+    def around(self, index: int, count: int):
+        """`(first index, ids)` of the runs `count` places above and below `index`"""
+        start = max(0, index - count)
+        return start, self.ids[start : index + count + 1].tolist()
+
+    def apply(self, maptime_id: int, run_time: int):
+        """Adds the run or moves it to its new time, applying the same run twice leaves the board as it is"""
+        old = self.run_times.get(maptime_id)
+        if old is not None:
+            index = self.position(old, maptime_id)
+            del self.times[index]
+            del self.ids[index]
+
+        index = self.position(run_time, maptime_id)
+        self.times.insert(index, run_time)
+        self.ids.insert(index, maptime_id)
+        self.run_times[maptime_id] = run_time
+
+    def distribution(self, quantiles: list, buckets: int, upper: float) -> dict:
+        """Run times at `quantiles` and a histogram of `buckets` equal buckets from the fastest run to the run
+        time at quantile `upper`, slower runs are counted in `overflow`"""
+        # A view of the array, it blocks resizing the array so it must not outlive this call
+        times = np.frombuffer(self.times, dtype=np.int64)
+        total = len(times)
+
+        # `inverted_cdf`: the fastest run time that at least `q` of the runs are as slow as
+        positions = np.ceil(np.asarray(quantiles, dtype=np.float64) * total)
+        quantile_times = times[np.clip(positions.astype(np.int64) - 1, 0, total - 1)]
+
+        lowest = int(times[0])
+        highest = int(times[max(int(np.ceil(upper * total)) - 1, 0)])
+        edges = np.unique(
+            np.linspace(lowest, highest + 1, buckets + 1).astype(np.int64)
+        )
+        counts = np.diff(np.searchsorted(times, edges, side="left"))
+
+        distribution = {
+            "total": total,
+            "quantiles": [
+                {"quantile": quantile, "run_time": run_time}
+                for quantile, run_time in zip(quantiles, quantile_times.tolist())
+            ],
+            "histogram": [
+                {"start": start, "end": end, "count": count}
+                for start, end, count in zip(
+                    edges[:-1].tolist(), edges[1:].tolist(), counts.tolist()
+                )
+            ],
+            "overflow": total - int(np.searchsorted(times, edges[-1], side="left")),
+        }
+        del times
+        return distribution
+
+
+_boards = OrderedDict()
+
+
+def _catch_up(board: Board, key: tuple, log) -> bool:
+    """Applies the runs logged since the board was loaded, `False` if it has to be reloaded"""
+    version, logged, entries = log
+    behind = logged - board.logged
+    if version - board.version != behind or behind > len(entries):
+        return False
+
+    _apply_entries(board, key, entries[len(entries) - behind :])
+    board.version, board.logged = version, logged
+    return True
+
+
+def _apply_entries(board: Board, key: tuple, entries: list):
+    """Applies the logged runs of the board's style, type and stage in log order"""
+    _, style, type, stage = key
+    for entry in entries:
+        entry_style, entry_type, entry_stage, maptime_id, run_time = map(
+            int, entry.split(":")
+        )
+        if (entry_style, entry_type, entry_stage) == (style, type, stage):
+            board.apply(maptime_id, run_time)
+
+
+def get_board(map_id: int, style: int, type: int, stage: int) -> Board:
+    """Returns the board, catching up with the runs saved since it was loaded or reloading it"""
+    key = (map_id, style, type, stage)
+    scope = f"maptimes:{map_id}"
+    versions = get_versions(scope)
+
+    board = _boards.get(key)
+    if board is not None:
+        if versions:
+            fresh = board.version == versions[0] or _catch_up(
+                board, key, get_version_log(scope)
+            )
+        else:
+            fresh = (
+                time.monotonic() - board.loaded_at
+                <= leaderboard_config["BOARD_MAX_AGE"]
+            )
+        if fresh:
+            _boards.move_to_end(key)
+            return board
+
+    # The version and log position are read before the rows, runs saved in between are applied again later
+    log = get_version_log(scope) if versions else None
+    board = Board(
+        selectQuery(
+            surftimer.queries.sql_getLeaderboardKeys.format(map_id, style, type, stage)
+        ),
+        *(log[:2] if log is not None else (None, 0)),
+    )
+    if log is not None:
+        # A replica can be behind the log, applying the logged runs again is a no-op for the ones it has
+        _apply_entries(board, key, log[2])
+    _boards[key] = board
+    _boards.move_to_end(key)
+    while len(_boards) > leaderboard_config["MAX_BOARDS"]:
+        _boards.popitem(last=False)
+    return board
+
+
+def record_run(
+    map_id: int, style: int, type: int, stage: int, maptime_id: int, run_time: int
+):
+    """Bumps `maptimes:{map_id}` after a new or improved run and logs it for the boards of the map"""
+    bump_logged_version(
+        f"maptimes:{map_id}",
+        f"{style}:{type}:{stage}:{maptime_id}:{run_time}",
+        leaderboard_config["BOARD_LOG_SIZE"],
+    )
+    board = _boards.get((map_id, style, type, stage))
+    if board is not None and board.version is None:
+        board.apply(maptime_id, run_time)
@@ -1,11 +1,18 @@
 # IMPORTS
+from contextlib import asynccontextmanager
 from datetime import datetime
+import asyncio
 import time
 from fastapi import FastAPI, Request, status, Depends, Response
 from fastapi.responses import JSONResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.middleware import Middleware
 from auth import VerifyToken
+from admission import AdmissionMiddleware
+from deadline import DeadlineMiddleware
+from metrics import MetricsMiddleware, metrics_response
+from ratelimit import RateLimitMiddleware
+from tracing import TracingMiddleware
 from threading import Thread  # Not used yet
 
 # Templates
@@ -22,6 +29,9 @@ from globals import (
 )
 
 
+import write_buffer
+
+
 # Import all the endpoints for each table
 from surftimer.Map import router as Map
 from surftimer.PlayerStats import router as PlayerStats
@@ -64,14 +74,38 @@ swagger_config = {
     "pluginLoadType": "chain",
     "tagsSorter": "alpha",
 }
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Flushes the coalesced writes of `write_buffer.py` on an interval and once more on shutdown"""
+    flusher = (
+        asyncio.create_task(write_buffer.flush_periodically())
+        if write_buffer.enabled()
+        else None
+    )
+    yield
+    if flusher is not None:
+        flusher.cancel()
+    write_buffer.flush()
+
+
 app = FastAPI(
     title="CS2 SurfTimer API",
     description="""by [`tslashd`](https://github.com/tslashd)""",
     version="0.0.0",
     debug=True,
     swagger_ui_parameters=swagger_config,
-    middleware=[Middleware(IPValidatorMiddleware)],
+    middleware=[
+        Middleware(MetricsMiddleware),
+        Middleware(TracingMiddleware),
+        Middleware(IPValidatorMiddleware),
+        Middleware(RateLimitMiddleware),
+        Middleware(DeadlineMiddleware),
+        Middleware(AdmissionMiddleware),
+    ],
     openapi_tags=tags_metadata,
+    lifespan=lifespan,
 )
 
 
@@ -120,6 +154,16 @@ def ping(client_unix: float):
     )
 
 
+@app.get(
+    "/metrics",
+    name="Metrics",
+    tags=["Utilities"],
+    summary="Prometheus metrics: route latency, status codes, query times, cache hit ratios and pool usage",
+)
+async def metrics():
+    return metrics_response()
+
+
 # This is an example of a endpoint locked behind an AUTH token 👇
 @app.get(
     "/api/private",
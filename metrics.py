@@ -0,0 +1,165 @@
+"""Prometheus instrumentation shared by the middleware, `sql.py` and the cache helpers
+
+Scrape `/metrics`. When running several workers set `PROMETHEUS_MULTIPROC_DIR` so the
+samples of every worker are aggregated.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+import anyio.to_thread
+from fastapi import Request, Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.middleware.base import BaseHTTPMiddleware
+
+
+REQUEST_LATENCY = Histogram(
+    "surftimer_request_duration_seconds",
+    "Time spent handling a request, per route",
+    ["method", "route"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+REQUEST_COUNT = Counter(
+    "surftimer_requests_total",
+    "Requests handled, per route and status code",
+    ["method", "route", "status"],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "surftimer_requests_in_progress",
+    "Requests currently being handled",
+    multiprocess_mode="livesum",
+)
+DB_QUERY_LATENCY = Histogram(
+    "surftimer_db_query_duration_seconds",
+    "Time spent executing a query, per named query from `surftimer/queries.py`",
+    ["query"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+DB_CONNECTIONS_IN_USE = Gauge(
+    "surftimer_db_connections_in_use",
+    "MySQL connections currently open",
+    multiprocess_mode="livesum",
+)
+CACHE_REQUESTS = Counter(
+    "surftimer_cache_requests_total",
+    "Redis cache lookups per cache key prefix, `result` is `hit` or `miss`",
+    ["prefix", "result"],
+)
+THREADPOOL_IN_USE = Gauge(
+    "surftimer_threadpool_in_use",
+    "Worker threads borrowed from the threadpool (sync endpoints, compression)",
+    multiprocess_mode="livesum",
+)
+ADMISSION_QUEUED = Gauge(
+    "surftimer_admission_queued",
+    "Requests waiting for a slot of their route class",
+    ["route_class"],
+    multiprocess_mode="livesum",
+)
+ADMISSION_SHED = Counter(
+    "surftimer_admission_shed_total",
+    "Requests answered with `503` because their route class was at its limit and its line was full",
+    ["route_class"],
+)
+RATE_LIMITED = Counter(
+    "surftimer_rate_limited_total",
+    "Requests answered with `429` because the client's token bucket was empty",
+)
+RATE_LIMIT_FALLBACKS = Counter(
+    "surftimer_rate_limit_fallbacks_total",
+    "Requests limited by the bucket of their worker because the shared bucket in Redis failed",
+)
+REQUESTS_ABANDONED = Counter(
+    "surftimer_requests_abandoned_total",
+    "Reads cancelled because their deadline passed or the client disconnected, `reason` is `deadline` or `disconnect`",
+    ["reason"],
+)
+WRITE_BUFFER_FLUSH_FAILURES = Counter(
+    "surftimer_write_buffer_flush_failures_total",
+    "Flushes of `write_buffer.py` that failed, their rows are kept for the next flush",
+)
+WRITE_BUFFER_ROWS_DROPPED = Counter(
+    "surftimer_write_buffer_rows_dropped_total",
+    "Pending rows of `write_buffer.py` MySQL rejected when written on their own, they are not retried",
+)
+THREADPOOL_SIZE = Gauge(
+    "surftimer_threadpool_size",
+    "Worker threads available in the threadpool",
+    multiprocess_mode="liveall",
+)
+
+
+def cache_prefix(cache_key: str) -> str:
+    """`selectMapRunsData:12#1718000000000000001` becomes `selectMapRunsData`"""
+    return cache_key.split(":", 1)[0]
+
+
+def record_cache(cache_key: str, hit: bool):
+    CACHE_REQUESTS.labels(cache_prefix(cache_key), "hit" if hit else "miss").inc()
+
+
+@contextmanager
+def db_connection():
+    """Counts the MySQL connection as in use for the duration of the block"""
+    DB_CONNECTIONS_IN_USE.inc()
+    try:
+        yield
+    finally:
+        DB_CONNECTIONS_IN_USE.dec()
+
+
+@contextmanager
+def db_query(query):
+    """Times a query, the label is the name it has in `surftimer/queries.py`"""
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        DB_QUERY_LATENCY.labels(getattr(query, "name", "unnamed")).observe(
+            time.perf_counter() - tic
+        )
+
+
+class MetricsMiddleware(BaseHTTPMiddleware):
+    """Records latency, status codes and in-flight requests for every route"""
+
+    async def dispatch(self, request: Request, call_next):
+        REQUESTS_IN_PROGRESS.inc()
+        tic = time.perf_counter()
+        status_code = 500
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+            return response
+        finally:
+            # Use the route template so `/surftimer/playersurfprofile/{steamid}` is a single series
+            route = request.scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            REQUEST_LATENCY.labels(request.method, route).observe(
+                time.perf_counter() - tic
+            )
+            REQUEST_COUNT.labels(request.method, route, status_code).inc()
+            REQUESTS_IN_PROGRESS.dec()
+
+
+def metrics_response() -> Response:
+    """Exposition of every metric in the Prometheus text format"""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    THREADPOOL_IN_USE.set(limiter.borrowed_tokens)
+    THREADPOOL_SIZE.set(limiter.total_tokens)
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
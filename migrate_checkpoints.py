@@ -0,0 +1,157 @@
+"""Copies the checkpoints of every run from `Checkpoints` into `PackedCheckpoints`, or back with `--unpack`
+
+Set `"CHECKPOINTS": {"STORAGE": "packed"}` and restart the API first: new runs are then written packed and
+runs that were not copied yet are still read from `Checkpoints`. A save deletes the run's checkpoints from the
+storage it doesn't write, so a run found in the source table was saved there last: its copy replaces whatever the
+target table still has for the run. To go back, set `"rows"` and run with `--unpack`.
+```
+    python migrate_checkpoints.py [--unpack] [--delete] [--batch 1000]
+```
+Runs are copied in batches of `--batch` runs, each in its own transaction, so the script can be stopped and
+run again. `--delete` removes the copied runs from the source table in the same transaction. The copied rows are
+read with `FOR UPDATE`: a save that commits first already deleted them from the source, a save that comes later
+waits for the batch and replaces the copy.
+"""
+
+import argparse
+
+import mysql.connector
+import simplejson as json
+
+from checkpoints import pack, unpack_rows
+
+
+sql_getRowRuns = """SELECT DISTINCT `maptime_id` FROM `Checkpoints`
+                    WHERE `maptime_id` > %s ORDER BY `maptime_id` LIMIT %s"""
+# The copied rows are locked, a save of one of the runs waits for the batch and its checkpoints replace the copy
+sql_getRows = """SELECT * FROM `Checkpoints` WHERE `maptime_id` BETWEEN %s AND %s ORDER BY `maptime_id`, `cp`
+                    FOR UPDATE"""
+sql_deletePackedRun = """DELETE FROM `PackedCheckpoints` WHERE `maptime_id` = %s"""
+sql_insertPacked = """INSERT INTO `PackedCheckpoints` (`maptime_id`, `cp_count`, `data`) VALUES (%s, %s, %s)"""
+sql_deleteRows = """DELETE FROM `Checkpoints` WHERE `maptime_id` BETWEEN %s AND %s"""
+
+sql_getPackedRuns = """SELECT `maptime_id`, `data` FROM `PackedCheckpoints`
+                    WHERE `maptime_id` > %s ORDER BY `maptime_id` LIMIT %s FOR UPDATE"""
+sql_deleteRowsRun = """DELETE FROM `Checkpoints` WHERE `maptime_id` = %s"""
+sql_insertRows = """INSERT INTO `Checkpoints` (`maptime_id`, `cp`, `run_time`, `start_vel_x`, `start_vel_y`, `start_vel_z`,
+                    `end_vel_x`, `end_vel_y`, `end_vel_z`, `attempts`, `end_touch`)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+sql_deletePacked = (
+    """DELETE FROM `PackedCheckpoints` WHERE `maptime_id` BETWEEN %s AND %s"""
+)
+
+
+def pack_batch(mycursor, last_id: int, batch: int, delete: bool):
+    """Packs the next `batch` runs after `last_id`, returns the last `maptime_id` or `None` when done"""
+    mycursor.execute(sql_getRowRuns, (last_id, batch))
+    maptime_ids = [row["maptime_id"] for row in mycursor.fetchall()]
+    if not maptime_ids:
+        return None
+
+    first, last = maptime_ids[0], maptime_ids[-1]
+    mycursor.execute(sql_getRows, (first, last))
+    runs = {}
+    for row in mycursor.fetchall():
+        runs.setdefault(row["maptime_id"], []).append(row)
+
+    mycursor.executemany(sql_deletePackedRun, [(maptime_id,) for maptime_id in runs])
+    mycursor.executemany(
+        sql_insertPacked,
+        [
+            (maptime_id, len(checkpoints), pack(checkpoints))
+            for maptime_id, checkpoints in runs.items()
+        ],
+    )
+    if delete:
+        mycursor.execute(sql_deleteRows, (first, last))
+    return last
+
+
+def unpack_batch(mycursor, last_id: int, batch: int, delete: bool):
+    """Writes the next `batch` packed runs after `last_id` back as rows, returns the last `maptime_id` or `None`"""
+    mycursor.execute(sql_getPackedRuns, (last_id, batch))
+    packed = mycursor.fetchall()
+    if not packed:
+        return None
+
+    rows = []
+    for run in packed:
+        for row in unpack_rows(run["maptime_id"], bytes(run["data"])):
+            rows.append(
+                (
+                    row["maptime_id"],
+                    row["cp"],
+                    row["run_time"],
+                    row["start_vel_x"],
+                    row["start_vel_y"],
+                    row["start_vel_z"],
+                    row["end_vel_x"],
+                    row["end_vel_y"],
+                    row["end_vel_z"],
+                    row["attempts"],
+                    row["end_touch"],
+                )
+            )
+    # Rows of a run left over from before it was packed, a row per `cp` the packed run doesn't have would stay
+    mycursor.executemany(sql_deleteRowsRun, [(run["maptime_id"],) for run in packed])
+    if rows:
+        mycursor.executemany(sql_insertRows, rows)
+
+    first, last = packed[0]["maptime_id"], packed[-1]["maptime_id"]
+    if delete:
+        mycursor.execute(sql_deletePacked, (first, last))
+    return last
+
+
+def migrate(mydb, unpack: bool = False, delete: bool = False, batch: int = 1000):
+    """Copies every run in batches, returns the number of batches"""
+    step = unpack_batch if unpack else pack_batch
+    mycursor = mydb.cursor(dictionary=True)
+    last_id = 0
+    batches = 0
+    while True:
+        mydb.start_transaction()
+        try:
+            last_id = step(mycursor, last_id, batch, delete)
+            mydb.commit()
+        except Exception as e:
+            mydb.rollback()
+            raise e
+        if last_id is None:
+            break
+        batches += 1
+        print(f"batch {batches}: up to maptime_id {last_id}")
+    mycursor.close()
+    return batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--unpack", action="store_true", help="PackedCheckpoints to Checkpoints"
+    )
+    parser.add_argument(
+        "--delete", action="store_true", help="Delete the copied runs from the source"
+    )
+    parser.add_argument("--batch", type=int, default=1000, help="Runs per transaction")
+    args = parser.parse_args()
+
+    with open("config.json", "r") as f:
+        db = json.load(f)["DATABASE"]
+
+    mydb = mysql.connector.connect(
+        host=db["HOST"],
+        port=db["PORT"],
+        user=db["USERNAME"],
+        password=db["PASSWORD"],
+        database=db["DB"],
+    )
+    try:
+        batches = migrate(mydb, args.unpack, args.delete, args.batch)
+    finally:
+        mydb.close()
+    print(f"{batches} batches migrated")
+
+
+if __name__ == "__main__":
+    main()
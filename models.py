@@ -100,3 +100,165 @@ class PlayerSurfProfile(BaseModel):
         if v is None or v == 0:
             return int(datetime.datetime.now(datetime.timezone.utc).timestamp())
         return v
+
+
+class LeaderboardRun(BaseModel):
+    """A run on a leaderboard page, `position` is the place on the leaderboard"""
+
+    id: int
+    player_id: int
+    name: str
+    map_id: int
+    style: int
+    type: int
+    stage: int
+    run_time: int
+    start_vel_x: Decimal
+    start_vel_y: Decimal
+    start_vel_z: Decimal
+    end_vel_x: Decimal
+    end_vel_y: Decimal
+    end_vel_z: Decimal
+    run_date: int
+    position: int
+
+
+class LeaderboardPage(BaseModel):
+    """Response body for a leaderboard page, `next_cursor` is `None` on the last page"""
+
+    runs: List[LeaderboardRun]
+    next_cursor: Optional[str] = None
+
+
+class LeaderboardSlice(BaseModel):
+    """Response body for the runs around a player, `rank` and `total` are for the whole leaderboard"""
+
+    rank: int
+    total: int
+    runs: List[LeaderboardRun]
+
+
+class StageRuns(BaseModel):
+    """Top runs of a stage or bonus, `completions` is the number of runs on it"""
+
+    stage: int
+    completions: int
+    runs: List[LeaderboardRun]
+
+
+class StageRecords(BaseModel):
+    """Response body for the top runs of every stage and bonus of a map"""
+
+    stages: List[StageRuns]
+    bonuses: List[StageRuns]
+
+
+class CheckpointSplit(BaseModel):
+    """A checkpoint of a run against the same checkpoint of the reference run, deltas are `None` if the reference doesn't have it"""
+
+    cp: int
+    run_time: int
+    time_delta: Optional[int] = None
+    start_speed: float
+    start_speed_delta: Optional[float] = None
+    end_speed: float
+    end_speed_delta: Optional[float] = None
+
+
+class RunSplits(BaseModel):
+    """Splits of one run, `time_delta` is the difference of the whole run"""
+
+    id: int
+    player_id: int
+    run_time: int
+    time_delta: int
+    checkpoints: List[CheckpointSplit]
+
+
+class CheckpointSplits(BaseModel):
+    """Response body for checkpoint split comparisons"""
+
+    reference: RunSplits
+    runs: List[RunSplits]
+
+
+class RunQuantile(BaseModel):
+    """Run time at a quantile, `0.5` is the median run"""
+
+    quantile: float
+    run_time: int
+
+
+class HistogramBucket(BaseModel):
+    """Runs with `start <= run_time < end`"""
+
+    start: int
+    end: int
+    count: int
+
+
+class PlayerPercentile(BaseModel):
+    """`percentile` is the share of runs as fast or faster, `3.2` means top 3.2%"""
+
+    player_id: int
+    run_time: int
+    rank: int
+    percentile: float
+
+
+class RunDistribution(BaseModel):
+    """Response body for the run time distribution of a leaderboard"""
+
+    total: int
+    quantiles: List[RunQuantile]
+    histogram: List[HistogramBucket]
+    overflow: int
+    player: Optional[PlayerPercentile] = None
+
+
+class PlayerPoints(BaseModel):
+    """A player's total points and global rank for a style"""
+
+    style: int
+    player_id: int
+    name: str
+    points: int
+    maps: int
+    rank: int
+
+
+class PlayerSummaryTier(BaseModel):
+    """Completions, top 10 map runs and records of a player on the maps of one style and tier"""
+
+    style: int
+    tier: int
+    maps: int
+    stages: int
+    bonuses: int
+    top10: int
+    records: int
+    stage_records: int
+    bonus_records: int
+
+
+class PlayerSummary(BaseModel):
+    """Response body for a player's completion summary, one entry per style and tier with runs"""
+
+    player_id: int
+    name: str
+    tiers: List[PlayerSummaryTier]
+
+
+class PointsPage(BaseModel):
+    """Response body for a page of the global ranking, `next_cursor` is `None` on the last page"""
+
+    total: int
+    players: List[PlayerPoints]
+    next_cursor: Optional[str] = None
+
+
+class LeaderboardTotals(BaseModel):
+    """Response body for the size and record time of a leaderboard"""
+
+    total: int
+    record: Optional[int] = None
@@ -0,0 +1,203 @@
+"""Points per map run and global player ranks
+
+Every map run (type 0) gets points per map and style, multiplied by the map's tier:
+- `COMPLETION` for finishing the map
+- up to `POSITION` depending on the share of runs that are slower, `POSITION * ((completions - rank + 1) / completions) ** 2`
+- `TOP[rank - 1]` for the fastest runs
+Ranks are the runs as fast or faster like everywhere else, ties share a rank and its points.
+
+`recompute` only reads the maps that had a save since they were last computed (`MapRecords.updated_at`), the
+ranks and points of all their runs are computed with NumPy in one pass per batch of maps. `MapPoints` keeps the
+points per map and player and `PlayerPoints` their sum, only the totals of players on a recomputed map before or
+after the recompute are summed again. Global ranks come from a `PointsBoard`, the sorted totals of a style, so a
+rank is a `bisect`.
+"""
+
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+import numpy as np
+
+import surftimer.queries
+from globals import bump_versions, get_versions, leaderboard_config, points_config
+from sql import selectQuery, transaction
+
+
+# Rows per multi-row `INSERT` and players per `IN (...)` list
+CHUNK_SIZE = 5000
+
+
+def map_points(
+    map_ids: np.ndarray, styles: np.ndarray, run_times: np.ndarray, tiers: np.ndarray
+):
+    """`(ranks, points)` of runs ordered by `map_id`, `style` and `run_time`"""
+    count = len(run_times)
+    if not count:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+
+    # A leaderboard starts where the map or the style changes
+    starts_board = np.ones(count, dtype=bool)
+    starts_board[1:] = (map_ids[1:] != map_ids[:-1]) | (styles[1:] != styles[:-1])
+    board_starts = np.flatnonzero(starts_board)
+    board_index = np.cumsum(starts_board) - 1
+    completions = np.diff(np.append(board_starts, count))[board_index]
+
+    # Rank is the position of the last run with the same time on the same leaderboard
+    ends_tie = np.ones(count, dtype=bool)
+    ends_tie[:-1] = starts_board[1:] | (run_times[1:] != run_times[:-1])
+    tie_ends = np.flatnonzero(ends_tie)
+    ranks = (
+        tie_ends[np.searchsorted(tie_ends, np.arange(count))]
+        - board_starts[board_index]
+        + 1
+    )
+
+    share = (completions - ranks + 1) / completions
+    points = points_config["COMPLETION"] + points_config["POSITION"] * share**2
+    top = np.asarray(points_config["TOP"], dtype=np.float64)
+    in_top = ranks <= len(top)
+    points[in_top] += top[ranks[in_top] - 1]
+    return ranks, np.rint(points * tiers).astype(np.int64)
+
+
+def _chunks(values: list, size: int = CHUNK_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start : start + size]
+
+
+def recompute_maps(map_ids: list, computed_at: int) -> dict:
+    """Recomputes `MapPoints` of the maps and the `PlayerPoints` of their players in one transaction,
+    returns the number of runs per style"""
+    maps = ", ".join(map(str, map_ids))
+    runs = selectQuery(surftimer.queries.sql_getPointsRuns.format(maps))
+    columns = {
+        name: np.fromiter((run[name] for run in runs), np.int64, len(runs))
+        for name in ("id", "map_id", "style", "player_id", "run_time", "tier")
+    }
+    ranks, points = map_points(
+        columns["map_id"], columns["style"], columns["run_time"], columns["tier"]
+    )
+
+    rows = [
+        f"({map_id}, {style}, {player_id}, {maptime_id}, {rank}, {run_points})"
+        for map_id, style, player_id, maptime_id, rank, run_points in zip(
+            columns["map_id"].tolist(),
+            columns["style"].tolist(),
+            columns["player_id"].tolist(),
+            columns["id"].tolist(),
+            ranks.tolist(),
+            points.tolist(),
+        )
+    ]
+
+    players = {}
+    runs_per_style = {}
+    for style in np.unique(columns["style"]).tolist():
+        players[style] = set(
+            np.unique(columns["player_id"][columns["style"] == style]).tolist()
+        )
+        runs_per_style[style] = int((columns["style"] == style).sum())
+
+    with transaction() as trx:
+        # Players that had points on the maps but no run any more, their totals have to drop these maps too
+        dropped = {}
+        for row in trx.select(surftimer.queries.sql_getMapPointsPlayers.format(maps)):
+            if row["player_id"] not in players.get(row["style"], ()):
+                dropped.setdefault(row["style"], []).append(row["player_id"])
+
+        queries = [surftimer.queries.sql_deleteMapPoints.format(maps)]
+        queries += [
+            surftimer.queries.sql_insertMapPoints.format(", ".join(chunk))
+            for chunk in _chunks(rows)
+        ]
+        for style, player_ids in dropped.items():
+            # A player without any other map keeps no row, the others are summed again below
+            queries += [
+                surftimer.queries.sql_deletePlayerPoints.format(
+                    style, ", ".join(map(str, chunk))
+                )
+                for chunk in _chunks(player_ids)
+            ]
+            players.setdefault(style, set()).update(player_ids)
+            runs_per_style.setdefault(style, 0)
+        for style, player_ids in players.items():
+            queries += [
+                surftimer.queries.sql_updatePlayerPoints.format(
+                    style, ", ".join(map(str, chunk))
+                )
+                for chunk in _chunks(sorted(player_ids))
+            ]
+        queries.append(surftimer.queries.sql_markMapPoints.format(computed_at, maps))
+
+        trx.execute(queries)
+    return runs_per_style
+
+
+def recompute(full: bool = False) -> dict:
+    """Recomputes the maps with new runs since they were last computed, every map with `full`"""
+    computed_at = int(time.time())
+    condition = "TRUE" if full else "`updated_at` >= `points_at`"
+    map_ids = [
+        row["map_id"]
+        for row in selectQuery(surftimer.queries.sql_getPointsMaps.format(condition))
+    ]
+
+    runs_per_style = {}
+    for batch in _chunks(map_ids, points_config["BATCH_MAPS"]):
+        for style, runs in recompute_maps(batch, computed_at).items():
+            runs_per_style[style] = runs_per_style.get(style, 0) + runs
+
+    # Rankings of the recomputed styles changed
+    if runs_per_style:
+        bump_versions(*(f"points:{style}" for style in runs_per_style))
+    return {"maps": len(map_ids), "runs": runs_per_style}
+
+
+class PointsBoard:
+    """Totals of a style sorted from most to least points, stored negated so they are ascending"""
+
+    __slots__ = ("version", "loaded_at", "points")
+
+    def __init__(self, rows: list, version):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.points = array("q", (-row["points"] for row in rows))
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def rank(self, points: int) -> int:
+        """1 + the players with more points, players with the same points share the rank"""
+        return bisect_left(self.points, -points) + 1
+
+
+_boards = OrderedDict()
+
+
+def get_points_board(style: int) -> PointsBoard:
+    """Returns the ranking of a style, reloading it after `recompute` changed it"""
+    versions = get_versions(f"points:{style}")
+    version = versions[0] if versions else None
+
+    board = _boards.get(style)
+    if board is not None:
+        if version is not None:
+            stale = board.version != version
+        else:
+            stale = (
+                time.monotonic() - board.loaded_at > leaderboard_config["BOARD_MAX_AGE"]
+            )
+        if not stale:
+            _boards.move_to_end(style)
+            return board
+
+    board = PointsBoard(
+        selectQuery(surftimer.queries.sql_getPointsKeys.format(style)), version
+    )
+    _boards[style] = board
+    _boards.move_to_end(style)
+    while len(_boards) > leaderboard_config["MAX_BOARDS"]:
+        _boards.popitem(last=False)
+    return board
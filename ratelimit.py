@@ -0,0 +1,163 @@
+"""Per-client rate limiting with token buckets
+
+Every client has a bucket of `BURST` tokens that refills at `RATE` tokens per second. A `/surftimer/` request
+takes `COSTS[path]` tokens (1 when the path is not listed) or is answered with `429` and a `Retry-After` of the
+seconds until the bucket has enough tokens again. Clients are keyed by IP, with `"KEY": "identity"` by the
+`IDENTITY_HEADER` value when the request sends one, e.g. several game servers behind one address.
+
+A bucket is two numbers updated on the request, so the work per request doesn't depend on the number of clients.
+Buckets are per worker, the `MAX_CLIENTS` most recently seen are kept. With `"SHARED": 1` and Redis enabled the
+buckets live in Redis and a Lua script refills and takes in one round trip, so all workers share one limit.
+When Redis fails the request takes from the bucket of this worker instead, counted in
+`surftimer_rate_limit_fallbacks_total`.
+
+Every limited response has the `RateLimit-Limit`, `RateLimit-Remaining` and `RateLimit-Reset` headers of the
+IETF `RateLimit` header fields draft, `Reset` being the seconds until the bucket is full again.
+"""
+
+import math
+import time
+from collections import OrderedDict
+
+import redis
+from fastapi import status
+from fastapi.responses import JSONResponse
+
+from globals import config, rate_limit_config, redis_client
+from metrics import RATE_LIMIT_FALLBACKS, RATE_LIMITED
+from tracing import span
+
+
+# Refills the bucket in `KEYS[1]` and takes `ARGV[3]` tokens, same arithmetic as `take`
+# Returns whether the tokens were taken and the tokens left, as a string as Lua numbers become integers
+TAKE_SCRIPT = """
+local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, tostring(tokens)}
+"""
+_take_script = None
+
+# Local buckets by client key: `[tokens, updated_at]`
+_buckets = OrderedDict()
+
+
+def take(bucket: list, cost: float, now: float) -> bool:
+    """Refills the `[tokens, updated_at]` bucket up to `now` and takes `cost` tokens if it has them"""
+    rate, burst = rate_limit_config["RATE"], rate_limit_config["BURST"]
+    bucket[0] = min(burst, bucket[0] + max(0.0, now - bucket[1]) * rate)
+    bucket[1] = now
+    if bucket[0] >= cost:
+        bucket[0] -= cost
+        return True
+    return False
+
+
+def take_local(client: str, cost: float) -> tuple:
+    """`(allowed, tokens left)` from the bucket of this worker"""
+    now = time.monotonic()
+    bucket = _buckets.get(client)
+    if bucket is None:
+        bucket = _buckets[client] = [rate_limit_config["BURST"], now]
+        while len(_buckets) > rate_limit_config["MAX_CLIENTS"]:
+            _buckets.popitem(last=False)
+    else:
+        _buckets.move_to_end(client)
+    return take(bucket, cost, now), bucket[0]
+
+
+def take_shared(client: str, cost: float) -> tuple:
+    """`(allowed, tokens left)` from the bucket in Redis"""
+    global _take_script
+    if _take_script is None:
+        _take_script = redis_client.register_script(TAKE_SCRIPT)
+    with span("cache", "ratelimit"):
+        allowed, tokens = _take_script(
+            keys=[f"ratelimit:{client}"],
+            args=[
+                rate_limit_config["RATE"],
+                rate_limit_config["BURST"],
+                cost,
+                repr(time.time()),
+            ],
+        )
+    return allowed == 1, float(tokens)
+
+
+def client_key(scope) -> str:
+    """The client IP, or the `IDENTITY_HEADER` value with `"KEY": "identity"`"""
+    if rate_limit_config["KEY"] == "identity":
+        header = rate_limit_config["IDENTITY_HEADER"].lower().encode("latin-1")
+        for name, value in scope["headers"]:
+            if name == header:
+                return "id:" + value.decode("latin-1")
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+def rate_limit_headers(tokens: float) -> dict:
+    rate, burst = rate_limit_config["RATE"], rate_limit_config["BURST"]
+    return {
+        "ratelimit-limit": str(burst),
+        "ratelimit-remaining": str(math.floor(tokens)),
+        "ratelimit-reset": str(math.ceil((burst - tokens) / rate)),
+    }
+
+
+class RateLimitMiddleware:
+    """Takes the route's cost from the client's bucket, `429` when it is empty, and adds the `RateLimit` headers"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or rate_limit_config["ENABLED"] == 0
+            or not scope["path"].startswith("/surftimer/")
+        ):
+            return await self.app(scope, receive, send)
+
+        client = client_key(scope)
+        cost = rate_limit_config["COSTS"].get(scope["path"], 1)
+        allowed = None
+        if rate_limit_config["SHARED"] == 1 and config["REDIS"]["ENABLED"] == 1:
+            try:
+                allowed, tokens = take_shared(client, cost)
+            except redis.RedisError:
+                RATE_LIMIT_FALLBACKS.inc()
+        if allowed is None:
+            allowed, tokens = take_local(client, cost)
+        headers = rate_limit_headers(tokens)
+
+        if not allowed:
+            RATE_LIMITED.inc()
+            # A cost above `BURST` can never be paid, such a route is effectively disabled for the client
+            wait = (cost - tokens) / rate_limit_config["RATE"]
+            response = JSONResponse(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                content={"message": "Too Many Requests"},
+                headers={**headers, "retry-after": str(math.ceil(wait))},
+            )
+            return await response(scope, receive, send)
+
+        raw_headers = [
+            (name.encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers.items()
+        ]
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + raw_headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
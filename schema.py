@@ -0,0 +1,102 @@
+"""Applies `schema.sql` to the database from `config.json`
+
+Every statement can be run again on an existing database: tables use `CREATE TABLE IF NOT EXISTS` and a
+`CREATE INDEX` is skipped when the index, or another index starting with the same columns, is already there.
+```
+    python schema.py
+```
+"""
+
+import os
+import re
+
+import mysql.connector
+import simplejson as json
+
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+CREATE_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+`?(\w+)`?\s+ON\s+`?(\w+)`?\s*\(([^)]*)\)",
+    re.IGNORECASE,
+)
+
+
+def schema_statements(path: str = SCHEMA_FILE):
+    """Splits `schema.sql` into statements"""
+    with open(path) as f:
+        lines = [line for line in f if not line.lstrip().startswith("--")]
+    return [
+        statement.strip()
+        for statement in "".join(lines).split(";")
+        if statement.strip()
+    ]
+
+
+def table_indexes(mycursor, table: str) -> dict:
+    """`{index name: [columns]}` of a table in the current database"""
+    mycursor.execute(
+        """SELECT `INDEX_NAME`, `COLUMN_NAME` FROM information_schema.STATISTICS
+        WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = %s
+        ORDER BY `INDEX_NAME`, `SEQ_IN_INDEX`""",
+        (table,),
+    )
+    indexes = {}
+    for index_name, column_name in mycursor.fetchall():
+        indexes.setdefault(index_name.lower(), []).append(column_name.lower())
+    return indexes
+
+
+def index_exists(mycursor, name: str, table: str, columns: list) -> bool:
+    """`True` if the index exists or another index already covers `columns` as its leftmost columns"""
+    indexes = table_indexes(mycursor, table)
+    return name.lower() in indexes or any(
+        existing[: len(columns)] == columns for existing in indexes.values()
+    )
+
+
+def apply_schema(mydb, indexes: bool = True, path: str = SCHEMA_FILE):
+    """Runs `schema.sql` on the connection's database and returns the statements that were executed,
+    `indexes=False` only creates the tables"""
+    mycursor = mydb.cursor()
+    executed = []
+    for statement in schema_statements(path):
+        create_index = CREATE_INDEX.match(statement)
+        if create_index:
+            if not indexes:
+                continue
+            name, table, columns = create_index.groups()
+            columns = [
+                column.strip().strip("`").lower() for column in columns.split(",")
+            ]
+            if index_exists(mycursor, name, table, columns):
+                continue
+        mycursor.execute(statement)
+        executed.append(statement)
+    mydb.commit()
+    mycursor.close()
+    return executed
+
+
+def main():
+    with open("config.json", "r") as f:
+        db = json.load(f)["DATABASE"]
+
+    mydb = mysql.connector.connect(
+        host=db["HOST"],
+        port=db["PORT"],
+        user=db["USERNAME"],
+        password=db["PASSWORD"],
+        database=db["DB"],
+    )
+    try:
+        executed = apply_schema(mydb)
+    finally:
+        mydb.close()
+
+    for statement in executed:
+        print(statement.splitlines()[0])
+    print(f"{len(executed)} statements executed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+-- Tables and indexes used by the API, apply with `python schema.py` which can be run again on an existing database
+
+CREATE TABLE IF NOT EXISTS `Maps` (
+    `id` INT NOT NULL AUTO_INCREMENT,
+    `name` VARCHAR(255) NOT NULL,
+    `author` VARCHAR(50) NOT NULL DEFAULT 'Unknown',
+    `tier` INT NOT NULL,
+    `stages` INT NOT NULL,
+    `bonuses` INT NOT NULL DEFAULT 0,
+    `ranked` TINYINT NOT NULL DEFAULT 0,
+    `date_added` INT NOT NULL,
+    `last_played` INT NOT NULL,
+    PRIMARY KEY (`id`),
+    UNIQUE KEY `name` (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `Player` (
+    `id` INT NOT NULL AUTO_INCREMENT,
+    `name` VARCHAR(64) NOT NULL,
+    `steam_id` BIGINT NOT NULL,
+    `country` VARCHAR(32) NOT NULL,
+    `join_date` INT NOT NULL,
+    `last_seen` INT NOT NULL,
+    `connections` INT NOT NULL DEFAULT 1,
+    PRIMARY KEY (`id`),
+    UNIQUE KEY `steam_id` (`steam_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `MapTimes` (
+    `id` INT NOT NULL AUTO_INCREMENT,
+    `player_id` INT NOT NULL,
+    `map_id` INT NOT NULL,
+    `style` INT NOT NULL DEFAULT 0,
+    `type` INT NOT NULL DEFAULT 0,
+    `stage` INT NOT NULL DEFAULT 0,
+    `run_time` INT NOT NULL,
+    `start_vel_x` DECIMAL(12, 6) NOT NULL,
+    `start_vel_y` DECIMAL(12, 6) NOT NULL,
+    `start_vel_z` DECIMAL(12, 6) NOT NULL,
+    `end_vel_x` DECIMAL(12, 6) NOT NULL,
+    `end_vel_y` DECIMAL(12, 6) NOT NULL,
+    `end_vel_z` DECIMAL(12, 6) NOT NULL,
+    `run_date` INT NOT NULL,
+    `replay_frames` LONGTEXT,
+    PRIMARY KEY (`id`),
+    UNIQUE KEY `player_run` (`player_id`, `map_id`, `style`, `type`, `stage`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `Checkpoints` (
+    `id` INT NOT NULL AUTO_INCREMENT,
+    `maptime_id` INT NOT NULL,
+    `cp` INT NOT NULL,
+    `run_time` INT NOT NULL,
+    `start_vel_x` DECIMAL(12, 6) NOT NULL,
+    `start_vel_y` DECIMAL(12, 6) NOT NULL,
+    `start_vel_z` DECIMAL(12, 6) NOT NULL,
+    `end_vel_x` DECIMAL(12, 6) NOT NULL,
+    `end_vel_y` DECIMAL(12, 6) NOT NULL,
+    `end_vel_z` DECIMAL(12, 6) NOT NULL,
+    `attempts` INT NOT NULL DEFAULT 0,
+    `end_touch` INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (`id`),
+    UNIQUE KEY `maptime_cp` (`maptime_id`, `cp`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- All checkpoints of a run in one row, used with `"CHECKPOINTS": {"STORAGE": "packed"}`
+-- `data` holds 64 bytes per checkpoint (`checkpoints.py`), copy existing runs with `python migrate_checkpoints.py`
+CREATE TABLE IF NOT EXISTS `PackedCheckpoints` (
+    `maptime_id` INT NOT NULL,
+    `cp_count` INT NOT NULL,
+    `data` MEDIUMBLOB NOT NULL,
+    PRIMARY KEY (`maptime_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Record and number of runs per map/style/type/stage, maintained by the save endpoints
+-- Rebuild with `POST /surftimer/rebuildrecords` after creating it on an existing database
+CREATE TABLE IF NOT EXISTS `MapRecords` (
+    `map_id` INT NOT NULL,
+    `style` INT NOT NULL,
+    `type` INT NOT NULL,
+    `stage` INT NOT NULL,
+    `maptime_id` INT NOT NULL,
+    `player_id` INT NOT NULL,
+    `run_time` INT NOT NULL,
+    `completions` INT NOT NULL DEFAULT 0,
+    `updated_at` INT NOT NULL DEFAULT 0,
+    `points_at` INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (`map_id`, `style`, `type`, `stage`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Points of every map run (type 0) per style, maps with `MapRecords.updated_at` >= `points_at` are recomputed
+-- by `POST /surftimer/recomputepoints` (`points.py`)
+CREATE TABLE IF NOT EXISTS `MapPoints` (
+    `map_id` INT NOT NULL,
+    `style` INT NOT NULL,
+    `player_id` INT NOT NULL,
+    `maptime_id` INT NOT NULL,
+    `rank` INT NOT NULL,
+    `points` INT NOT NULL,
+    PRIMARY KEY (`map_id`, `style`, `player_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Sum of `MapPoints` per style and player
+CREATE TABLE IF NOT EXISTS `PlayerPoints` (
+    `style` INT NOT NULL,
+    `player_id` INT NOT NULL,
+    `points` INT NOT NULL,
+    `maps` INT NOT NULL,
+    PRIMARY KEY (`style`, `player_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Completions, top 10 map runs and records per player, style and map tier, maintained by the save endpoints
+-- Rebuild with `POST /surftimer/rebuildsummaries` after creating it on an existing database or changing a tier
+CREATE TABLE IF NOT EXISTS `PlayerSummary` (
+    `player_id` INT NOT NULL,
+    `style` INT NOT NULL,
+    `tier` INT NOT NULL,
+    `maps` INT NOT NULL DEFAULT 0,
+    `stages` INT NOT NULL DEFAULT 0,
+    `bonuses` INT NOT NULL DEFAULT 0,
+    `top10` INT NOT NULL DEFAULT 0,
+    `records` INT NOT NULL DEFAULT 0,
+    `stage_records` INT NOT NULL DEFAULT 0,
+    `bonus_records` INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (`player_id`, `style`, `tier`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Leaderboards and ranks, `COUNT(*)` of the runs faster than a time is a range scan of this index
+CREATE INDEX `idx_maptimes_leaderboard` ON `MapTimes` (`map_id`, `style`, `type`, `stage`, `run_time`);
+
+-- Checkpoints of a run, skipped when `maptime_cp` already starts with `maptime_id`
+CREATE INDEX `idx_checkpoints_maptime` ON `Checkpoints` (`maptime_id`);
+
+-- Players whose totals change when a map is recomputed
+CREATE INDEX `idx_mappoints_player` ON `MapPoints` (`style`, `player_id`);
+
+-- Global ranking pages and the in-memory points board
+CREATE INDEX `idx_playerpoints_points` ON `PlayerPoints` (`style`, `points`);
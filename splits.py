@@ -0,0 +1,147 @@
+"""Checkpoint split comparisons against a reference run, computed with NumPy
+
+The checkpoints of every compared run are stacked in one array and matched to the reference run's checkpoints
+with a single `searchsorted`, so a batch of runs costs about the same number of Python steps as one run.
+Speeds are horizontal, `hypot(vel_x, vel_y)`, the same speed the timer shows in game.
+"""
+
+import numpy as np
+
+from checkpoints import VELOCITY_SCALE, unpack
+
+
+# Value columns of a checkpoint, in the order of `CheckpointArrays.values`
+COLUMNS = (
+    "run_time",
+    "start_vel_x",
+    "start_vel_y",
+    "start_vel_z",
+    "end_vel_x",
+    "end_vel_y",
+    "end_vel_z",
+)
+RUN_TIME, START_VEL_X, START_VEL_Y, END_VEL_X, END_VEL_Y = 0, 1, 2, 4, 5
+
+
+class CheckpointArrays:
+    """Checkpoints of one or more runs ordered by `maptime_id` and `cp`"""
+
+    __slots__ = ("maptime_ids", "cps", "values")
+
+    def __init__(self, maptime_ids: np.ndarray, cps: np.ndarray, values: np.ndarray):
+        self.maptime_ids = maptime_ids
+        self.cps = cps
+        self.values = values
+
+    @classmethod
+    def from_rows(cls, rows: list):
+        """From `Checkpoints` rows ordered by `maptime_id` and `cp`"""
+        count = len(rows)
+        return cls(
+            np.fromiter((row["maptime_id"] for row in rows), np.int64, count),
+            np.fromiter((row["cp"] for row in rows), np.int64, count),
+            np.array(
+                [[float(row[column]) for column in COLUMNS] for row in rows],
+                dtype=np.float64,
+            ).reshape(count, len(COLUMNS)),
+        )
+
+    @classmethod
+    def from_packed(cls, rows: list):
+        """From `PackedCheckpoints` rows ordered by `maptime_id`"""
+        arrays = [unpack(row["data"]) for row in rows]
+        packed = np.concatenate(arrays) if arrays else unpack(b"")
+        values = np.empty((len(packed), len(COLUMNS)), dtype=np.float64)
+        values[:, RUN_TIME] = packed["run_time"]
+        for index, column in enumerate(COLUMNS[1:], start=1):
+            values[:, index] = packed[column] / VELOCITY_SCALE
+        return cls(
+            np.repeat(
+                np.array([row["maptime_id"] for row in rows], dtype=np.int64),
+                [len(array) for array in arrays],
+            ),
+            packed["cp"].astype(np.int64),
+            values,
+        )
+
+    @classmethod
+    def concatenate(cls, parts: list):
+        """Joins arrays of different runs, ordered by `maptime_id` and `cp` again"""
+        maptime_ids = np.concatenate([part.maptime_ids for part in parts])
+        cps = np.concatenate([part.cps for part in parts])
+        order = np.lexsort((cps, maptime_ids))
+        return cls(
+            maptime_ids[order],
+            cps[order],
+            np.concatenate([part.values for part in parts])[order],
+        )
+
+    def __len__(self) -> int:
+        return len(self.cps)
+
+    def run(self, maptime_id: int):
+        """Checkpoints of a single run"""
+        mask = self.maptime_ids == maptime_id
+        return CheckpointArrays(
+            self.maptime_ids[mask], self.cps[mask], self.values[mask]
+        )
+
+
+def _speeds(values: np.ndarray):
+    return (
+        np.hypot(values[:, START_VEL_X], values[:, START_VEL_Y]),
+        np.hypot(values[:, END_VEL_X], values[:, END_VEL_Y]),
+    )
+
+
+def _listed(values: np.ndarray, decimals: int = None) -> list:
+    """`NaN` becomes `None` in the response, without `decimals` the values are ticks and stay integers"""
+    if decimals is None:
+        return [None if value != value else int(value) for value in values.tolist()]
+    values = np.round(values, decimals)
+    return [None if value != value else value for value in values.tolist()]
+
+
+def compare(reference: CheckpointArrays, runs: CheckpointArrays) -> dict:
+    """Per-checkpoint deltas of every run in `runs` against `reference`, a positive `time_delta` is slower\n
+    Returns `{maptime_id: [checkpoint split]}`, deltas are `None` for checkpoints the reference doesn't have
+    """
+    if not len(runs):
+        return {}
+
+    # Reference values for every checkpoint of `runs`, `NaN` where the reference has no such `cp`
+    aligned = np.full_like(runs.values, np.nan)
+    if len(reference):
+        order = np.argsort(reference.cps, kind="stable")
+        reference_cps = reference.cps[order]
+        index = np.minimum(
+            np.searchsorted(reference_cps, runs.cps), len(reference_cps) - 1
+        )
+        found = reference_cps[index] == runs.cps
+        aligned[found] = reference.values[order][index[found]]
+
+    start_speed, end_speed = _speeds(runs.values)
+    reference_start_speed, reference_end_speed = _speeds(aligned)
+
+    columns = {
+        "cp": runs.cps.tolist(),
+        "run_time": runs.values[:, RUN_TIME].astype(np.int64).tolist(),
+        "time_delta": _listed(runs.values[:, RUN_TIME] - aligned[:, RUN_TIME]),
+        "start_speed": _listed(start_speed, 6),
+        "start_speed_delta": _listed(start_speed - reference_start_speed, 6),
+        "end_speed": _listed(end_speed, 6),
+        "end_speed_delta": _listed(end_speed - reference_end_speed, 6),
+    }
+
+    # Runs are contiguous, split the columns at every change of `maptime_id`
+    bounds = np.flatnonzero(np.diff(runs.maptime_ids)) + 1
+    starts = [0, *bounds.tolist()]
+    ends = [*bounds.tolist(), len(runs)]
+    names = list(columns)
+    splits = {}
+    for start, end in zip(starts, ends):
+        splits[int(runs.maptime_ids[start])] = [
+            dict(zip(names, values))
+            for values in zip(*(columns[name][start:end] for name in names))
+        ]
+    return splits
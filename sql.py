@@ -1,111 +1,319 @@
+import itertools
+import math
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
 import mysql.connector
 import simplejson as json
+from deadline import (
+    QUERY_TIMEOUT_ERRNO,
+    DeadlineExceeded,
+    remaining,
+    with_execution_time,
+)
+from metrics import db_connection, db_query
+from tracing import span
 
 
 with open("config.json", "r") as f:
     config = json.load(f)
 
+# Read replicas, entries of `REPLICAS` take the keys they leave out from `DATABASE`
+# `selectQuery` and `streamQuery` go round robin over the healthy replicas, every write goes to `DATABASE`
+# A replica is skipped for `RETRY_AFTER` seconds when it can't be reached or lags more than `MAX_LAG` seconds,
+# the lag is checked every `LAG_CHECK` seconds (needs the `REPLICATION CLIENT` privilege, `MAX_LAG` 0 skips it)
+# Reads of a player are pinned to `DATABASE` for `PIN_SECONDS` after one of their runs was saved
+replica_config = {
+    "REPLICAS": [],
+    "MAX_LAG": 5,
+    "LAG_CHECK": 10,
+    "RETRY_AFTER": 30,
+    "PIN_SECONDS": 5,
+}
+replica_config.update(config.get("REPLICATION", {}))
+
+# Connection errors, a replica that raises one of these is skipped and the read is retried on the primary
+CONNECTION_ERRORS = (
+    mysql.connector.errors.InterfaceError,
+    mysql.connector.errors.OperationalError,
+)
+
+
+class Replica:
+    """Connection settings and health of a read replica"""
+
+    __slots__ = ("db", "down_until", "checked_at")
+
+    def __init__(self, db: dict):
+        self.db = db
+        self.down_until = 0.0
+        self.checked_at = 0.0
+
+    def mark_down(self):
+        self.down_until = time.monotonic() + replica_config["RETRY_AFTER"]
+
+    def lag(self):
+        """Seconds the replica is behind the primary, `None` when it is not replicating"""
+        mydb = connect(self.db)
+        try:
+            mycursor = mydb.cursor(dictionary=True)
+            try:
+                mycursor.execute("SHOW REPLICA STATUS")
+            except mysql.connector.errors.ProgrammingError:
+                # Before MySQL 8.0.22
+                mycursor.execute("SHOW SLAVE STATUS")
+            status = mycursor.fetchone()
+        finally:
+            mydb.close()
+        if status is None:
+            return None
+        return status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+
+    def healthy(self) -> bool:
+        now = time.monotonic()
+        if self.down_until > now:
+            return False
+        if (
+            replica_config["MAX_LAG"]
+            and now - self.checked_at >= replica_config["LAG_CHECK"]
+        ):
+            self.checked_at = now
+            try:
+                lag = self.lag()
+            except mysql.connector.Error:
+                lag = None
+            if lag is None or lag > replica_config["MAX_LAG"]:
+                self.mark_down()
+                return False
+        return True
+
+
+replicas = [
+    Replica({**config["DATABASE"], **replica}) for replica in replica_config["REPLICAS"]
+]
+_next_replica = itertools.count()
+_primary_reads = ContextVar("primary_reads", default=False)
+
+
+def read_from_primary():
+    """Sends the reads of the current request to the primary, e.g. right after the player saved a run"""
+    _primary_reads.set(True)
+
+
+def read_replica():
+    """The next healthy replica or `None` for the primary"""
+    if not replicas or _primary_reads.get():
+        return None
+    for _ in range(len(replicas)):
+        replica = replicas[next(_next_replica) % len(replicas)]
+        if replica.healthy():
+            return replica
+    return None
+
+
+def connect(db: dict):
+    """Connects to `db`, within a request deadline the socket times out a second after it"""
+    left = remaining()
+    options = {} if left is None else {"connection_timeout": math.ceil(left) + 1}
+    with span("db", "connect"):
+        return mysql.connector.connect(
+            host=db["HOST"],
+            port=db["PORT"],
+            user=db["USERNAME"],
+            password=db["PASSWORD"],
+            database=db["DB"],
+            **options,
+        )
+
+
+def deadline_error(error: Exception) -> bool:
+    """Whether a failed read ran out of the request deadline rather than failed on its own"""
+    if getattr(error, "errno", None) == QUERY_TIMEOUT_ERRNO:
+        return True
+    left = remaining()
+    return left is not None and left <= 0
+
 
 def selectQuery(query):
     """Executes `SELECT` query provided and returns the output in JSON\n
-    Connects to a predefined `Database` from `config.json`"""
-    json_data = []
-    db = config["DATABASE"]
-    mydb = mysql.connector.connect(
-        host=db["HOST"],
-        port=db["PORT"],
-        user=db["USERNAME"],
-        password=db["PASSWORD"],
-        database=db["DB"],
-    )
-    mycursor = mydb.cursor(dictionary=True)
-    mycursor.execute(query)
-    res = mycursor.fetchall()
-    for result in res:
-        json_data.append(dict(result))
-
-    mydb.close()
+    Connects to a healthy replica or the predefined `Database` from `config.json`\n
+    Within a request deadline the query gets a `MAX_EXECUTION_TIME` hint, raises `DeadlineExceeded` when it passed
+    """
+    query = with_execution_time(query)
+    replica = read_replica()
+    if replica is not None:
+        try:
+            return _select(replica.db, query)
+        except CONNECTION_ERRORS:
+            replica.mark_down()
+    return _select(config["DATABASE"], query)
+
+
+def _select(db: dict, query):
+    with db_connection():
+        try:
+            mydb = connect(db)
+            try:
+                mycursor = mydb.cursor(dictionary=True)
+                with db_query(query), span("db", getattr(query, "name", None)):
+                    mycursor.execute(query)
+                    # The dictionary cursor already returns a `dict` per row
+                    json_data = mycursor.fetchall()
+            finally:
+                mydb.close()
+        except mysql.connector.Error as e:
+            # Not the replica's fault, don't retry on the primary
+            if deadline_error(e):
+                raise DeadlineExceeded() from e
+            raise e
+
     return json_data
 
 
+def streamQuery(query, batch_size: int = 500):
+    """Executes `SELECT` query provided and yields the rows in lists of up to `batch_size` rows\n
+    The cursor is unbuffered, rows are read from the server as the batches are consumed and the
+    connection stays open until the generator is exhausted or closed\n
+    Connects to a healthy replica or the predefined `Database` from `config.json`, with the same deadline
+    handling as `selectQuery`"""
+    query = with_execution_time(query)
+    replica = read_replica()
+    db = config["DATABASE"]
+    with db_connection():
+        mydb = None
+        if replica is not None:
+            try:
+                mydb = connect(replica.db)
+            except CONNECTION_ERRORS:
+                replica.mark_down()
+        if mydb is None:
+            mydb = connect(db)
+        exhausted = False
+        try:
+            mycursor = mydb.cursor(dictionary=True, buffered=False)
+            with db_query(query), span("db", getattr(query, "name", None)):
+                mycursor.execute(query)
+            while True:
+                rows = mycursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+            exhausted = True
+        finally:
+            if exhausted:
+                mydb.close()
+            else:
+                # Closed early, e.g. the client went away. Drop the socket instead of reading the rest of the rows
+                mydb.shutdown()
+
+
 def insertQuery(query):
     """Executes `INSERT` query provided and returns `mycursor.rowcount`\n
     Connects to a predefined `Database` from `config.json`"""
     db = config["DATABASE"]
-    mydb = mysql.connector.connect(
-        host=db["HOST"],
-        port=db["PORT"],
-        user=db["USERNAME"],
-        password=db["PASSWORD"],
-        database=db["DB"],
-    )
+    with db_connection():
+        with span("db", "connect"):
+            mydb = mysql.connector.connect(
+                host=db["HOST"],
+                port=db["PORT"],
+                user=db["USERNAME"],
+                password=db["PASSWORD"],
+                database=db["DB"],
+            )
+        try:
+            mycursor = mydb.cursor()
+            with db_query(query), span("db", getattr(query, "name", None)):
+                mycursor.execute(query)
 
-    mycursor = mydb.cursor()
-    mycursor.execute(query)
+                mydb.commit()
 
-    mydb.commit()
+            # Get the last auto-incremented value
+            last_inserted_id = mycursor.lastrowid
 
-    # Get the last auto-incremented value
-    last_inserted_id = mycursor.lastrowid
-
-    return mycursor.rowcount, last_inserted_id
+            return mycursor.rowcount, last_inserted_id
+        finally:
+            mydb.close()
 
 
 def insertEscapedQuery(query):
     """Executes `INSERT` query `mycursor.execute("", (query))` provided and returns `mycursor.rowcount`\n
     Connects to a predefined `Database` from `config.json`"""
     db = config["DATABASE"]
-    mydb = mysql.connector.connect(
-        host=db["HOST"],
-        port=db["PORT"],
-        user=db["USERNAME"],
-        password=db["PASSWORD"],
-        database=db["DB"],
-    )
+    with db_connection():
+        with span("db", "connect"):
+            mydb = mysql.connector.connect(
+                host=db["HOST"],
+                port=db["PORT"],
+                user=db["USERNAME"],
+                password=db["PASSWORD"],
+                database=db["DB"],
+            )
+        try:
+            mycursor = mydb.cursor()
+            with db_query(query), span("db", getattr(query, "name", None)):
+                mycursor.execute("", (query))
 
-    mycursor = mydb.cursor()
-    mycursor.execute("", (query))
+                mydb.commit()
 
-    mydb.commit()
+            # Get the last auto-incremented value
+            last_inserted_id = mycursor.lastrowid
 
-    # Get the last auto-incremented value
-    last_inserted_id = mycursor.lastrowid
+            return mycursor.rowcount, last_inserted_id
+        finally:
+            mydb.close()
 
-    return mycursor.rowcount, last_inserted_id
 
+class Transaction:
+    """Queries on the connection of a `transaction()`, every one sees the ones before it"""
 
-def executeTransaction(queries):
-    """Executes multiple queries within a single transaction and returns the row counts"""
-    db_config = config["DATABASE"]
-    mydb = mysql.connector.connect(
-        host=db_config["HOST"],
-        port=db_config["PORT"],
-        user=db_config["USERNAME"],
-        password=db_config["PASSWORD"],
-        database=db_config["DB"],
-    )
+    __slots__ = ("cursor",)
 
-    try:
-        mycursor = mydb.cursor()
+    def __init__(self, cursor):
+        self.cursor = cursor
 
-        # Start a transaction
-        mydb.start_transaction()
+    def select(self, query) -> list:
+        """Executes a `SELECT` query and returns its rows, `FOR UPDATE` keeps them locked until the commit"""
+        with db_query(query), span("db", getattr(query, "name", None)):
+            self.cursor.execute(query)
+            return self.cursor.fetchall()
 
-        row_counts = []
+    def insert(self, query) -> tuple:
+        """Executes an `INSERT` query and returns `(rowcount, lastrowid)` like `insertQuery`"""
+        with db_query(query), span("db", getattr(query, "name", None)):
+            self.cursor.execute(query)
+        return self.cursor.rowcount, self.cursor.lastrowid
 
+    def execute(self, queries) -> list:
+        """Executes the queries and returns their row counts"""
+        row_counts = []
         for query in queries:
-            mycursor.execute(query)
-            row_counts.append(mycursor.rowcount)
+            with db_query(query), span("db", getattr(query, "name", None)):
+                self.cursor.execute(query)
+            row_counts.append(self.cursor.rowcount)
+        return row_counts
 
-        # Commit the transaction
-        mydb.commit()
 
-        return row_counts
+@contextmanager
+def transaction():
+    """A `Transaction` on one connection to the predefined `Database` from `config.json`\n
+    Commits when the block ends and rolls back if it raises"""
+    with db_connection():
+        mydb = connect(config["DATABASE"])
+        try:
+            mydb.start_transaction()
+            try:
+                yield Transaction(mydb.cursor(dictionary=True))
+                mydb.commit()
+            except Exception as e:
+                # Rollback the transaction if an error occurs
+                mydb.rollback()
+                raise e
+        finally:
+            mydb.close()
 
-    except Exception as e:
-        # Rollback the transaction if an error occurs
-        mydb.rollback()
-        raise e
 
-    finally:
-        mydb.close()
+def executeTransaction(queries):
+    """Executes multiple queries within a single transaction and returns the row counts"""
+    with transaction() as trx:
+        return trx.execute(queries)
@@ -1,14 +1,192 @@
 from fastapi import APIRouter, Request, Response, status
 from fastapi.responses import JSONResponse
-from sql import selectQuery, insertQuery, executeTransaction
-from globals import get_cache, set_cache
-import simplejson as json
+from sql import read_from_primary, transaction
+from globals import (
+    bump_versions,
+    set_cache,
+    response_encoder,
+    load_cached_response,
+    send_response,
+    checkpoint_config,
+    pin_player,
+)
+from checkpoints import pack
+from leaderboards import record_run
+from tracing import TracedRoute
 import time, surftimer.queries
 from typing import List
 from models import *
 
 
-router = APIRouter()
+router = APIRouter(route_class=TracedRoute)
+
+
+def checkpoint_queries(data: CurrentRun, maptime_id: int) -> list:
+    """Queries writing the run's checkpoints in the configured storage, see `checkpoints.py`"""
+    if checkpoint_config["STORAGE"] == "packed":
+        # All checkpoints in one statement
+        return [
+            surftimer.queries.sql_insertPackedCheckpoints.format(
+                maptime_id, len(data.checkpoints), pack(data.checkpoints).hex()
+            )
+        ]
+    return [
+        surftimer.queries.sql_insertCheckpoint.format(
+            maptime_id,
+            checkpoint.cp,
+            checkpoint.run_time,
+            checkpoint.start_vel_x,
+            checkpoint.start_vel_y,
+            checkpoint.start_vel_z,
+            checkpoint.end_vel_x,
+            checkpoint.end_vel_y,
+            checkpoint.end_vel_z,
+            checkpoint.attempts,
+            checkpoint.end_touch,
+        )
+        for checkpoint in data.checkpoints
+    ]
+
+
+# `PlayerSummary` columns changed by a save, completions and records per run type
+SUMMARY_COMPLETIONS = {0: "maps", 1: "bonuses", 2: "stages"}
+SUMMARY_RECORDS = {0: "records", 1: "bonus_records", 2: "stage_records"}
+SUMMARY_COLUMNS = (
+    "maps",
+    "stages",
+    "bonuses",
+    "top10",
+    "records",
+    "stage_records",
+    "bonus_records",
+)
+
+
+def top_players(trx, data: CurrentRun, type: int, stage: int) -> list:
+    """`player_id` of the top 10 map runs or the stage/bonus record holder, read and locked in the save's
+    transaction before and after the insert
+    """
+    return [
+        row["player_id"]
+        for row in trx.select(
+            surftimer.queries.sql_getTopPlayers.format(
+                data.map_id, data.style, type, stage, 10 if type == 0 else 1
+            )
+        )
+    ]
+
+
+def update_player_summary(
+    trx, data: CurrentRun, type: int, row_count: int, before: list, after: list
+) -> list:
+    """Adds a save to `PlayerSummary` in the save's transaction: a completion for a new run, the players that
+    entered or left the top 10 and the record changing hands\n
+    Returns the `steam_id` of every player whose summary changed
+    """
+    deltas = {}
+
+    def add(player_id: int, column: str, value: int):
+        deltas.setdefault(player_id, dict.fromkeys(SUMMARY_COLUMNS, 0))[column] += value
+
+    if row_count == 1 and type in SUMMARY_COMPLETIONS:
+        add(data.player_id, SUMMARY_COMPLETIONS[type], 1)
+    if type == 0:
+        for player_id in set(after) - set(before):
+            add(player_id, "top10", 1)
+        for player_id in set(before) - set(after):
+            add(player_id, "top10", -1)
+    if type in SUMMARY_RECORDS and before[:1] != after[:1]:
+        for player_id in before[:1]:
+            add(player_id, SUMMARY_RECORDS[type], -1)
+        for player_id in after[:1]:
+            add(player_id, SUMMARY_RECORDS[type], 1)
+
+    changed = [
+        player_id for player_id, columns in deltas.items() if any(columns.values())
+    ]
+    if not changed:
+        return []
+    trx.execute(
+        [
+            surftimer.queries.sql_updatePlayerSummary.format(
+                player_id,
+                data.style,
+                *(deltas[player_id][column] for column in SUMMARY_COLUMNS),
+                data.map_id,
+            )
+            for player_id in changed
+        ]
+    )
+    return [
+        row["steam_id"]
+        for row in trx.select(
+            surftimer.queries.sql_getSteamIds.format(", ".join(map(str, changed)))
+        )
+    ]
+
+
+def save_run(data: CurrentRun, type: int, stage: int) -> tuple:
+    """Inserts or updates the run, its checkpoints (map runs only), the `MapRecords` row of its
+    map/style/type/stage and the `PlayerSummary` changes in one transaction, a failed step leaves none of them
+    behind\n
+    Returns `(row_count, maptime_id, checkpoint row counts)`, `row_count` of `sql_insertMapTime` is 1 for a
+    new run, 2 for an updated one and 0 when nothing changed
+    """
+    summaries = []
+    with transaction() as trx:
+        top_before = top_players(trx, data, type, stage)
+        row_count, last_inserted_id = trx.insert(
+            surftimer.queries.sql_insertMapTime.format(
+                data.player_id,
+                data.map_id,
+                data.style,
+                type,
+                stage,
+                data.run_time,
+                data.start_vel_x,
+                data.start_vel_y,
+                data.start_vel_z,
+                data.end_vel_x,
+                data.end_vel_y,
+                data.end_vel_z,
+                data.run_date,
+                data.replay_frames,
+            )
+        )
+
+        # Now we have the `maptime_id` here we will add the checkpoints
+        checkpoints = None
+        if data.checkpoints is not None and type == 0:
+            # An older copy in the other storage would come back with `migrate_checkpoints.py`
+            stale = (
+                surftimer.queries.sql_deleteCheckpoints
+                if checkpoint_config["STORAGE"] == "packed"
+                else surftimer.queries.sql_deletePackedCheckpoints
+            )
+            trx.execute([stale.format(last_inserted_id)])
+            checkpoints = trx.execute(checkpoint_queries(data, last_inserted_id))
+
+        if row_count >= 1:
+            # Only new runs are completions
+            trx.execute(
+                [
+                    surftimer.queries.sql_updateMapRecord.format(
+                        1 if row_count == 1 else 0, data.map_id, data.style, type, stage
+                    )
+                ]
+            )
+            summaries = update_player_summary(
+                trx,
+                data,
+                type,
+                row_count,
+                top_before,
+                top_players(trx, data, type, stage),
+            )
+
+    # Bump the versions so cached summaries of the players in the deltas change, after the commit
+    bump_versions(*(f"summary:{steam_id}" for steam_id in summaries))
+    return row_count, last_inserted_id, checkpoints
 
 
 @router.post(
@@ -30,6 +208,10 @@ async def saveMapTime(
     `run_date` value is automatically populated from the API as UNIX timestamp
     """
     tic = time.perf_counter()
+    encoder = response_encoder(request)
+
+    # Anything the request reads after the save has to see the run
+    read_from_primary()
 
     # print(
     #     f"Sending CurrentRun:\n"
@@ -48,50 +230,7 @@ async def saveMapTime(
 
     # return data
 
-    xquery = insertQuery(
-        surftimer.queries.sql_insertMapTime.format(
-            data.player_id,
-            data.map_id,
-            data.style,
-            # 0,  # Hardcoding type = 0 to signify that this is a Map Run Time
-            data.type,  # Hardcoding type = 0 to signify that this is a Map Run Time
-            data.stage,
-            data.run_time,
-            data.start_vel_x,
-            data.start_vel_y,
-            data.start_vel_z,
-            data.end_vel_x,
-            data.end_vel_y,
-            data.end_vel_z,
-            data.run_date,
-            data.replay_frames,
-        )
-    )
-    row_count, last_inserted_id = xquery
-
-    # Now we have the `maptime_id` here we will add the checkpoints
-    trx = None
-    if data.checkpoints is not None and data.type == 0:
-        checkpoint_queries = []
-        for checkpoint in data.checkpoints:
-            cpquery = surftimer.queries.sql_insertCheckpoint.format(
-                last_inserted_id,
-                checkpoint.cp,
-                checkpoint.run_time,
-                checkpoint.start_vel_x,
-                checkpoint.start_vel_y,
-                checkpoint.start_vel_z,
-                checkpoint.end_vel_x,
-                checkpoint.end_vel_y,
-                checkpoint.end_vel_z,
-                checkpoint.attempts,
-                checkpoint.end_touch,
-            )
-
-            checkpoint_queries.append(cpquery)
-
-        # Start the transaction with all checkpoints
-        trx = executeTransaction(checkpoint_queries)
+    row_count, last_inserted_id, trx = save_run(data, data.type, data.stage)
 
     content_data = PostResponseData(
         inserted=row_count,
@@ -104,14 +243,21 @@ async def saveMapTime(
         response.status_code = status.HTTP_304_NOT_MODIFIED
         return response
 
-    # Prepare the response
-    toc = time.perf_counter()
-    print(f"Execution time {toc - tic:0.4f}")
+    # Bump the versions so cached entries and `ETag`s depending on this data change
+    record_run(
+        data.map_id, data.style, data.type, data.stage, last_inserted_id, data.run_time
+    )
+    bump_versions("maptimes", f"checkpoints:{last_inserted_id}")
+    pin_player(data.player_id)
 
-    response.headers["content-type"] = "application/json"
-    response.body = json.dumps(content_data.model_dump()).encode("utf-8")
-    response.status_code = status.HTTP_201_CREATED
-    return response
+    # Prepare the response
+    return await send_response(
+        request,
+        response,
+        encoder.dumps(content_data.model_dump()),
+        encoder,
+        status_code=status.HTTP_201_CREATED,
+    )
 
 
 @router.post(
@@ -131,29 +277,15 @@ async def saveStageTime(
     `checkpoints` value is **NOT** required here
     """
     tic = time.perf_counter()
+    encoder = response_encoder(request)
+
+    # Anything the request reads after the save has to see the run
+    read_from_primary()
 
     # print(data)
     # return data
 
-    xquery = insertQuery(
-        surftimer.queries.sql_insertMapTime.format(
-            data.player_id,
-            data.map_id,
-            data.style,
-            2,  # Hardcoding type = 2 to signify that this is a Stage Run Time
-            data.stage,
-            data.run_time,
-            data.start_vel_x,
-            data.start_vel_y,
-            data.start_vel_z,
-            data.end_vel_x,
-            data.end_vel_y,
-            data.end_vel_z,
-            data.run_date,
-            data.replay_frames,
-        )
-    )
-    row_count, last_inserted_id = xquery
+    row_count, last_inserted_id, _ = save_run(data, 2, data.stage)
 
     content_data = PostResponseData(
         inserted=row_count, xtime=time.perf_counter() - tic, last_id=last_inserted_id
@@ -163,14 +295,19 @@ async def saveStageTime(
         response.status_code = status.HTTP_304_NOT_MODIFIED
         return response
 
-    # Prepare the response
-    toc = time.perf_counter()
-    print(f"Execution time {toc - tic:0.4f}")
+    # Bump the versions so cached entries and `ETag`s depending on this data change
+    record_run(data.map_id, data.style, 2, data.stage, last_inserted_id, data.run_time)
+    bump_versions("maptimes")
+    pin_player(data.player_id)
 
-    response.headers["content-type"] = "application/json"
-    response.body = json.dumps(content_data.model_dump()).encode("utf-8")
-    response.status_code = status.HTTP_201_CREATED
-    return response
+    # Prepare the response
+    return await send_response(
+        request,
+        response,
+        encoder.dumps(content_data.model_dump()),
+        encoder,
+        status_code=status.HTTP_201_CREATED,
+    )
 
 
 @router.post(
@@ -190,29 +327,15 @@ async def saveBonusTime(
     `checkpoints` value is **NOT** required here
     """
     tic = time.perf_counter()
+    encoder = response_encoder(request)
+
+    # Anything the request reads after the save has to see the run
+    read_from_primary()
 
     # print(data)
     # return data
 
-    xquery = insertQuery(
-        surftimer.queries.sql_insertMapTime.format(
-            data.player_id,
-            data.map_id,
-            data.style,
-            1,  # Hardcoding type = 1 to signify that this is a Bonus Run Time
-            data.stage,  # This represents the bonus number
-            data.run_time,
-            data.start_vel_x,
-            data.start_vel_y,
-            data.start_vel_z,
-            data.end_vel_x,
-            data.end_vel_y,
-            data.end_vel_z,
-            data.run_date,
-            data.replay_frames,
-        )
-    )
-    row_count, last_inserted_id = xquery
+    row_count, last_inserted_id, _ = save_run(data, 1, data.stage)
 
     content_data = PostResponseData(
         inserted=row_count, xtime=time.perf_counter() - tic, last_id=last_inserted_id
@@ -222,11 +345,16 @@ async def saveBonusTime(
         response.status_code = status.HTTP_304_NOT_MODIFIED
         return response
 
-    # Prepare the response
-    toc = time.perf_counter()
-    print(f"Execution time {toc - tic:0.4f}")
+    # Bump the versions so cached entries and `ETag`s depending on this data change
+    record_run(data.map_id, data.style, 1, data.stage, last_inserted_id, data.run_time)
+    bump_versions("maptimes")
+    pin_player(data.player_id)
 
-    response.headers["content-type"] = "application/json"
-    response.body = json.dumps(content_data.model_dump()).encode("utf-8")
-    response.status_code = status.HTTP_201_CREATED
-    return response
+    # Prepare the response
+    return await send_response(
+        request,
+        response,
+        encoder.dumps(content_data.model_dump()),
+        encoder,
+        status_code=status.HTTP_201_CREATED,
+    )
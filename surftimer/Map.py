@@ -1,14 +1,27 @@
-from fastapi import APIRouter, Request, Response, status
+from fastapi import APIRouter, Query, Request, Response, status
 from fastapi.responses import JSONResponse
-from sql import selectQuery, insertQuery
-from globals import get_cache, set_cache
-import simplejson as json
+from sql import selectQuery, insertQuery, executeTransaction
+from globals import (
+    bump_versions,
+    versioned_cache_key,
+    set_cache,
+    response_encoder,
+    load_cached_response,
+    send_response,
+    send_stream,
+    leaderboard_config,
+)
+from leaderboards import get_board
+from checkpoint_storage import get_checkpoint_arrays, get_checkpoints
+from splits import compare
+from tracing import TracedRoute
+import write_buffer
 import time, datetime, surftimer.queries
 from models import *
 from typing import List, Dict, Any
 
 
-router = APIRouter()
+router = APIRouter(route_class=TracedRoute)
 
 
 @router.get(
@@ -28,37 +41,28 @@ async def selectMapInfo(
         GetMapInfoAsync
     ```
     """
-    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     # Check if data is cached in Redis
-    cache_key = f"selectMapInfo:{mapname}"
-    cached_data = get_cache(cache_key)
-    if cached_data is not None:
-        print(f"[Redis] Loaded '{cache_key}' ({time.perf_counter() - tic:0.4f}s)")
-        response.headers["content-type"] = "application/json"
-        response.status_code = status.HTTP_200_OK
-        response.body = json.loads(cached_data, use_decimal=True, parse_nan=True)
-        return response
+    cache_key = versioned_cache_key(f"selectMapInfo:{mapname}", f"mapinfo:{mapname}")
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
 
     xquery = selectQuery(surftimer.queries.sql_getMapInfo.format(mapname))
 
     if xquery:
-        xquery = xquery.pop()
+        # Map loads of this worker that are not flushed yet
+        xquery = write_buffer.map_row(xquery.pop())
     else:
         response.headers["content-type"] = "application/json"
         response.status_code = status.HTTP_204_NO_CONTENT
         return response
 
-    # Cache the data in Redis
-    set_cache(cache_key, xquery)
-
-    toc = time.perf_counter()
-
-    print(f"Execution time {toc - tic:0.4f}")
+    # Cache the data in Redis, the row is sent as it is, `MapInfoModel` only documents it
+    cached_data = set_cache(cache_key, xquery, encoder)
 
-    response_data = MapInfoModel(**xquery).model_dump()
-
-    return JSONResponse(content=response_data)
+    return await send_response(request, response, cached_data, encoder, cache_key)
 
 
 @router.post(
@@ -80,6 +84,7 @@ async def insertMap(
     `date_added` and `last_played` values are automatically populated from the API as UNIX timestamps
     """
     tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     xquery = insertQuery(
         surftimer.queries.sql_insertMap.format(
@@ -103,14 +108,17 @@ async def insertMap(
         response.status_code = status.HTTP_304_NOT_MODIFIED
         return response
 
-    # Prepare the response
-    toc = time.perf_counter()
-    print(f"Execution time {toc - tic:0.4f}")
+    # Bump the versions so cached entries and `ETag`s depending on this data change
+    bump_versions(f"mapinfo:{data.name}")
 
-    response.headers["content-type"] = "application/json"
-    response.body = json.dumps(content_data.model_dump()).encode("utf-8")
-    response.status_code = status.HTTP_201_CREATED
-    return response
+    # Prepare the response
+    return await send_response(
+        request,
+        response,
+        encoder.dumps(content_data.model_dump()),
+        encoder,
+        status_code=status.HTTP_201_CREATED,
+    )
 
 
 @router.put(
@@ -131,21 +139,33 @@ async def updateMapTier(
         UpdateMapInfoAsync
     ```
     `last_played` value is automatically populated from the API as UNIX timestamp.\n
+    The update is written with the next flush (`write_buffer.py`), `inserted` is 1 once it is queued
     """
     tic = time.perf_counter()
+    encoder = response_encoder(request)
 
-    xquery = insertQuery(
-        surftimer.queries.sql_updateMap.format(
-            data.last_played,
-            data.stages,
-            data.bonuses,
-            data.author,
-            data.tier,
-            data.ranked,
-            data.id,
+    if data.id is None:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"message": "`id` is required"},
         )
-    )
-    row_count, last_inserted_id = xquery
+
+    if write_buffer.enabled():
+        write_buffer.update_map(data)
+        row_count, last_inserted_id = 1, 0
+    else:
+        xquery = insertQuery(
+            surftimer.queries.sql_updateMap.format(
+                data.last_played,
+                data.stages,
+                data.bonuses,
+                data.author,
+                data.tier,
+                data.ranked,
+                data.id,
+            )
+        )
+        row_count, last_inserted_id = xquery
 
     content_data = PostResponseData(
         inserted=row_count, xtime=time.perf_counter() - tic, last_id=last_inserted_id
@@ -156,14 +176,17 @@ async def updateMapTier(
         response.status_code = status.HTTP_304_NOT_MODIFIED
         return response
 
-    # Prepare the response
-    toc = time.perf_counter()
-    print(f"Execution time {toc - tic:0.4f}")
+    # Bump the versions so cached entries and `ETag`s depending on this data change
+    bump_versions(f"mapinfo:{data.name}")
 
-    response.body = json.dumps(content_data.model_dump()).encode("utf-8")
-    response.headers["content-type"] = "application/json"
-    response.status_code = status.HTTP_200_OK
-    return response
+    # Prepare the response
+    return await send_response(
+        request,
+        response,
+        encoder.dumps(content_data.model_dump()),
+        encoder,
+        status_code=status.HTTP_200_OK,
+    )
 
 
 @router.get(
@@ -184,18 +207,17 @@ async def selectMapRunsData(
     ```
         GetMapRecordRunsAsync
     ```
+    The record run of every style, type and stage with `total_count` runs, read from `MapRecords`
     """
-    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     # Check if data is cached in Redis
-    cache_key = f"selectMapRunsData:{id}"
-    cached_data = get_cache(cache_key)
-    if cached_data is not None:
-        print(f"[Redis] Loaded '{cache_key}' ({time.perf_counter() - tic:0.4f}s)")
-        response.headers["content-type"] = "application/json"
-        response.status_code = status.HTTP_200_OK
-        response.body = json.loads(cached_data, use_decimal=True, parse_nan=True)
-        return response
+    cache_key = versioned_cache_key(
+        f"selectMapRunsData:{id}", f"maptimes:{id}", "records"
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
 
     # xquery = selectQuery(surftimer.queries.sql_getMapRunsData.format(id, style, type))
     xquery = selectQuery(surftimer.queries.sql_getMapRunsData.format(id))
@@ -205,11 +227,185 @@ async def selectMapRunsData(
         return response
 
     # Cache the data in Redis
-    set_cache(cache_key, xquery)
+    cached_data = set_cache(cache_key, xquery, encoder)
+
+    return await send_response(request, response, cached_data, encoder, cache_key)
+
+
+@router.get(
+    "/surftimer/stagerecords",
+    name="Get Stage and Bonus Records",
+    tags=["Map"],
+    summary="The top **top** runs and the number of runs of every stage and bonus for the given **MapID** and **Style** combo.",
+    response_model=StageRecords,
+)
+async def selectStageRecords(
+    request: Request,
+    response: Response,
+    map_id: int,
+    style: int = 0,
+    top: int = Query(1, ge=1, le=leaderboard_config["MAX_STAGE_TOP"]),
+):
+    """
+    Replaces calling `/surftimer/getstagerunbyrank` and `/surftimer/getbonusrunbyrank` with `rank=1` for every stage,
+    all stages and bonuses come from one query and are cached as a single entry
+    """
+    encoder = response_encoder(request)
+
+    # Check if data is cached in Redis
+    cache_key = versioned_cache_key(
+        f"selectStageRecords:{map_id}-{style}-{top}", f"maptimes:{map_id}", "records"
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
+
+    xquery = selectQuery(
+        surftimer.queries.sql_getStageRecords.format(top, map_id, style)
+    )
+
+    if not xquery:
+        response.headers["content-type"] = "application/json"
+        response.status_code = status.HTTP_204_NO_CONTENT
+        return response
+
+    # Rows are ordered by type, stage and run_time, group them per stage and bonus
+    groups = {}
+    for run in xquery:
+        group = groups.get((run["type"], run["stage"]))
+        if group is None:
+            group = {
+                "stage": run["stage"],
+                "completions": run["completions"],
+                "runs": [],
+            }
+            groups[(run["type"], run["stage"])] = group
+        del run["completions"]
+        run["position"] = len(group["runs"]) + 1
+        group["runs"].append(run)
+
+    response_data = {
+        "stages": [group for (type, _), group in groups.items() if type == 2],
+        "bonuses": [group for (type, _), group in groups.items() if type == 1],
+    }
+
+    # Cache the data in Redis
+    cached_data = set_cache(cache_key, response_data, encoder)
+
+    return await send_response(request, response, cached_data, encoder, cache_key)
+
+
+# Quantiles returned by `/surftimer/mapdistribution`
+DISTRIBUTION_QUANTILES = (0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99)
+
+
+@router.get(
+    "/surftimer/mapdistribution",
+    name="Get Run Time Distribution",
+    tags=["Map"],
+    summary="Run time quantiles, a histogram and the player's percentile for the given **MapID**, **Style**, **Type** and **Stage** combo.",
+    response_model=RunDistribution,
+)
+async def selectRunDistribution(
+    request: Request,
+    response: Response,
+    map_id: int,
+    style: int = 0,
+    type: int = 0,
+    stage: int = 0,
+    buckets: int = Query(20, ge=1, le=leaderboard_config["MAX_BUCKETS"]),
+    upper: float = Query(0.99, gt=0, le=1),
+    player_id: int = None,
+):
+    """
+    Computed from the in-memory board (`leaderboards.py`) instead of `/surftimer/maptotals`.\n
+    The histogram goes from the fastest run to the run time at quantile `upper` so a few AFK runs don't
+    squash every bucket, slower runs are counted in `overflow`.
+    """
+    encoder = response_encoder(request)
+
+    # Check if data is cached in Redis
+    cache_key = versioned_cache_key(
+        f"selectRunDistribution:{map_id}-{style}-{type}-{stage}-{buckets}-{upper}-{player_id}",
+        f"maptimes:{map_id}",
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
+
+    board = get_board(map_id, style, type, stage)
+    if not len(board):
+        response.headers["content-type"] = "application/json"
+        response.status_code = status.HTTP_204_NO_CONTENT
+        return response
+
+    response_data = board.distribution(DISTRIBUTION_QUANTILES, buckets, upper)
+    if player_id is not None:
+        run = selectQuery(
+            surftimer.queries.sql_getPlayerRun.format(
+                player_id, map_id, style, type, stage
+            )
+        )
+        if run:
+            rank = board.rank(run[0]["run_time"])
+            response_data["player"] = {
+                "player_id": player_id,
+                "run_time": run[0]["run_time"],
+                "rank": rank,
+                "percentile": round(rank / len(board) * 100, 2),
+            }
+
+    # Cache the data in Redis
+    cached_data = set_cache(cache_key, response_data, encoder)
+
+    return await send_response(request, response, cached_data, encoder, cache_key)
+
+
+@router.post(
+    "/surftimer/rebuildrecords",
+    name="Rebuild Map Records",
+    tags=["Map"],
+    response_model=PostResponseData,
+    summary="Rebuilds `MapRecords` from `MapTimes` for the given **MapID** or every map.",
+)
+async def rebuildMapRecords(
+    request: Request,
+    response: Response,
+    map_id: int = None,
+):
+    """
+    Only needed after creating `MapRecords` on an existing database or changing `MapTimes` by hand,
+    the save endpoints keep it up to date
+    """
+    tic = time.perf_counter()
+    encoder = response_encoder(request)
+
+    condition = f"`map_id` = {map_id}" if map_id is not None else "TRUE"
+    row_counts = executeTransaction(
+        [
+            surftimer.queries.sql_deleteMapRecords.format(condition),
+            surftimer.queries.sql_rebuildMapRecords.format(condition),
+        ]
+    )
+
+    content_data = PostResponseData(
+        inserted=row_counts[-1], xtime=time.perf_counter() - tic, trx=row_counts
+    )
 
-    toc = time.perf_counter()
-    print(f"Execution time {toc - tic:0.4f}")
-    return xquery
+    # Bump the versions so cached entries and `ETag`s depending on this data change
+    if map_id is not None:
+        bump_versions(f"maptimes:{map_id}")
+    else:
+        bump_versions("records")
+
+    # Prepare the response
+    return await send_response(
+        request,
+        response,
+        encoder.dumps(content_data.model_dump()),
+        encoder,
+        status_code=status.HTTP_200_OK,
+    )
 
 
 @router.get(
@@ -217,6 +413,7 @@ async def selectMapRunsData(
     name="Get Map Record and Totals",
     tags=["Map"],
     summary="All map records and totals for the given **MapID** and **Style** combo.",
+    deprecated=True,
 )
 async def selectMapRecordAndTotals(
     request: Request,
@@ -225,22 +422,69 @@ async def selectMapRecordAndTotals(
     style: int = 0,
 ):
     """
-    ***NOT USED*** in plugin
+    ***NOT USED*** in plugin\n
+    Sends every run of the map, use `/surftimer/leaderboard` and `/surftimer/leaderboardtotals` instead.
+    The runs are streamed from the database and not cached
     """
-    tic = time.perf_counter()
+    encoder = response_encoder(request)
+
+    cache_key = versioned_cache_key(
+        f"selectMapRecordAndTotals:{map_id}-{style}", f"maptimes:{map_id}"
+    )
+
+    return await send_stream(
+        request,
+        response,
+        surftimer.queries.sql_getMapRecordAndTotals.format(map_id, style),
+        encoder,
+        cache_key,
+    )
+
+
+@router.get(
+    "/surftimer/leaderboard",
+    name="Get Leaderboard Page",
+    tags=["Map"],
+    summary="One page of the leaderboard for the given **MapID**, **Style**, **Type** and **Stage** combo.",
+    response_model=LeaderboardPage,
+)
+async def selectLeaderboardPage(
+    request: Request,
+    response: Response,
+    map_id: int,
+    style: int = 0,
+    type: int = 0,
+    stage: int = 0,
+    cursor: str = Query(None, pattern=r"^-?\d+\.\d+\.\d+$"),
+    limit: int = Query(
+        leaderboard_config["PAGE_SIZE"], ge=1, le=leaderboard_config["MAX_PAGE_SIZE"]
+    ),
+):
+    """
+    Runs ordered by `run_time`, send the `next_cursor` of a page as `cursor` to get the next one.\n
+    `replay_frames` are not included, totals are in `/surftimer/leaderboardtotals`
+    """
+    encoder = response_encoder(request)
 
     # Check if data is cached in Redis
-    cache_key = f"selectMapRecordAndTotals:{map_id}-{style}"
-    cached_data = get_cache(cache_key)
-    if cached_data is not None:
-        print(f"[Redis] Loaded '{cache_key}' ({time.perf_counter() - tic:0.4f}s)")
-        response.headers["content-type"] = "application/json"
-        response.status_code = status.HTTP_200_OK
-        response.body = json.loads(cached_data, use_decimal=True, parse_nan=True)
-        return response
+    cache_key = versioned_cache_key(
+        f"selectLeaderboardPage:{map_id}-{style}-{type}-{stage}-{cursor}-{limit}",
+        f"maptimes:{map_id}",
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
+
+    # The cursor is `run_time.id.position` of the last run on the previous page
+    after_time, after_id, position = (
+        map(int, cursor.split(".")) if cursor else (-1, 0, 0)
+    )
 
+    # One run more than the page to know if there is a next page
     xquery = selectQuery(
-        surftimer.queries.sql_getMapRecordAndTotals.format(map_id, style)
+        surftimer.queries.sql_getLeaderboardPage.format(
+            map_id, style, type, stage, after_time, after_time, after_id, limit + 1
+        )
     )
 
     if not xquery:
@@ -248,14 +492,86 @@ async def selectMapRecordAndTotals(
         response.status_code = status.HTTP_204_NO_CONTENT
         return response
 
+    runs = xquery[:limit]
+    for run in runs:
+        position += 1
+        run["position"] = position
+
+    next_cursor = None
+    if len(xquery) > limit:
+        next_cursor = f"{runs[-1]['run_time']}.{runs[-1]['id']}.{position}"
+
+    # Cache the data in Redis
+    cached_data = set_cache(
+        cache_key, {"runs": runs, "next_cursor": next_cursor}, encoder
+    )
+
+    return await send_response(request, response, cached_data, encoder, cache_key)
+
+
+@router.get(
+    "/surftimer/leaderboardtotals",
+    name="Get Leaderboard Totals",
+    tags=["Map"],
+    summary="Number of runs and the record time for the given **MapID**, **Style**, **Type** and **Stage** combo.",
+    response_model=LeaderboardTotals,
+)
+async def selectLeaderboardTotals(
+    request: Request,
+    response: Response,
+    map_id: int,
+    style: int = 0,
+    type: int = 0,
+    stage: int = 0,
+):
+    encoder = response_encoder(request)
+
+    # Check if data is cached in Redis
+    cache_key = versioned_cache_key(
+        f"selectLeaderboardTotals:{map_id}-{style}-{type}-{stage}",
+        f"maptimes:{map_id}",
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
+
+    xquery = selectQuery(
+        surftimer.queries.sql_getLeaderboardTotals.format(map_id, style, type, stage)
+    )
+
     # Cache the data in Redis
-    set_cache(cache_key, xquery)
+    cached_data = set_cache(cache_key, xquery.pop(), encoder)
 
-    toc = time.perf_counter()
+    return await send_response(request, response, cached_data, encoder, cache_key)
 
-    print(f"Execution time {toc - tic:0.4f}")
 
-    return xquery
+@router.get(
+    "/surftimer/mapexport",
+    name="Export Map Runs",
+    tags=["Map"],
+    summary="Every run on the given **MapID** for all styles, types and stages, without `replay_frames`.",
+    response_model=List[LeaderboardRun],
+)
+async def selectMapExport(
+    request: Request,
+    response: Response,
+    map_id: int,
+):
+    """
+    Runs are ordered by `style`, `type`, `stage` and `run_time` and streamed from the database,
+    the response is never held in memory as a whole
+    """
+    encoder = response_encoder(request)
+
+    cache_key = versioned_cache_key(f"selectMapExport:{map_id}", f"maptimes:{map_id}")
+
+    return await send_stream(
+        request,
+        response,
+        surftimer.queries.sql_getMapExport.format(map_id),
+        encoder,
+        cache_key,
+    )
 
 
 @router.get(
@@ -275,19 +591,17 @@ async def selectMapCheckpointsData(
         LoadCheckpointsAsync
     ```
     """
-    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     # Check if data is cached in Redis
-    cache_key = f"selectMapCheckpointsData:{maptime_id}"
-    cached_data = get_cache(cache_key)
-    if cached_data is not None:
-        print(f"[Redis] Loaded '{cache_key}' ({time.perf_counter() - tic:0.4f}s)")
-        response.headers["content-type"] = "application/json"
-        response.status_code = status.HTTP_200_OK
-        response.body = json.loads(cached_data, use_decimal=True, parse_nan=True)
-        return response
+    cache_key = versioned_cache_key(
+        f"selectMapCheckpointsData:{maptime_id}", f"checkpoints:{maptime_id}"
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
 
-    xquery = selectQuery(surftimer.queries.sql_getMapCheckpointsData.format(maptime_id))
+    xquery = get_checkpoints([maptime_id]).get(maptime_id)
 
     if not xquery:
         response.headers["content-type"] = "application/json"
@@ -295,10 +609,121 @@ async def selectMapCheckpointsData(
         return response
 
     # Cache the data in Redis
-    set_cache(cache_key, xquery)
+    cached_data = set_cache(cache_key, xquery, encoder)
+
+    return await send_response(request, response, cached_data, encoder, cache_key)
 
-    toc = time.perf_counter()
 
-    print(f"Execution time {toc - tic:0.4f}")
+@router.get(
+    "/surftimer/checkpointsplits",
+    name="Get Checkpoint Splits",
+    tags=["Map", "Personal Best"],
+    summary="Checkpoint time and speed deltas of the given runs against the WR, a player's PB or the run at **target_rank** for the given **MapID** and **Style** combo.",
+    response_model=CheckpointSplits,
+)
+async def selectCheckpointSplits(
+    request: Request,
+    response: Response,
+    map_id: int,
+    style: int = 0,
+    maptime_id: List[int] = Query([]),
+    player_id: List[int] = Query([]),
+    target: str = Query("wr", pattern="^(wr|pb|rank)$"),
+    target_rank: int = Query(1, ge=1),
+    target_player_id: int = None,
+):
+    """
+    Runs are picked by `maptime_id` and/or `player_id`, both can be repeated to compare a batch of runs
+    against the same reference.\n
+    `target=wr` compares against the record, `target=rank` against the run at `target_rank` and `target=pb`
+    against the run of `target_player_id`.
+    """
+    encoder = response_encoder(request)
+
+    if (
+        not (maptime_id or player_id)
+        or len(maptime_id) + len(player_id) > leaderboard_config["MAX_SPLIT_RUNS"]
+    ):
+        response.headers["content-type"] = "application/json"
+        response.status_code = status.HTTP_204_NO_CONTENT
+        return response
+
+    # The reference run comes from the in-memory board, or the target player's run for `pb`
+    reference_id = None
+    if target == "pb":
+        if target_player_id is not None:
+            run = selectQuery(
+                surftimer.queries.sql_getPlayerRun.format(
+                    target_player_id, map_id, style, 0, 0
+                )
+            )
+            reference_id = run[0]["id"] if run else None
+    else:
+        board = get_board(map_id, style, 0, 0)
+        rank = target_rank if target == "rank" else 1
+        if rank <= len(board):
+            reference_id = board.ids[rank - 1]
+
+    if reference_id is None:
+        response.headers["content-type"] = "application/json"
+        response.status_code = status.HTTP_204_NO_CONTENT
+        return response
+
+    # Check if data is cached in Redis, one entry per reference run and set of compared runs
+    maptime_ids = sorted(set(maptime_id))
+    player_ids = sorted(set(player_id))
+    cache_key = versioned_cache_key(
+        f"selectCheckpointSplits:{reference_id}-{style}"
+        f"-{','.join(map(str, maptime_ids))}-{','.join(map(str, player_ids))}",
+        f"maptimes:{map_id}",
+        f"checkpoints:{reference_id}",
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
+
+    runs = selectQuery(
+        surftimer.queries.sql_getSplitRuns.format(
+            map_id,
+            style,
+            ", ".join(map(str, [*maptime_ids, reference_id])),
+            ", ".join(map(str, player_ids)) or "NULL",
+        )
+    )
+    runs_by_id = {run["id"]: run for run in runs}
+    reference = runs_by_id.get(reference_id)
+    compared = [
+        run
+        for run in runs
+        if run["id"] in maptime_ids or run["player_id"] in player_ids
+    ]
+
+    if reference is None or not compared:
+        response.headers["content-type"] = "application/json"
+        response.status_code = status.HTTP_204_NO_CONTENT
+        return response
+
+    checkpoints = get_checkpoint_arrays(list(runs_by_id))
+    reference_checkpoints = checkpoints.run(reference_id)
+    splits = compare(reference_checkpoints, checkpoints)
+
+    def run_splits(run: dict) -> dict:
+        return {
+            "id": run["id"],
+            "player_id": run["player_id"],
+            "run_time": run["run_time"],
+            "time_delta": run["run_time"] - reference["run_time"],
+            "checkpoints": splits.get(run["id"], []),
+        }
+
+    response_data = {
+        "reference": run_splits(reference),
+        "runs": [
+            run_splits(run) for run in sorted(compared, key=lambda run: run["run_time"])
+        ],
+    }
+
+    # Cache the data in Redis
+    cached_data = set_cache(cache_key, response_data, encoder)
 
-    return xquery
+    return await send_response(request, response, cached_data, encoder, cache_key)
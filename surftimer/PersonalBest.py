@@ -1,14 +1,21 @@
 from fastapi import APIRouter, Request, Response, status
 from fastapi.responses import JSONResponse
 from sql import selectQuery, insertQuery
-from globals import get_cache, set_cache
-import simplejson as json
+from globals import (
+    read_own_writes,
+    versioned_cache_key,
+    set_cache,
+    response_encoder,
+    load_cached_response,
+    send_response,
+)
+from tracing import TracedRoute
 import time, datetime, surftimer.queries
 from models import *
 from typing import List, Dict, Any
 
 
-router = APIRouter()
+router = APIRouter(route_class=TracedRoute)
 
 
 @router.get(
@@ -31,17 +38,18 @@ async def selectRunByPlayer(
         LoadPersonalBestRunAsync
     ```
     """
-    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     # Check if data is cached in Redis
-    cache_key = f"selectRunByPlayer:{player_id}-{map_id}-{type}-{style}"
-    cached_data = get_cache(cache_key)
-    if cached_data is not None:
-        print(f"[Redis] Loaded '{cache_key}' ({time.perf_counter() - tic:0.4f}s)")
-        response.headers["content-type"] = "application/json"
-        response.status_code = status.HTTP_200_OK
-        response.body = json.loads(cached_data, use_decimal=True, parse_nan=True)
-        return response
+    cache_key = versioned_cache_key(
+        f"selectRunByPlayer:{player_id}-{map_id}-{type}-{style}", f"maptimes:{map_id}"
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
+
+    # Reads of the player's own runs right after a save go to the primary
+    read_own_writes(player_id)
 
     xquery = selectQuery(
         surftimer.queries.sql_getRunByPlayer.format(player_id, map_id, type, style)
@@ -52,11 +60,9 @@ async def selectRunByPlayer(
         return response
 
     # Cache the data in Redis
-    set_cache(cache_key, xquery)
+    cached_data = set_cache(cache_key, xquery, encoder)
 
-    toc = time.perf_counter()
-    print(f"Execution time {toc - tic:0.4f}")
-    return xquery
+    return await send_response(request, response, cached_data, encoder, cache_key)
 
 
 @router.get(
@@ -76,17 +82,13 @@ async def selectRunById(
         LoadPersonalBestRunAsync
     ```
     """
-    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     # Check if data is cached in Redis
-    cache_key = f"selectRunById:{run_id}"
-    cached_data = get_cache(cache_key)
-    if cached_data is not None:
-        print(f"[Redis] Loaded '{cache_key}' ({time.perf_counter() - tic:0.4f}s)")
-        response.headers["content-type"] = "application/json"
-        response.status_code = status.HTTP_200_OK
-        response.body = json.loads(cached_data, use_decimal=True, parse_nan=True)
-        return response
+    cache_key = versioned_cache_key(f"selectRunById:{run_id}", "maptimes")
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
 
     xquery = selectQuery(surftimer.queries.sql_getRunById.format(run_id))
 
@@ -98,8 +100,6 @@ async def selectRunById(
         return response
 
     # Cache the data in Redis
-    set_cache(cache_key, xquery)
+    cached_data = set_cache(cache_key, xquery, encoder)
 
-    toc = time.perf_counter()
-    print(f"Execution time {toc - tic:0.4f}")
-    return xquery
+    return await send_response(request, response, cached_data, encoder, cache_key)
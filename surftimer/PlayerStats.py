@@ -1,12 +1,25 @@
-from fastapi import APIRouter, Request, Response, status
+from fastapi import APIRouter, Query, Request, Response, status
 from fastapi.responses import JSONResponse
-from sql import selectQuery, insertQuery
-from globals import get_cache, set_cache
+from sql import selectQuery, insertQuery, read_from_primary
+from globals import (
+    read_own_writes,
+    versioned_cache_key,
+    set_cache,
+    response_encoder,
+    load_cached_response,
+    send_response,
+    leaderboard_config,
+)
+from leaderboards import get_board
+from checkpoint_storage import get_checkpoints
+from points import get_points_board, recompute
+from models import LeaderboardSlice, PlayerPoints, PointsPage, PostResponseData
 from typing import List, Dict, Any
-import simplejson as json
+from starlette.concurrency import run_in_threadpool
+from tracing import TracedRoute
 import time, surftimer.queries
 
-router = APIRouter()
+router = APIRouter(route_class=TracedRoute)
 
 
 @router.get(
@@ -29,17 +42,18 @@ async def getPlayerMapData(
         GetPlayerMapTimesAsync
     ```
     """
-    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     # Check if data is cached in Redis
-    cache_key = f"getPlayerMapData:{player_id}-{map_id}"
-    cached_data = get_cache(cache_key)
-    if cached_data is not None:
-        print(f"[Redis] Loaded '{cache_key}' ({time.perf_counter() - tic:0.4f}s)")
-        response.headers["content-type"] = "application/json"
-        response.status_code = status.HTTP_200_OK
-        response.body = json.loads(cached_data, use_decimal=True, parse_nan=True)
-        return response
+    cache_key = versioned_cache_key(
+        f"getPlayerMapData:{player_id}-{map_id}", f"maptimes:{map_id}"
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
+
+    # Reads of the player's own runs right after a save go to the primary
+    read_own_writes(player_id)
 
     xquery = selectQuery(
         surftimer.queries.sql_getPlayerMapData.format(player_id, map_id)
@@ -51,23 +65,15 @@ async def getPlayerMapData(
         response.status_code = status.HTTP_204_NO_CONTENT
         return response
 
+    # Checkpoints of every run in one read per storage
+    checkpoints = get_checkpoints([item["id"] for item in xquery])
     for item in xquery:
-        # Execute query to fetch checkpoints using the id from the current item
-        checkpoints = selectQuery(
-            surftimer.queries.sql_getMapCheckpointsData.format(item["id"])
-        )
-
-        # Append checkpoints to the current item
-        item["checkpoints"] = checkpoints
+        item["checkpoints"] = checkpoints.get(item["id"], [])
 
     # Cache the data in Redis
-    set_cache(cache_key, xquery)
+    cached_data = set_cache(cache_key, xquery, encoder)
 
-    toc = time.perf_counter()
-
-    print(f"Execution time {toc - tic:0.4f}")
-
-    return xquery
+    return await send_response(request, response, cached_data, encoder, cache_key)
 
 
 @router.get(
@@ -93,17 +99,19 @@ async def getPlayerSpecificData(
     ## 1 = bonus time (`stage` signifies bonus number);
     ## 2 = stage time (`stage` signifies stage number);
     """
-    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     # Check if data is cached in Redis
-    cache_key = f"getPlayerSpecificData:{player_id}-{map_id}-{style}-{type}"
-    cached_data = get_cache(cache_key)
-    if cached_data is not None:
-        print(f"[Redis] Loaded '{cache_key}' ({time.perf_counter() - tic:0.4f}s)")
-        response.headers["content-type"] = "application/json"
-        response.status_code = status.HTTP_200_OK
-        response.body = json.loads(cached_data, use_decimal=True, parse_nan=True)
-        return response
+    cache_key = versioned_cache_key(
+        f"getPlayerSpecificData:{player_id}-{map_id}-{style}-{type}",
+        f"maptimes:{map_id}",
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
+
+    # Reads of the player's own runs right after a save go to the primary
+    read_own_writes(player_id)
 
     xquery = selectQuery(
         surftimer.queries.sql_getSpecificPlayerStatsData.format(
@@ -118,27 +126,15 @@ async def getPlayerSpecificData(
         return response
 
     if type == 0:
-        for (
-            item
-        ) in (
-            xquery
-        ):  # Technically we would only have one item in this list as a player can only have 1 entry for the `type` and `style` combo
-            # Execute query to fetch checkpoints using the id from the current item
-            checkpoints = selectQuery(
-                surftimer.queries.sql_getMapCheckpointsData.format(item["id"])
-            )
-
-            # Append checkpoints to the current item
-            item["checkpoints"] = checkpoints
+        # Technically we would only have one item in this list as a player can only have 1 entry for the `type` and `style` combo
+        checkpoints = get_checkpoints([item["id"] for item in xquery])
+        for item in xquery:
+            item["checkpoints"] = checkpoints.get(item["id"], [])
 
     # Cache the data in Redis
-    set_cache(cache_key, xquery)
-
-    toc = time.perf_counter()
+    cached_data = set_cache(cache_key, xquery, encoder)
 
-    print(f"Execution time {toc - tic:0.4f}")
-
-    return xquery
+    return await send_response(request, response, cached_data, encoder, cache_key)
 
 
 @router.get(
@@ -160,17 +156,15 @@ async def selectMapRunByRank(
 
     Gets the map run data for the specified rank on the specified map and style.
     """
-    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     # Check if data is cached in Redis
-    cache_key = f"selectMapRunByRank:{map_id}-{style}-0-0-{rank}"
-    cached_data = get_cache(cache_key)
-    if cached_data is not None:
-        print(f"[Redis] Loaded '{cache_key}' ({time.perf_counter() - tic:0.4f}s)")
-        response.headers["content-type"] = "application/json"
-        response.status_code = status.HTTP_200_OK
-        response.body = json.loads(cached_data, use_decimal=True, parse_nan=True)
-        return response
+    cache_key = versioned_cache_key(
+        f"selectMapRunByRank:{map_id}-{style}-0-0-{rank}", f"maptimes:{map_id}"
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
 
     xquery = selectQuery(
         surftimer.queries.sql_getDataByRank.format(map_id, style, 0, 0, rank)
@@ -181,28 +175,16 @@ async def selectMapRunByRank(
         response.status_code = status.HTTP_204_NO_CONTENT
         return response
     else:
-        for (
-            item
-        ) in (
-            xquery
-        ):  # Technically we would only have one item in this list as a player can only have 1 entry for the `type` and `style` combo
-            # Execute query to fetch checkpoints using the id from the current item
-            checkpoints = selectQuery(
-                surftimer.queries.sql_getMapCheckpointsData.format(item["id"])
-            )
-
-            # Append checkpoints to the current item
-            item["checkpoints"] = checkpoints
+        # Technically we would only have one item in this list as a player can only have 1 entry for the `type` and `style` combo
+        checkpoints = get_checkpoints([item["id"] for item in xquery])
+        for item in xquery:
+            item["checkpoints"] = checkpoints.get(item["id"], [])
         xquery = xquery.pop()
 
     # Cache the data in Redis
-    set_cache(cache_key, xquery)
-
-    toc = time.perf_counter()
+    cached_data = set_cache(cache_key, xquery, encoder)
 
-    print(f"Execution time {toc - tic:0.4f}")
-
-    return xquery
+    return await send_response(request, response, cached_data, encoder, cache_key)
 
 
 @router.get(
@@ -225,17 +207,15 @@ async def selectBonusRunByRank(
 
     Gets the bonus run data for the specified rank on the specified map and style.
     """
-    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     # Check if data is cached in Redis
-    cache_key = f"selectBonusRunByRank:{map_id}-{style}-1-{bonus}-{rank}"
-    cached_data = get_cache(cache_key)
-    if cached_data is not None:
-        print(f"[Redis] Loaded '{cache_key}' ({time.perf_counter() - tic:0.4f}s)")
-        response.headers["content-type"] = "application/json"
-        response.status_code = status.HTTP_200_OK
-        response.body = json.loads(cached_data, use_decimal=True, parse_nan=True)
-        return response
+    cache_key = versioned_cache_key(
+        f"selectBonusRunByRank:{map_id}-{style}-1-{bonus}-{rank}", f"maptimes:{map_id}"
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
 
     xquery = selectQuery(
         surftimer.queries.sql_getDataByRank.format(map_id, style, 1, bonus, rank)
@@ -249,13 +229,9 @@ async def selectBonusRunByRank(
         xquery = xquery.pop()
 
     # Cache the data in Redis
-    set_cache(cache_key, xquery)
-
-    toc = time.perf_counter()
+    cached_data = set_cache(cache_key, xquery, encoder)
 
-    print(f"Execution time {toc - tic:0.4f}")
-
-    return xquery
+    return await send_response(request, response, cached_data, encoder, cache_key)
 
 
 @router.get(
@@ -278,17 +254,15 @@ async def selectStageRunByRank(
 
     Gets the stage run data for the specified rank on the specified map and style.
     """
-    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     # Check if data is cached in Redis
-    cache_key = f"selectStageRunByRank:{map_id}-{style}-2-{stage}-{rank}"
-    cached_data = get_cache(cache_key)
-    if cached_data is not None:
-        print(f"[Redis] Loaded '{cache_key}' ({time.perf_counter() - tic:0.4f}s)")
-        response.headers["content-type"] = "application/json"
-        response.status_code = status.HTTP_200_OK
-        response.body = json.loads(cached_data, use_decimal=True, parse_nan=True)
-        return response
+    cache_key = versioned_cache_key(
+        f"selectStageRunByRank:{map_id}-{style}-2-{stage}-{rank}", f"maptimes:{map_id}"
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
 
     xquery = selectQuery(
         surftimer.queries.sql_getDataByRank.format(map_id, style, 2, stage, rank)
@@ -302,10 +276,219 @@ async def selectStageRunByRank(
         xquery = xquery.pop()
 
     # Cache the data in Redis
-    set_cache(cache_key, xquery)
+    cached_data = set_cache(cache_key, xquery, encoder)
+
+    return await send_response(request, response, cached_data, encoder, cache_key)
+
+
+@router.get(
+    "/surftimer/aroundme",
+    name="Get Runs Around Player",
+    tags=["Player Stats"],
+    summary="The player's rank and the runs `count` places above and below it for the given **MapID**, **Style**, **Type** and **Stage** combo.",
+    response_model=LeaderboardSlice,
+)
+async def selectRunsAroundPlayer(
+    request: Request,
+    response: Response,
+    player_id: int,
+    map_id: int,
+    style: int = 0,
+    type: int = 0,
+    stage: int = 0,
+    count: int = Query(5, ge=0, le=leaderboard_config["MAX_AROUND"]),
+):
+    """
+    For the `!rank` and `!top` views in game. Ranks come from an in-memory board (`leaderboards.py`)
+    so only the runs in the slice are read from MySQL.
+    """
+    encoder = response_encoder(request)
+
+    # Check if data is cached in Redis
+    cache_key = versioned_cache_key(
+        f"selectRunsAroundPlayer:{player_id}-{map_id}-{style}-{type}-{stage}-{count}",
+        f"maptimes:{map_id}",
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
+
+    # Reads of the player's own runs right after a save go to the primary
+    read_own_writes(player_id)
+
+    run = selectQuery(
+        surftimer.queries.sql_getPlayerRun.format(player_id, map_id, style, type, stage)
+    )
+    board = get_board(map_id, style, type, stage)
+    index = board.index(run[0]["run_time"], run[0]["id"]) if run else None
+
+    if index is None:
+        response.headers["content-type"] = "application/json"
+        response.status_code = status.HTTP_204_NO_CONTENT
+        return response
+
+    start, ids = board.around(index, count)
+    rows = selectQuery(
+        surftimer.queries.sql_getLeaderboardRuns.format(", ".join(map(str, ids)))
+    )
+    rows_by_id = {row["id"]: row for row in rows}
+
+    runs = []
+    for position, maptime_id in enumerate(ids, start=start + 1):
+        row = rows_by_id.get(maptime_id)
+        if row is not None:
+            row["position"] = position
+            runs.append(row)
+
+    # Cache the data in Redis
+    cached_data = set_cache(
+        cache_key,
+        {"rank": board.rank(run[0]["run_time"]), "total": len(board), "runs": runs},
+        encoder,
+    )
+
+    return await send_response(request, response, cached_data, encoder, cache_key)
+
+
+@router.get(
+    "/surftimer/playerpoints",
+    name="Get Player Points",
+    tags=["Player Stats"],
+    summary="The player's total points and global rank for the given **Style**.",
+    response_model=PlayerPoints,
+)
+async def selectPlayerPoints(
+    request: Request,
+    response: Response,
+    player_id: int,
+    style: int = 0,
+):
+    """
+    Points come from `PlayerPoints`, see `points.py` for how they are computed. The rank is a `bisect`
+    of the in-memory ranking of the style.
+    """
+    encoder = response_encoder(request)
+
+    # Check if data is cached in Redis
+    cache_key = versioned_cache_key(
+        f"selectPlayerPoints:{player_id}-{style}", f"points:{style}"
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
+
+    xquery = selectQuery(surftimer.queries.sql_getPlayerPoints.format(style, player_id))
+
+    if not xquery:
+        response.headers["content-type"] = "application/json"
+        response.status_code = status.HTTP_204_NO_CONTENT
+        return response
+
+    player = xquery[0]
+    player["rank"] = get_points_board(style).rank(player["points"])
+
+    # Cache the data in Redis
+    cached_data = set_cache(cache_key, player, encoder)
+
+    return await send_response(request, response, cached_data, encoder, cache_key)
+
+
+@router.get(
+    "/surftimer/pointsleaderboard",
+    name="Get Points Leaderboard",
+    tags=["Player Stats"],
+    summary="One page of the global ranking for the given **Style**.",
+    response_model=PointsPage,
+)
+async def selectPointsLeaderboard(
+    request: Request,
+    response: Response,
+    style: int = 0,
+    cursor: str = Query(None, pattern=r"^-?\d+\.\d+$"),
+    limit: int = Query(
+        leaderboard_config["PAGE_SIZE"], ge=1, le=leaderboard_config["MAX_PAGE_SIZE"]
+    ),
+):
+    """
+    Players ordered by points, send the `next_cursor` of a page as `cursor` to get the next one
+    """
+    encoder = response_encoder(request)
+
+    # Check if data is cached in Redis
+    cache_key = versioned_cache_key(
+        f"selectPointsLeaderboard:{style}-{cursor}-{limit}", f"points:{style}"
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
+
+    # The cursor is `points.player_id` of the last player on the previous page
+    after_points, after_id = map(int, cursor.split(".")) if cursor else (2**62, 0)
+
+    # One player more than the page to know if there is a next page
+    xquery = selectQuery(
+        surftimer.queries.sql_getPointsPage.format(
+            style, after_points, after_points, after_id, limit + 1
+        )
+    )
+
+    if not xquery:
+        response.headers["content-type"] = "application/json"
+        response.status_code = status.HTTP_204_NO_CONTENT
+        return response
+
+    board = get_points_board(style)
+    players = xquery[:limit]
+    for player in players:
+        player["rank"] = board.rank(player["points"])
+
+    next_cursor = None
+    if len(xquery) > limit:
+        next_cursor = f"{players[-1]['points']}.{players[-1]['player_id']}"
+
+    # Cache the data in Redis
+    cached_data = set_cache(
+        cache_key,
+        {"total": len(board), "players": players, "next_cursor": next_cursor},
+        encoder,
+    )
+
+    return await send_response(request, response, cached_data, encoder, cache_key)
+
+
+@router.post(
+    "/surftimer/recomputepoints",
+    name="Recompute Points",
+    tags=["Player Stats"],
+    response_model=PostResponseData,
+    summary="Recomputes the points of the maps with new runs, or of every map with **full**.",
+)
+async def recomputePoints(
+    request: Request,
+    response: Response,
+    full: bool = False,
+):
+    """
+    Meant to be called on a schedule, only maps with a map run saved since they were last computed are read.
+    Use `full=true` after changing a map's tier or the `POINTS` config. `inserted` is the number of recomputed maps.
+    """
+    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
-    toc = time.perf_counter()
+    # Runs in the threadpool, a full recompute reads every map run. Maps are marked as computed, so the runs
+    # are read from the primary and not from a replica that might miss the latest ones
+    read_from_primary()
+    result = await run_in_threadpool(recompute, full)
 
-    print(f"Execution time {toc - tic:0.4f}")
+    content_data = PostResponseData(
+        inserted=result["maps"], xtime=time.perf_counter() - tic
+    )
 
-    return xquery
+    # Prepare the response
+    return await send_response(
+        request,
+        response,
+        encoder.dumps(content_data.model_dump()),
+        encoder,
+        status_code=status.HTTP_200_OK,
+    )
@@ -1,13 +1,21 @@
 from fastapi import APIRouter, Request, Response, status
 from fastapi.responses import JSONResponse
-from sql import selectQuery, insertQuery
-from globals import get_cache, set_cache
-import simplejson as json
+from sql import selectQuery, insertQuery, executeTransaction
+from globals import (
+    bump_versions,
+    versioned_cache_key,
+    set_cache,
+    response_encoder,
+    load_cached_response,
+    send_response,
+)
+from tracing import TracedRoute
+import write_buffer
 import time, datetime, surftimer.queries
 from models import *
 
 
-router = APIRouter()
+router = APIRouter(route_class=TracedRoute)
 
 
 @router.get(
@@ -27,36 +35,123 @@ async def getPlayerProfileData(
         GetPlayerProfileAsync
     ```
     """
-    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     # Check if data is cached in Redis
-    cache_key = f"getPlayerProfileData:{steamid}"
-    cached_data = get_cache(cache_key)
-    if cached_data is not None:
-        print(f"[Redis] Loaded '{cache_key}' ({time.perf_counter() - tic:0.4f}s)")
-        response.headers["content-type"] = "application/json"
-        response.status_code = status.HTTP_200_OK
-        response.body = json.loads(cached_data, use_decimal=True, parse_nan=True)
-        return response
+    cache_key = versioned_cache_key(
+        f"getPlayerProfileData:{steamid}", f"player:{steamid}"
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
 
     xquery = selectQuery(surftimer.queries.sql_getPlayerProfileData.format(steamid))
 
     if xquery:
-        xquery = xquery.pop()
+        # Connects of this worker that are not flushed yet
+        xquery = write_buffer.player_row(xquery.pop())
     else:
         response.headers["content-type"] = "application/json"
         response.status_code = status.HTTP_204_NO_CONTENT
         return response
 
+    # Cache the data in Redis, the row is sent as it is, `PlayerSurfProfile` only documents it
+    cached_data = set_cache(cache_key, xquery, encoder)
+
+    return await send_response(request, response, cached_data, encoder, cache_key)
+
+
+@router.get(
+    "/surftimer/playersummary/{steamid}",
+    name="Get Player Summary",
+    tags=["Player Profile"],
+    summary="Completions, top 10 map runs and records per style and map tier",
+    response_model=PlayerSummary,
+)
+async def getPlayerSummary(
+    request: Request,
+    response: Response,
+    steamid: int,
+):
+    """
+    Read from `PlayerSummary`, kept up to date by the save endpoints so no runs are counted here
+    """
+    encoder = response_encoder(request)
+
+    # Check if data is cached in Redis
+    cache_key = versioned_cache_key(
+        f"getPlayerSummary:{steamid}", f"summary:{steamid}", "summaries"
+    )
+    cached_response = await load_cached_response(request, response, cache_key, encoder)
+    if cached_response is not None:
+        return cached_response
+
+    xquery = selectQuery(surftimer.queries.sql_getPlayerSummary.format(steamid))
+
+    if not xquery:
+        response.headers["content-type"] = "application/json"
+        response.status_code = status.HTTP_204_NO_CONTENT
+        return response
+
+    data = {
+        "player_id": xquery[0]["player_id"],
+        "name": xquery[0]["name"],
+        "tiers": [
+            {
+                key: value
+                for key, value in row.items()
+                if key not in ("player_id", "name")
+            }
+            for row in xquery
+        ],
+    }
+
     # Cache the data in Redis
-    set_cache(cache_key, xquery)
+    cached_data = set_cache(cache_key, data, encoder)
+
+    return await send_response(request, response, cached_data, encoder, cache_key)
+
 
-    toc = time.perf_counter()
+@router.post(
+    "/surftimer/rebuildsummaries",
+    name="Rebuild Player Summaries",
+    tags=["Player Profile"],
+    response_model=PostResponseData,
+    summary="Rebuilds `PlayerSummary` from `MapTimes` for every player.",
+)
+async def rebuildPlayerSummaries(
+    request: Request,
+    response: Response,
+):
+    """
+    Only needed after creating `PlayerSummary` on an existing database, changing a map's tier or `MapTimes` by hand,
+    the save endpoints keep it up to date
+    """
+    tic = time.perf_counter()
+    encoder = response_encoder(request)
 
-    print(f"Execution time {toc - tic:0.4f}")
+    row_counts = executeTransaction(
+        [
+            surftimer.queries.sql_deletePlayerSummaries,
+            surftimer.queries.sql_rebuildPlayerSummaries,
+        ]
+    )
 
-    response_data = PlayerSurfProfile(**xquery).model_dump()
-    return JSONResponse(content=response_data)
+    content_data = PostResponseData(
+        inserted=row_counts[-1], xtime=time.perf_counter() - tic, trx=row_counts
+    )
+
+    # Bump the versions so cached entries and `ETag`s depending on this data change
+    bump_versions("summaries")
+
+    # Prepare the response
+    return await send_response(
+        request,
+        response,
+        encoder.dumps(content_data.model_dump()),
+        encoder,
+        status_code=status.HTTP_200_OK,
+    )
 
 
 @router.post(
@@ -79,6 +174,7 @@ async def insertPlayer(
     `join_date` and `last_seen` values are automatically populated from the API as UNIX timestamps
     """
     tic = time.perf_counter()
+    encoder = response_encoder(request)
 
     xquery = insertQuery(
         surftimer.queries.sql_insertPlayerProfile.format(
@@ -100,14 +196,17 @@ async def insertPlayer(
         response.status_code = status.HTTP_304_NOT_MODIFIED
         return response
 
-    # Prepare the response
-    toc = time.perf_counter()
-    print(f"Execution time {toc - tic:0.4f}")
+    # Bump the versions so cached entries and `ETag`s depending on this data change
+    bump_versions(f"player:{data.steam_id}")
 
-    response.headers["content-type"] = "application/json"
-    response.body = json.dumps(content_data.model_dump()).encode("utf-8")
-    response.status_code = status.HTTP_201_CREATED
-    return response
+    # Prepare the response
+    return await send_response(
+        request,
+        response,
+        encoder.dumps(content_data.model_dump()),
+        encoder,
+        status_code=status.HTTP_201_CREATED,
+    )
 
 
 @router.put(
@@ -130,18 +229,25 @@ async def updatePlayerProfile(
     ```
 
     `last_played` value is automatically populated from the API as UNIX timestamp.\n
-    `id` is **required** here.
+    `id` is **required** here.\n
+    The update is merged with the other connects of the player and written with the next flush (`write_buffer.py`),
+    `inserted` is 1 once it is queued
     """
     tic = time.perf_counter()
+    encoder = response_encoder(request)
 
-    xquery = insertQuery(
-        surftimer.queries.sql_updatePlayerProfile.format(
-            data.country,
-            data.last_seen,
-            data.id,
+    if write_buffer.enabled():
+        write_buffer.update_player(data.id, data.steam_id, data.country, data.last_seen)
+        row_count, last_inserted_id = 1, 0
+    else:
+        xquery = insertQuery(
+            surftimer.queries.sql_updatePlayerProfile.format(
+                data.country,
+                data.last_seen,
+                data.id,
+            )
         )
-    )
-    row_count, last_inserted_id = xquery
+        row_count, last_inserted_id = xquery
 
     content_data = PostResponseData(
         inserted=row_count, xtime=time.perf_counter() - tic, last_id=last_inserted_id
@@ -152,11 +258,14 @@ async def updatePlayerProfile(
         response.status_code = status.HTTP_304_NOT_MODIFIED
         return response
 
-    # Prepare the response
-    toc = time.perf_counter()
-    print(f"Execution time {toc - tic:0.4f}")
+    # Bump the versions so cached entries and `ETag`s depending on this data change
+    bump_versions(f"player:{data.steam_id}")
 
-    response.body = json.dumps(content_data.model_dump()).encode("utf-8")
-    response.headers["content-type"] = "application/json"
-    response.status_code = status.HTTP_200_OK
-    return response
+    # Prepare the response
+    return await send_response(
+        request,
+        response,
+        encoder.dumps(content_data.model_dump()),
+        encoder,
+        status_code=status.HTTP_200_OK,
+    )
@@ -1,3 +1,17 @@
+class NamedQuery(str):
+    """A query string that remembers its name in this file, `sql.py` uses it to label the query metrics"""
+
+    name = "unnamed"
+
+    def __new__(cls, query: str, name: str):
+        self = super().__new__(cls, query)
+        self.name = name
+        return self
+
+    def format(self, *args, **kwargs):
+        return NamedQuery(super().format(*args, **kwargs), self.name)
+
+
 ############
 ## Map.cs ##
 ############
@@ -5,56 +19,168 @@ sql_getMapInfo = "SELECT * FROM Maps WHERE name='{}';"
 sql_insertMap = """INSERT INTO Maps (name, author, tier, stages, bonuses, ranked, date_added, last_played) 
                 VALUES ('{}', '{}', {}, {}, {}, {}, {}, {});"""
 sql_updateMap = """UPDATE Maps SET last_played={}, stages={}, bonuses={}, author='{}', tier={}, ranked={} WHERE id={};"""
-sql_getMapRunsData = """
-                            SELECT 
-                                ranked_times.*
-                            FROM (
-                                SELECT 
-                                    MapTimes.*,
-                                    Player.name,
-                                    ROW_NUMBER() OVER (
-                                        PARTITION BY MapTimes.type, MapTimes.stage 
-                                        ORDER BY MapTimes.run_time ASC
-                                    ) AS row_num,
-                                    COUNT(*) OVER (PARTITION BY MapTimes.type, MapTimes.stage) AS total_count
+# Pending `sql_updateMap` rows of `write_buffer.py`, one `SELECT` of `id` and the `sql_updateMap` columns per map joined by `UNION ALL`
+sql_flushMaps = """UPDATE `Maps` JOIN ({}) AS pending ON Maps.id = pending.id
+                            SET Maps.last_played = pending.last_played, Maps.stages = pending.stages,
+                            Maps.bonuses = pending.bonuses, Maps.author = pending.author, Maps.tier = pending.tier,
+                            Maps.ranked = pending.ranked;"""
+# Records come from `MapRecords`, one row per map/style/type/stage kept up to date by the save endpoints
+# `row_num` and `total_count` are kept for clients of the window query this replaced
+sql_getMapRunsData = """SELECT MapTimes.*, Player.name, 1 AS row_num, MapRecords.completions AS total_count
+                            FROM MapRecords
+                            JOIN MapTimes ON MapTimes.id = MapRecords.maptime_id
+                            JOIN Player ON MapTimes.player_id = Player.id
+                            WHERE MapRecords.map_id = {};"""
+# Top runs of every stage (type 2) and bonus (type 1) of a map, each group is read from the top of
+# `idx_maptimes_leaderboard` for the `MapRecords` rows of the map so only `top` runs per group are touched
+sql_getStageRecords = """SELECT top_runs.*, Player.name, MapRecords.completions
+                            FROM MapRecords
+                            JOIN LATERAL (
+                                SELECT MapTimes.id, MapTimes.player_id, MapTimes.map_id, MapTimes.style, MapTimes.type, MapTimes.stage,
+                                    MapTimes.run_time, MapTimes.start_vel_x, MapTimes.start_vel_y, MapTimes.start_vel_z,
+                                    MapTimes.end_vel_x, MapTimes.end_vel_y, MapTimes.end_vel_z, MapTimes.run_date
                                 FROM MapTimes
-                                JOIN Player ON MapTimes.player_id = Player.id
-                                WHERE MapTimes.map_id = {}
-                            ) AS ranked_times
-                            WHERE ranked_times.row_num = 1;"""
+                                WHERE MapTimes.map_id = MapRecords.map_id AND MapTimes.style = MapRecords.style
+                                    AND MapTimes.type = MapRecords.type AND MapTimes.stage = MapRecords.stage
+                                ORDER BY MapTimes.run_time ASC, MapTimes.id ASC
+                                LIMIT {}
+                            ) AS top_runs ON TRUE
+                            JOIN Player ON top_runs.player_id = Player.id
+                            WHERE MapRecords.map_id = {} AND MapRecords.style = {} AND MapRecords.type IN (1, 2)
+                            ORDER BY top_runs.type, top_runs.stage, top_runs.run_time, top_runs.id;"""
+# After a save: the fastest run of the group is read from `idx_maptimes_leaderboard` and `completions`
+# grows by the first value, 1 for a new run and 0 for an improved one
+sql_updateMapRecord = """INSERT INTO `MapRecords` (`map_id`, `style`, `type`, `stage`, `maptime_id`, `player_id`, `run_time`, `completions`, `updated_at`)
+                            SELECT `map_id`, `style`, `type`, `stage`, `id`, `player_id`, `run_time`, {}, UNIX_TIMESTAMP() FROM `MapTimes`
+                            WHERE `map_id` = {} AND `style` = {} AND `type` = {} AND `stage` = {}
+                            ORDER BY `run_time` ASC, `id` ASC
+                            LIMIT 1
+                            ON DUPLICATE KEY UPDATE `maptime_id` = VALUES(`maptime_id`), `player_id` = VALUES(`player_id`),
+                            `run_time` = VALUES(`run_time`), `completions` = `completions` + VALUES(`completions`),
+                            `updated_at` = VALUES(`updated_at`);"""
+# Rebuilds `MapRecords` from `MapTimes`, the condition is either `map_id` = X or TRUE for every map
+sql_deleteMapRecords = """DELETE FROM `MapRecords` WHERE {};"""
+sql_rebuildMapRecords = """INSERT INTO `MapRecords` (`map_id`, `style`, `type`, `stage`, `maptime_id`, `player_id`, `run_time`, `completions`, `updated_at`)
+                            SELECT `map_id`, `style`, `type`, `stage`, `id`, `player_id`, `run_time`, `completions`, UNIX_TIMESTAMP() FROM (
+                                SELECT `id`, `player_id`, `map_id`, `style`, `type`, `stage`, `run_time`,
+                                    ROW_NUMBER() OVER (PARTITION BY `map_id`, `style`, `type`, `stage` ORDER BY `run_time` ASC, `id` ASC) AS row_num,
+                                    COUNT(*) OVER (PARTITION BY `map_id`, `style`, `type`, `stage`) AS completions
+                                FROM `MapTimes`
+                                WHERE {}
+                            ) AS ranked
+                            WHERE ranked.row_num = 1;"""
+# Points (`points.py`), the condition is either `updated_at` >= `points_at` for the maps with new runs or TRUE
+sql_getPointsMaps = """SELECT DISTINCT `map_id` FROM `MapRecords`
+                            WHERE `type` = 0 AND `stage` = 0 AND {} ORDER BY `map_id`;"""
+sql_getPointsRuns = """SELECT MapTimes.id, MapTimes.map_id, MapTimes.style, MapTimes.player_id, MapTimes.run_time, Maps.tier
+                            FROM MapTimes
+                            JOIN Maps ON Maps.id = MapTimes.map_id
+                            WHERE MapTimes.map_id IN ({}) AND MapTimes.type = 0 AND MapTimes.stage = 0
+                            ORDER BY MapTimes.map_id, MapTimes.style, MapTimes.run_time, MapTimes.id;"""
+# Players with points on the maps before they are recomputed, read from the primary key
+sql_getMapPointsPlayers = """SELECT DISTINCT `style`, `player_id` FROM `MapPoints` WHERE `map_id` IN ({}) FOR UPDATE;"""
+sql_deleteMapPoints = """DELETE FROM `MapPoints` WHERE `map_id` IN ({});"""
+sql_deletePlayerPoints = (
+    """DELETE FROM `PlayerPoints` WHERE `style` = {} AND `player_id` IN ({});"""
+)
+sql_insertMapPoints = """INSERT INTO `MapPoints` (`map_id`, `style`, `player_id`, `maptime_id`, `rank`, `points`) VALUES {};"""
+sql_updatePlayerPoints = """INSERT INTO `PlayerPoints` (`style`, `player_id`, `points`, `maps`)
+                            SELECT `style`, `player_id`, SUM(`points`), COUNT(*) FROM `MapPoints`
+                            WHERE `style` = {} AND `player_id` IN ({})
+                            GROUP BY `style`, `player_id`
+                            ON DUPLICATE KEY UPDATE `points` = VALUES(`points`), `maps` = VALUES(`maps`);"""
+sql_markMapPoints = """UPDATE `MapRecords` SET `points_at` = {}
+                            WHERE `map_id` IN ({}) AND `type` = 0 AND `stage` = 0;"""
+sql_getPointsKeys = (
+    """SELECT `points` FROM `PlayerPoints` WHERE `style` = {} ORDER BY `points` DESC;"""
+)
+sql_getPlayerPoints = """SELECT PlayerPoints.*, Player.name FROM PlayerPoints
+                            JOIN Player ON PlayerPoints.player_id = Player.id
+                            WHERE PlayerPoints.style = {} AND PlayerPoints.player_id = {};"""
+# Keyset page of the global ranking, after the (`points`, `player_id`) of the last player of the previous page
+sql_getPointsPage = """SELECT PlayerPoints.*, Player.name FROM PlayerPoints
+                            JOIN Player ON PlayerPoints.player_id = Player.id
+                            WHERE PlayerPoints.style = {}
+                            AND (PlayerPoints.points < {} OR (PlayerPoints.points = {} AND PlayerPoints.player_id > {}))
+                            ORDER BY PlayerPoints.points DESC, PlayerPoints.player_id ASC
+                            LIMIT {};"""
 sql_getMapCheckpointsData = "SELECT * FROM `Checkpoints` WHERE `maptime_id` = {};"
+# Checkpoint rows of several runs (`checkpoint_storage.py`), read from `maptime_cp`
+sql_getCheckpointRows = """SELECT * FROM `Checkpoints` WHERE `maptime_id` IN ({}) ORDER BY `maptime_id`, `cp`;"""
+# Map runs to compare by `maptime_id` or `player_id`, either list can be `NULL`
+sql_getSplitRuns = """SELECT `id`, `player_id`, `run_time` FROM `MapTimes`
+                    WHERE `map_id` = {} AND `style` = {} AND `type` = 0 AND `stage` = 0
+                    AND (`id` IN ({}) OR `player_id` IN ({}));"""
+sql_getCheckpointsByRuns = """SELECT `maptime_id`, `cp`, `run_time`, `start_vel_x`, `start_vel_y`, `start_vel_z`,
+                    `end_vel_x`, `end_vel_y`, `end_vel_z` FROM `Checkpoints`
+                    WHERE `maptime_id` IN ({}) ORDER BY `maptime_id`, `cp`;"""
+# Packed checkpoint storage, see `checkpoints.py`
+sql_getPackedCheckpoints = """SELECT `maptime_id`, `data` FROM `PackedCheckpoints`
+                    WHERE `maptime_id` IN ({}) ORDER BY `maptime_id`;"""
 sql_getMapRecordAndTotals = """SELECT MapTimes.*, Player.name
                             FROM MapTimes
                             JOIN Player ON MapTimes.player_id = Player.id
                             WHERE MapTimes.map_id = {} AND MapTimes.style = {}
                             ORDER BY MapTimes.run_time ASC;"""
-# This one might cause issues if DB is large - revisit later
-sql_getDataByRank = """SELECT Player.name, mainquery.* FROM MapTimes AS mainquery
-                    INNER JOIN Player ON 
-                        mainquery.player_id = Player.id
-                    WHERE
-                        mainquery.map_id = {}
-                        AND mainquery.style = {}
-                        AND mainquery.type = {}
-                        AND mainquery.stage = {}
-                        AND (
-                            SELECT COUNT(*) FROM MapTimes AS subquery
-                            WHERE
-                                subquery.map_id = mainquery.map_id
-                                AND subquery.style = mainquery.style
-                                AND subquery.type = mainquery.type
-                                AND subquery.stage = mainquery.stage
-                                AND subquery.run_time <= mainquery.run_time
-                        ) = {};"""
+# One page of a leaderboard without `replay_frames`, keyset pagination after the `(run_time, id)` of the last run
+# of the previous page. InnoDB appends `id` to `idx_maptimes_leaderboard` so the page is read in index order
+sql_getLeaderboardPage = """SELECT MapTimes.id, MapTimes.player_id, Player.name, MapTimes.map_id, MapTimes.style, MapTimes.type,
+                                MapTimes.stage, MapTimes.run_time, MapTimes.start_vel_x, MapTimes.start_vel_y, MapTimes.start_vel_z,
+                                MapTimes.end_vel_x, MapTimes.end_vel_y, MapTimes.end_vel_z, MapTimes.run_date
+                            FROM MapTimes
+                            JOIN Player ON MapTimes.player_id = Player.id
+                            WHERE MapTimes.map_id = {} AND MapTimes.style = {} AND MapTimes.type = {} AND MapTimes.stage = {}
+                                AND (MapTimes.run_time > {} OR (MapTimes.run_time = {} AND MapTimes.id > {}))
+                            ORDER BY MapTimes.run_time ASC, MapTimes.id ASC
+                            LIMIT {};"""
+sql_getLeaderboardTotals = """SELECT COUNT(*) AS `total`, MIN(`run_time`) AS `record` FROM `MapTimes`
+                            WHERE `map_id` = {} AND `style` = {} AND `type` = {} AND `stage` = {};"""
+# Every run on a map without `replay_frames`, streamed by `/surftimer/mapexport`
+sql_getMapExport = """SELECT MapTimes.id, MapTimes.player_id, Player.name, MapTimes.map_id, MapTimes.style, MapTimes.type,
+                                MapTimes.stage, MapTimes.run_time, MapTimes.start_vel_x, MapTimes.start_vel_y, MapTimes.start_vel_z,
+                                MapTimes.end_vel_x, MapTimes.end_vel_y, MapTimes.end_vel_z, MapTimes.run_date
+                            FROM MapTimes
+                            JOIN Player ON MapTimes.player_id = Player.id
+                            WHERE MapTimes.map_id = {}
+                            ORDER BY MapTimes.style, MapTimes.type, MapTimes.stage, MapTimes.run_time, MapTimes.id;"""
+# `(run_time, id)` of a whole leaderboard for `leaderboards.py`, read from `idx_maptimes_leaderboard` alone
+sql_getLeaderboardKeys = """SELECT `id`, `run_time` FROM `MapTimes`
+                            WHERE `map_id` = {} AND `style` = {} AND `type` = {} AND `stage` = {}
+                            ORDER BY `run_time` ASC, `id` ASC;"""
+sql_getLeaderboardRuns = """SELECT MapTimes.id, MapTimes.player_id, Player.name, MapTimes.map_id, MapTimes.style, MapTimes.type,
+                                MapTimes.stage, MapTimes.run_time, MapTimes.start_vel_x, MapTimes.start_vel_y, MapTimes.start_vel_z,
+                                MapTimes.end_vel_x, MapTimes.end_vel_y, MapTimes.end_vel_z, MapTimes.run_date
+                            FROM MapTimes
+                            JOIN Player ON MapTimes.player_id = Player.id
+                            WHERE MapTimes.id IN ({});"""
+# Ranks the leaderboard once with a window over `idx_maptimes_leaderboard`, only `id` and `run_time` are read
+# from the index until the run with the rank is found. Same ranks as before: runs as fast or faster are counted
+sql_getDataByRank = """SELECT Player.name, MapTimes.* FROM (
+                        SELECT `id`, COUNT(*) OVER (ORDER BY `run_time` ASC) AS `rank`
+                        FROM `MapTimes`
+                        WHERE `map_id` = {} AND `style` = {} AND `type` = {} AND `stage` = {}
+                    ) AS ranked
+                    INNER JOIN MapTimes ON MapTimes.id = ranked.id
+                    INNER JOIN Player ON MapTimes.player_id = Player.id
+                    WHERE ranked.`rank` = {};"""
 
 
 ####################
 ## PlayerStats.cs ##
 ####################
-sql_getPlayerMapData = """SELECT mainquery.*, (SELECT COUNT(*) FROM `MapTimes` AS subquery 
-                        WHERE subquery.`map_id` = mainquery.`map_id` AND subquery.`style` = mainquery.`style` 
-                        AND subquery.`run_time` <= mainquery.`run_time` AND subquery.`type` = mainquery.`type` AND subquery.`stage` = mainquery.`stage`) AS `rank` FROM `MapTimes` AS mainquery 
+# Rank of a `mainquery` run, a range scan of `idx_maptimes_leaderboard` that never reads the table rows
+_rank = """(SELECT COUNT(*) FROM `MapTimes` AS subquery
+                        WHERE subquery.`map_id` = mainquery.`map_id` AND subquery.`style` = mainquery.`style`
+                        AND subquery.`type` = mainquery.`type` AND subquery.`stage` = mainquery.`stage`
+                        AND subquery.`run_time` <= mainquery.`run_time`) AS `rank`"""
+sql_getPlayerMapData = (
+    """SELECT mainquery.*, """
+    + _rank
+    + """ FROM `MapTimes` AS mainquery 
                         WHERE mainquery.`player_id` = {} AND mainquery.`map_id` = {};"""
+)
+sql_getPlayerRun = """SELECT `id`, `run_time` FROM `MapTimes`
+                    WHERE `player_id` = {} AND `map_id` = {} AND `style` = {} AND `type` = {} AND `stage` = {};"""
 sql_getSpecificPlayerStatsData = """SELECT * FROM `MapTimes` WHERE `player_id` = {} AND `map_id` = {} AND `style` = {} AND `type` = {};"""  # Can be replaced with sql_getRunByPlayer
 
 ####################
@@ -64,7 +190,7 @@ sql_insertMapTime = """INSERT INTO `MapTimes`
                     (`player_id`, `map_id`, `style`, `type`, `stage`, `run_time`, `start_vel_x`, `start_vel_y`, `start_vel_z`, `end_vel_x`, `end_vel_y`, `end_vel_z`, `run_date`, `replay_frames`) 
                     VALUES ({}, {}, {}, {}, {}, {}, 
                     {}, {}, {}, {}, {}, {}, {}, '{}') 
-                    ON DUPLICATE KEY UPDATE run_time=VALUES(run_time), start_vel_x=VALUES(start_vel_x), start_vel_y=VALUES(start_vel_y), 
+                    ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID(id), run_time=VALUES(run_time), start_vel_x=VALUES(start_vel_x), start_vel_y=VALUES(start_vel_y), 
                     start_vel_z=VALUES(start_vel_z), end_vel_x=VALUES(end_vel_x), end_vel_y=VALUES(end_vel_y), end_vel_z=VALUES(end_vel_z), run_date=VALUES(run_date), replay_frames=VALUES(replay_frames);"""
 sql_insertCheckpoint = """INSERT INTO `Checkpoints` 
                     (`maptime_id`, `cp`, `run_time`, `start_vel_x`, `start_vel_y`, `start_vel_z`, 
@@ -73,6 +199,14 @@ sql_insertCheckpoint = """INSERT INTO `Checkpoints`
                     ON DUPLICATE KEY UPDATE 
                     run_time=VALUES(run_time), start_vel_x=VALUES(start_vel_x), start_vel_y=VALUES(start_vel_y), start_vel_z=VALUES(start_vel_z), 
                     end_vel_x=VALUES(end_vel_x), end_vel_y=VALUES(end_vel_y), end_vel_z=VALUES(end_vel_z), attempts=VALUES(attempts), end_touch=VALUES(end_touch);"""
+sql_insertPackedCheckpoints = """INSERT INTO `PackedCheckpoints` (`maptime_id`, `cp_count`, `data`)
+                    VALUES ({}, {}, X'{}')
+                    ON DUPLICATE KEY UPDATE cp_count=VALUES(cp_count), data=VALUES(data);"""
+# A save removes the run's checkpoints from the storage it doesn't write, so an older copy can't come back
+sql_deleteCheckpoints = """DELETE FROM `Checkpoints` WHERE `maptime_id` = {};"""
+sql_deletePackedCheckpoints = (
+    """DELETE FROM `PackedCheckpoints` WHERE `maptime_id` = {};"""
+)
 
 
 ####################
@@ -84,16 +218,66 @@ sql_insertPlayerProfile = """INSERT INTO `Player` (`name`, `steam_id`, `country`
 sql_updatePlayerProfile = """UPDATE `Player` SET country = '{}', 
                             `last_seen` = {}, `connections` = `connections` + 1 
                             WHERE `id` = {};"""
+# Pending connects of `write_buffer.py`, one `SELECT` of `id`, `country`, `last_seen` and `connections` per player joined by `UNION ALL`
+sql_flushPlayerProfiles = """UPDATE `Player` JOIN ({}) AS pending ON Player.id = pending.id
+                            SET Player.country = pending.country, Player.last_seen = pending.last_seen,
+                            Player.connections = Player.connections + pending.connections;"""
+# Completions, top 10 map runs and records per style and map tier, one range of the `PlayerSummary` primary key
+sql_getPlayerSummary = """SELECT PlayerSummary.*, Player.name FROM Player
+                            JOIN PlayerSummary ON PlayerSummary.player_id = Player.id
+                            WHERE Player.steam_id = {}
+                            ORDER BY PlayerSummary.style, PlayerSummary.tier;"""
+# Players of the fastest runs of a leaderboard, read before and after a save to find who entered or left the top,
+# the locks held until the save's transaction ends keep concurrent saves on the leaderboard from reading the same top
+sql_getTopPlayers = """SELECT `player_id` FROM `MapTimes`
+                            WHERE `map_id` = {} AND `style` = {} AND `type` = {} AND `stage` = {}
+                            ORDER BY `run_time` ASC, `id` ASC
+                            LIMIT {} FOR UPDATE;"""
+# Adds the changes of a save to the player's row for the map's style and tier, values are +1, -1 or 0
+sql_updatePlayerSummary = """INSERT INTO `PlayerSummary` (`player_id`, `style`, `tier`, `maps`, `stages`, `bonuses`, `top10`, `records`, `stage_records`, `bonus_records`)
+                            SELECT {}, {}, `tier`, {}, {}, {}, {}, {}, {}, {} FROM `Maps` WHERE `id` = {}
+                            ON DUPLICATE KEY UPDATE `maps` = `maps` + VALUES(`maps`), `stages` = `stages` + VALUES(`stages`),
+                            `bonuses` = `bonuses` + VALUES(`bonuses`), `top10` = `top10` + VALUES(`top10`),
+                            `records` = `records` + VALUES(`records`), `stage_records` = `stage_records` + VALUES(`stage_records`),
+                            `bonus_records` = `bonus_records` + VALUES(`bonus_records`);"""
+# `steam_id` of the players whose `PlayerSummary` a save changed, for the `summary:{steam_id}` version stamps
+sql_getSteamIds = """SELECT `steam_id` FROM `Player` WHERE `id` IN ({});"""
+# Rebuilds `PlayerSummary` from `MapTimes`, positions are ordered by `run_time` and `id` like `sql_getTopPlayers`
+sql_deletePlayerSummaries = """DELETE FROM `PlayerSummary`;"""
+sql_rebuildPlayerSummaries = """INSERT INTO `PlayerSummary` (`player_id`, `style`, `tier`, `maps`, `stages`, `bonuses`, `top10`, `records`, `stage_records`, `bonus_records`)
+                            SELECT ranked.player_id, ranked.style, Maps.tier,
+                                SUM(ranked.type = 0), SUM(ranked.type = 2), SUM(ranked.type = 1),
+                                SUM(ranked.type = 0 AND ranked.row_num <= 10),
+                                SUM(ranked.type = 0 AND ranked.row_num = 1),
+                                SUM(ranked.type = 2 AND ranked.row_num = 1),
+                                SUM(ranked.type = 1 AND ranked.row_num = 1)
+                            FROM (
+                                SELECT `player_id`, `map_id`, `style`, `type`,
+                                    ROW_NUMBER() OVER (PARTITION BY `map_id`, `style`, `type`, `stage` ORDER BY `run_time` ASC, `id` ASC) AS row_num
+                                FROM `MapTimes`
+                            ) AS ranked
+                            JOIN Maps ON Maps.id = ranked.map_id
+                            GROUP BY ranked.player_id, ranked.style, Maps.tier;"""
 
 
 #########################
 ##   PersonalBest.cs   ##
 #########################
-sql_getRunByPlayer = """SELECT mainquery.*, (SELECT COUNT(*) FROM `MapTimes` AS subquery 
-                        WHERE subquery.`map_id` = mainquery.`map_id` AND subquery.`style` = mainquery.`style` 
-                        AND subquery.`run_time` <= mainquery.`run_time` AND subquery.`type` = mainquery.`type` AND subquery.`stage` = mainquery.`stage`) AS `rank` FROM `MapTimes` AS mainquery 
+sql_getRunByPlayer = (
+    """SELECT mainquery.*, """
+    + _rank
+    + """ FROM `MapTimes` AS mainquery 
                         WHERE mainquery.`player_id` = {} AND mainquery.`map_id` = {} AND mainquery.`type` = {} AND mainquery.`style` = {};"""
-sql_getRunById = """SELECT mainquery.*, (SELECT COUNT(*) FROM `MapTimes` AS subquery 
-                    WHERE subquery.`map_id` = mainquery.`map_id` AND subquery.`style` = mainquery.`style` 
-                    AND subquery.`run_time` <= mainquery.`run_time` AND subquery.`type` = mainquery.`type` AND subquery.`stage` = mainquery.`stage`) AS `rank` FROM `MapTimes` AS mainquery 
+)
+sql_getRunById = (
+    """SELECT mainquery.*, """
+    + _rank
+    + """ FROM `MapTimes` AS mainquery 
                     WHERE mainquery.`id` = {};"""
+)
+
+
+# Every `sql_*` query keeps its name after `.format()`
+for _name, _query in list(globals().items()):
+    if _name.startswith("sql_"):
+        globals()[_name] = NamedQuery(_query, _name)
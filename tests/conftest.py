@@ -0,0 +1,39 @@
+"""The API reads `config.json`, `requests.json` and `denied.json` from the working directory when it is imported,
+the tests run it from a temporary directory with Redis disabled. MySQL is replaced per test by monkeypatching the
+`sql.py` functions a module imported, see `FakeDatabase` in the tests."""
+
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_workdir = tempfile.mkdtemp(prefix="surftimer-tests-")
+with open(os.path.join(_workdir, "config.json"), "w") as f:
+    json.dump(
+        {
+            "AUTH0": {"DOMAIN": "", "API_AUDIENCE": "", "ALGORITHMS": "", "ISSUER": ""},
+            "DATABASE": {
+                "USERNAME": "",
+                "PASSWORD": "",
+                "HOST": "127.0.0.1",
+                "PORT": 3306,
+                "DB": "surftimer",
+            },
+            "REDIS": {
+                "ENABLED": 0,
+                "HOST": "127.0.0.1",
+                "PASSWORD": "",
+                "PORT": 6379,
+                "EXPIRY": 30,
+            },
+            "WHITELISTED_IPS": ["testclient"],
+        },
+        f,
+    )
+for name in ("requests.json", "denied.json"):
+    with open(os.path.join(_workdir, name), "w") as f:
+        f.write("[]")
+os.chdir(_workdir)
@@ -0,0 +1,164 @@
+import re
+from contextlib import contextmanager
+from decimal import Decimal
+
+import pytest
+from fastapi.testclient import TestClient
+
+import checkpoint_storage
+import main
+import surftimer.CurrentRun
+import surftimer.PlayerStats
+from globals import checkpoint_config
+
+
+RUN_ID = 7
+
+
+class FakeDatabase:
+    """The player's run and its checkpoints in both storages, answering the named queries of a save and a read"""
+
+    def __init__(self):
+        self.run = None
+        self.packed = {}
+        self.rows = {}
+
+    @contextmanager
+    def transaction(self):
+        yield self
+
+    def insert(self, query):
+        assert query.name == "sql_insertMapTime"
+        values = re.search(r"VALUES \((.*?)\)", query, re.S).group(1).split(",")
+        player_id, map_id, style, type, stage, run_time = map(int, values[:6])
+        new = self.run is None
+        self.run = {
+            "id": RUN_ID,
+            "player_id": player_id,
+            "map_id": map_id,
+            "style": style,
+            "type": type,
+            "stage": stage,
+            "run_time": run_time,
+        }
+        return (1 if new else 2), RUN_ID
+
+    def select(self, query):
+        return self.selectQuery(query)
+
+    def execute(self, queries):
+        for query in queries:
+            if query.name == "sql_insertPackedCheckpoints":
+                maptime_id, _, data = re.search(
+                    r"VALUES \((\d+), (\d+), X'([0-9a-f]*)'\)", query
+                ).groups()
+                self.packed[int(maptime_id)] = bytes.fromhex(data)
+            elif query.name == "sql_deleteCheckpoints":
+                self.rows.pop(int(re.search(r"= (\d+)", query).group(1)), None)
+            elif query.name == "sql_deletePackedCheckpoints":
+                self.packed.pop(int(re.search(r"= (\d+)", query).group(1)), None)
+        return [1] * len(queries)
+
+    def selectQuery(self, query):
+        if query.name == "sql_getSpecificPlayerStatsData":
+            return [dict(self.run)] if self.run else []
+        if query.name == "sql_getPackedCheckpoints":
+            return [
+                {"maptime_id": maptime_id, "data": data}
+                for maptime_id, data in self.packed.items()
+                if str(maptime_id) in query
+            ]
+        if query.name == "sql_getCheckpointRows":
+            return [
+                row
+                for maptime_id, rows in self.rows.items()
+                if str(maptime_id) in query
+                for row in rows
+            ]
+        return []
+
+
+def checkpoint(cp: int, run_time: int) -> dict:
+    return {
+        "cp": cp,
+        "run_time": run_time,
+        "start_vel_x": "1.5",
+        "start_vel_y": "-0.25",
+        "start_vel_z": "0",
+        "end_vel_x": "300.123456",
+        "end_vel_y": "0",
+        "end_vel_z": "0",
+        "end_touch": 0,
+        "attempts": cp,
+    }
+
+
+def map_run(run_time: int, checkpoints: list) -> dict:
+    return {
+        "player_id": 1,
+        "map_id": 2,
+        "run_time": run_time,
+        "start_vel_x": 0,
+        "start_vel_y": 0,
+        "start_vel_z": 0,
+        "end_vel_x": 0,
+        "end_vel_y": 0,
+        "end_vel_z": 0,
+        "style": 0,
+        "type": 0,
+        "stage": 0,
+        "replay_frames": "",
+        "checkpoints": checkpoints,
+    }
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setitem(checkpoint_config, "STORAGE", "packed")
+    monkeypatch.setattr(surftimer.CurrentRun, "transaction", database.transaction)
+    monkeypatch.setattr(surftimer.PlayerStats, "selectQuery", database.selectQuery)
+    monkeypatch.setattr(checkpoint_storage, "selectQuery", database.selectQuery)
+    return database
+
+
+def player_specific_data(client: TestClient) -> list:
+    response = client.get(
+        "/surftimer/playerspecificdata",
+        params={"player_id": 1, "map_id": 2, "style": 0, "type": 0},
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_packed_run_is_read_back(database):
+    client = TestClient(main.app)
+    saved = client.post(
+        "/surftimer/savemaptime",
+        json=map_run(5000, [checkpoint(2, 2000), checkpoint(1, 1000)]),
+    )
+    assert saved.status_code == 201
+
+    (run,) = player_specific_data(client)
+    assert run["id"] == RUN_ID
+    assert [cp["cp"] for cp in run["checkpoints"]] == [1, 2]
+    assert [cp["run_time"] for cp in run["checkpoints"]] == [1000, 2000]
+    assert Decimal(str(run["checkpoints"][0]["start_vel_y"])) == Decimal("-0.25")
+    assert Decimal(str(run["checkpoints"][0]["end_vel_x"])) == Decimal("300.123456")
+
+
+def test_improved_run_replaces_rows_from_before_the_migration(database):
+    # Saved with row storage and not migrated yet
+    database.run = {"id": RUN_ID, "player_id": 1, "map_id": 2, "run_time": 6000}
+    database.rows[RUN_ID] = [{**checkpoint(1, 1500), "id": 1, "maptime_id": RUN_ID}]
+    client = TestClient(main.app)
+    assert player_specific_data(client)[0]["checkpoints"][0]["run_time"] == 1500
+
+    saved = client.post(
+        "/surftimer/savemaptime", json=map_run(4000, [checkpoint(1, 900)])
+    )
+    assert saved.status_code == 201
+
+    assert RUN_ID not in database.rows
+    (run,) = player_specific_data(client)
+    assert [cp["run_time"] for cp in run["checkpoints"]] == [900]
@@ -0,0 +1,39 @@
+import socket
+import time
+
+import pytest
+import redis
+
+import deadline
+
+
+@pytest.fixture
+def hung_redis():
+    """A Redis address that accepts connections and never answers"""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    client = redis.Redis(
+        connection_pool=redis.ConnectionPool(
+            host="127.0.0.1",
+            port=server.getsockname()[1],
+            socket_timeout=10,
+            connection_class=deadline.DeadlineConnection,
+        )
+    )
+    yield client
+    client.close()
+    server.close()
+
+
+def test_redis_call_ends_with_the_deadline(hung_redis):
+    token = deadline._deadline.set(time.monotonic() + 0.2)
+    try:
+        tic = time.monotonic()
+        with pytest.raises(deadline.DeadlineExceeded):
+            hung_redis.get("key")
+        assert time.monotonic() - tic < 1
+        with pytest.raises(deadline.DeadlineExceeded):
+            hung_redis.get("key")
+    finally:
+        deadline._deadline.reset(token)
@@ -0,0 +1,36 @@
+import pytest
+import redis
+from fastapi.testclient import TestClient
+
+import main
+import ratelimit
+from globals import config, rate_limit_config
+
+
+class FailingRedis:
+    """A Redis client whose scripts fail like an unreachable server"""
+
+    def register_script(self, script):
+        def run(keys, args):
+            raise redis.ConnectionError("Connection refused")
+
+        return run
+
+
+@pytest.fixture
+def shared_buckets(monkeypatch):
+    monkeypatch.setitem(config["REDIS"], "ENABLED", 1)
+    monkeypatch.setitem(rate_limit_config, "SHARED", 1)
+    monkeypatch.setitem(rate_limit_config, "BURST", 2)
+    monkeypatch.setitem(rate_limit_config, "RATE", 0.01)
+    monkeypatch.setattr(ratelimit, "redis_client", FailingRedis())
+    monkeypatch.setattr(ratelimit, "_take_script", None)
+    monkeypatch.setattr(ratelimit, "_buckets", ratelimit.OrderedDict())
+
+
+def test_failing_redis_falls_back_to_the_local_bucket(shared_buckets):
+    client = TestClient(main.app)
+    statuses = [client.get("/surftimer/nope").status_code for _ in range(3)]
+
+    assert statuses == [404, 404, 429]
+    assert list(ratelimit._buckets) == ["ip:testclient"]
@@ -0,0 +1,67 @@
+import mysql.connector
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import write_buffer
+from globals import write_buffer_config
+
+
+class FakeDatabase:
+    """Records the flushed statements, rejects the ones with a `tier` of 99 like MySQL rejects a bad value"""
+
+    def __init__(self):
+        self.statements = []
+        self.down = False
+
+    def executeTransaction(self, queries):
+        if self.down:
+            raise mysql.connector.errors.InterfaceError("Can't connect to MySQL server")
+        for query in queries:
+            if "99 AS tier" in query:
+                raise mysql.connector.errors.DataError(
+                    "Out of range value for column 'tier'"
+                )
+        self.statements.extend(queries)
+        return [1] * len(queries)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setitem(write_buffer_config, "INTERVAL", 5)
+    monkeypatch.setattr(write_buffer, "executeTransaction", database.executeTransaction)
+    monkeypatch.setattr(write_buffer, "_players", {})
+    monkeypatch.setattr(write_buffer, "_maps", {})
+    return database
+
+
+def update_map(client: TestClient, **values):
+    body = {"name": "surf_beginner", "tier": 1, "stages": 1, **values}
+    return client.put("/surftimer/updateMap", json=body)
+
+
+def test_rejected_row_is_dropped_and_the_rest_written(database):
+    client = TestClient(main.app)
+    write_buffer.update_player(1, 76561198000000001, "Côte d'Ivoire", 100)
+    assert update_map(client, id=1, author="O'Brien").status_code == 200
+    assert update_map(client, id=2, tier=99).status_code == 200
+
+    database.down = True
+    with pytest.raises(mysql.connector.errors.InterfaceError):
+        write_buffer.flush()
+    assert (len(write_buffer._players), len(write_buffer._maps)) == (1, 2)
+
+    database.down = False
+    assert write_buffer.flush() == 2
+    assert write_buffer._players == {} and write_buffer._maps == {}
+    written = "".join(database.statements)
+    assert "'Côte d\\'Ivoire' AS country" in written
+    assert "'O\\'Brien' AS author" in written
+    assert "SELECT 2 AS id" not in written
+
+
+def test_map_update_without_id_is_rejected(database):
+    client = TestClient(main.app)
+    assert update_map(client).status_code == 400
+    assert write_buffer._maps == {}
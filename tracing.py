@@ -0,0 +1,254 @@
+"""Lightweight per-request tracing
+
+`TracingMiddleware` opens a `Trace` for every request and `span()` records a timed span into it
+from anywhere in the request (`sql.py`, the cache helpers in `globals.py`, ...).
+Every response gets a `Server-Timing` header with the time spent per span name, sampled requests are
+also exported as OpenTelemetry (OTLP/JSON) records, one `ExportTraceServiceRequest` per line in
+`EXPORT_DIR/traces-<date>.jsonl`.
+"""
+
+import asyncio
+import functools
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+import orjson
+from fastapi import Request
+from fastapi.routing import APIRoute
+from starlette.middleware.base import BaseHTTPMiddleware
+
+
+tracing_config = {
+    "ENABLED": 1,
+    "SAMPLE_RATE": 0.0,
+    "ROUTES": {},
+    "EXPORT_DIR": "traces",
+}
+
+_current_trace = ContextVar("current_trace", default=None)
+# When the route matching the request started handling it, see `TracedRoute`
+_route_start = ContextVar("route_start", default=None)
+
+
+class Trace:
+    """Spans recorded while handling a single request"""
+
+    __slots__ = ("trace_id", "parent_span_id", "root_span_id", "spans", "_stack")
+
+    def __init__(self, trace_id: str = None, parent_span_id: str = None):
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.parent_span_id = parent_span_id
+        self.root_span_id = os.urandom(8).hex()
+        # (span_id, parent_span_id, name, description, start_ns, end_ns)
+        self.spans = []
+        self._stack = [self.root_span_id]
+
+    def server_timing(self) -> str:
+        """`db;dur=12.31;desc="3", cache;dur=0.42;desc="2"`, time in ms and span count per name"""
+        totals = {}
+        for _, _, name, _, start_ns, end_ns in self.spans:
+            duration, count = totals.get(name, (0, 0))
+            totals[name] = (duration + end_ns - start_ns, count + 1)
+        return ", ".join(
+            f'{name};dur={duration / 1e6:.2f};desc="{count}"'
+            for name, (duration, count) in totals.items()
+        )
+
+
+def current_trace() -> Trace:
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name: str, description: str = None):
+    """Records the block as a span of the current request, does nothing outside of a request"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    span_id = os.urandom(8).hex()
+    parent_span_id = trace._stack[-1]
+    trace._stack.append(span_id)
+    start_ns = time.time_ns()
+    try:
+        yield
+    finally:
+        trace._stack.pop()
+        trace.spans.append(
+            (span_id, parent_span_id, name, description, start_ns, time.time_ns())
+        )
+
+
+def parse_traceparent(traceparent: str):
+    """Returns `(trace_id, parent_span_id)` from a W3C `traceparent` header or `(None, None)`"""
+    parts = traceparent.split("-") if traceparent else []
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        return parts[1], parts[2]
+    return None, None
+
+
+def sample_rate(route: str) -> float:
+    return tracing_config["ROUTES"].get(route, tracing_config["SAMPLE_RATE"])
+
+
+def otlp_record(trace: Trace, name: str, start_ns: int, end_ns: int, attributes: dict):
+    """The trace as an OTLP/JSON `ExportTraceServiceRequest`"""
+
+    def otlp_attributes(values: dict):
+        return [
+            {
+                "key": key,
+                "value": (
+                    {"intValue": str(value)}
+                    if isinstance(value, int)
+                    else {"stringValue": str(value)}
+                ),
+            }
+            for key, value in values.items()
+            if value is not None
+        ]
+
+    spans = [
+        {
+            "traceId": trace.trace_id,
+            "spanId": trace.root_span_id,
+            "parentSpanId": trace.parent_span_id or "",
+            "name": name,
+            "kind": 2,  # SPAN_KIND_SERVER
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(end_ns),
+            "attributes": otlp_attributes(attributes),
+        }
+    ]
+    for (
+        span_id,
+        parent_span_id,
+        span_name,
+        description,
+        span_start,
+        span_end,
+    ) in trace.spans:
+        spans.append(
+            {
+                "traceId": trace.trace_id,
+                "spanId": span_id,
+                "parentSpanId": parent_span_id,
+                "name": span_name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(span_start),
+                "endTimeUnixNano": str(span_end),
+                "attributes": otlp_attributes({"description": description}),
+            }
+        )
+
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": otlp_attributes({"service.name": "cs2-surftimer-api"})
+                },
+                "scopeSpans": [{"scope": {"name": "tracing"}, "spans": spans}],
+            }
+        ]
+    }
+
+
+def export_record(record: dict):
+    """Appends the record to today's file, runs in the default executor"""
+    os.makedirs(tracing_config["EXPORT_DIR"], exist_ok=True)
+    path = os.path.join(
+        tracing_config["EXPORT_DIR"],
+        f"traces-{datetime.now(timezone.utc):%Y%m%d}.jsonl",
+    )
+    with open(path, "ab") as f:
+        f.write(orjson.dumps(record) + b"\n")
+
+
+class TracingMiddleware(BaseHTTPMiddleware):
+    """Opens a `Trace` per request, sends `Server-Timing` and exports sampled requests"""
+
+    async def dispatch(self, request: Request, call_next):
+        if tracing_config["ENABLED"] == 0:
+            return await call_next(request)
+
+        trace = Trace(*parse_traceparent(request.headers.get("traceparent")))
+        token = _current_trace.set(trace)
+        start_ns = time.time_ns()
+        try:
+            response = await call_next(request)
+        finally:
+            _current_trace.reset(token)
+        end_ns = time.time_ns()
+
+        timings = trace.server_timing()
+        total = f"total;dur={(end_ns - start_ns) / 1e6:.2f}"
+        response.headers["server-timing"] = f"{timings}, {total}" if timings else total
+
+        route = request.scope.get("route")
+        route = route.path if route is not None else "unmatched"
+        if random.random() < sample_rate(route):
+            record = otlp_record(
+                trace,
+                f"{request.method} {route}",
+                start_ns,
+                end_ns,
+                {
+                    "http.method": request.method,
+                    "http.route": route,
+                    "http.status_code": response.status_code,
+                },
+            )
+            # File writes are done off the event loop, the response doesn't wait for them
+            asyncio.get_running_loop().run_in_executor(None, export_record, record)
+
+        return response
+
+
+class TracedRoute(APIRoute):
+    """Route class recording a `parse` span for the time between the route being matched and
+    the endpoint being called, that is reading the body and validating it (e.g. `CurrentRun`)
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if asyncio.iscoroutinefunction(endpoint):
+            endpoint = self.traced_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    @staticmethod
+    def traced_endpoint(endpoint):
+        @functools.wraps(endpoint)
+        async def traced(*args, **kwargs):
+            trace = _current_trace.get()
+            route_start = _route_start.get()
+            if trace is not None and route_start is not None:
+                trace.spans.append(
+                    (
+                        os.urandom(8).hex(),
+                        trace.root_span_id,
+                        "parse",
+                        None,
+                        route_start,
+                        time.time_ns(),
+                    )
+                )
+            with span("handler", endpoint.__name__):
+                return await endpoint(*args, **kwargs)
+
+        return traced
+
+    def get_route_handler(self):
+        route_handler = super().get_route_handler()
+
+        async def traced_route_handler(request: Request):
+            token = _route_start.set(time.time_ns())
+            try:
+                return await route_handler(request)
+            finally:
+                _route_start.reset(token)
+
+        return traced_route_handler
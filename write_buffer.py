@@ -0,0 +1,344 @@
+"""Coalesced writes for the rows every connect and map load touches: `Player.last_seen`, `Player.connections`,
+`Player.country` and the `sql_updateMap` columns of `Maps`
+
+`updatePlayerProfile` and `updateMapTier` merge their update into the pending row instead of writing it:
+connections are summed, the other columns keep the latest value. With Redis enabled the pending rows live in Redis,
+a hash per row (`writebuffer:player:{id}`, `writebuffer:map:{id}`) listed in `writebuffer:players` and
+`writebuffer:maps`, so every worker adds to the same rows and a worker that is killed, like the deploy does, loses
+nothing. Without Redis every worker keeps its own rows and a killed worker loses at most `INTERVAL` seconds of them.
+
+`flush` writes the pending rows in one transaction of multi-row `UPDATE ... JOIN` statements, sorted by `id` so
+concurrent flushes lock rows in the same order, and bumps the version stamps of the flushed rows. It runs every
+`INTERVAL` seconds, when more than `MAX_PENDING` rows are pending and when the worker shuts down, with Redis one
+worker at a time (`writebuffer:lock`). A flushed row is removed from Redis after the commit unless it changed in
+between, the connects that came in meanwhile stay pending. A worker killed between the commit and the removal
+writes the connects of that flush twice.
+
+When MySQL rejects the batch, e.g. a value out of range, its rows are written one by one and the rows it still
+rejects are dropped and counted in `surftimer_write_buffer_rows_dropped_total`. Any other error keeps the rows for
+the next flush and counts in `surftimer_write_buffer_flush_failures_total`, the update that filled the buffer is
+still queued. `/surftimer/playersurfprofile` and `/surftimer/mapinfo` add the pending values to the row they read,
+flushes run on the event loop like the endpoints so a flush doesn't land in between. `INTERVAL` 0 writes every
+update right away.
+"""
+
+import asyncio
+import uuid
+
+import mysql.connector
+from mysql.connector.conversion import MySQLConverter
+
+import surftimer.queries
+from globals import bump_versions, config, redis_client, write_buffer_config
+from metrics import WRITE_BUFFER_FLUSH_FAILURES, WRITE_BUFFER_ROWS_DROPPED
+from sql import executeTransaction
+
+
+# Pending `Player` updates by `id`: `steam_id`, `country`, `last_seen` and the connections to add
+_players = {}
+# Pending `sql_updateMap` columns by `id` and the map name for its version stamp
+_maps = {}
+# Columns of a pending map row, the ones `sql_updateMap` writes
+MAP_COLUMNS = ("last_played", "stages", "bonuses", "author", "tier", "ranked")
+# Columns of the pending rows kept as text, the others are integers
+TEXT_COLUMNS = ("country", "author", "name")
+
+# Errors of a statement MySQL rejects, the same rows would fail on every flush
+REJECTED_ERRORS = (
+    mysql.connector.errors.DataError,
+    mysql.connector.errors.IntegrityError,
+    mysql.connector.errors.ProgrammingError,
+)
+# Milliseconds a worker may flush before another one takes over
+LOCK_MS = 30000
+
+# Removes a flushed row unless it changed since it was read: `KEYS[1]` the row, `KEYS[2]` the set listing it,
+# `ARGV[1]` its `id`, `ARGV[2]` the flushed connections, then the flushed columns and values
+ACK_SCRIPT = """
+local connections = tonumber(ARGV[2])
+if connections ~= 0 then
+    connections = redis.call('HINCRBY', KEYS[1], 'connections', -connections)
+end
+for i = 3, #ARGV, 2 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) ~= ARGV[i + 1] then
+        return 0
+    end
+end
+if connections ~= 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[2], ARGV[1])
+return 1
+"""
+_ack_script = None
+# Releases `KEYS[1]` if it still holds this worker's `ARGV[1]`
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_unlock_script = None
+
+
+def enabled() -> bool:
+    return write_buffer_config["INTERVAL"] > 0
+
+
+def _shared() -> bool:
+    return config["REDIS"]["ENABLED"] == 1
+
+
+def _flush_when_full(pending: int):
+    if pending > write_buffer_config["MAX_PENDING"]:
+        try:
+            flush()
+        except Exception:
+            # The rows are kept and counted, the next flush retries them
+            pass
+
+
+def update_player(player_id: int, steam_id: int, country: str, last_seen: int):
+    """Merges a connect into the player's pending row"""
+    if _shared():
+        pipe = redis_client.pipeline(transaction=True)
+        key = f"writebuffer:player:{player_id}"
+        pipe.hset(
+            key,
+            mapping={"steam_id": steam_id, "country": country, "last_seen": last_seen},
+        )
+        pipe.hincrby(key, "connections", 1)
+        pipe.sadd("writebuffer:players", player_id)
+        pipe.scard("writebuffer:players")
+        pipe.scard("writebuffer:maps")
+        return _flush_when_full(sum(pipe.execute()[-2:]))
+
+    pending = _players.get(player_id)
+    if pending is None:
+        _players[player_id] = {
+            "steam_id": steam_id,
+            "country": country,
+            "last_seen": last_seen,
+            "connections": 1,
+        }
+    else:
+        pending.update(steam_id=steam_id, country=country, last_seen=last_seen)
+        pending["connections"] += 1
+
+    _flush_when_full(len(_players) + len(_maps))
+
+
+def update_map(data):
+    """Replaces the map's pending row with the columns of a map load, raises `ValueError` without an `id`"""
+    if data.id is None:
+        raise ValueError("A map update needs the map's id")
+    row = {
+        "name": data.name,
+        **{column: getattr(data, column) for column in MAP_COLUMNS},
+    }
+    if _shared():
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.hset(f"writebuffer:map:{data.id}", mapping=row)
+        pipe.sadd("writebuffer:maps", data.id)
+        pipe.scard("writebuffer:players")
+        pipe.scard("writebuffer:maps")
+        return _flush_when_full(sum(pipe.execute()[-2:]))
+
+    _maps[data.id] = row
+    _flush_when_full(len(_players) + len(_maps))
+
+
+def _decode(values: dict) -> dict:
+    row = {key.decode(): value for key, value in values.items()}
+    return {
+        key: value.decode() if key in TEXT_COLUMNS else int(value)
+        for key, value in row.items()
+    }
+
+
+def _pending_row(kind: str, row_id: int):
+    if _shared():
+        values = redis_client.hgetall(f"writebuffer:{kind}:{row_id}")
+        return _decode(values) if values else None
+    return (_players if kind == "player" else _maps).get(row_id)
+
+
+def _pending_rows(kind: str) -> dict:
+    """The pending rows of `kind`, `player` or `map`, by `id`"""
+    ids = sorted(
+        int(row_id) for row_id in redis_client.smembers(f"writebuffer:{kind}s")
+    )
+    pipe = redis_client.pipeline(transaction=False)
+    for row_id in ids:
+        pipe.hgetall(f"writebuffer:{kind}:{row_id}")
+    return {
+        row_id: _decode(values) for row_id, values in zip(ids, pipe.execute()) if values
+    }
+
+
+def player_row(row: dict) -> dict:
+    """The `Player` row with its pending update"""
+    pending = _pending_row("player", row["id"])
+    if pending is None:
+        return row
+    return {
+        **row,
+        "country": pending["country"],
+        "last_seen": pending["last_seen"],
+        "connections": row["connections"] + pending["connections"],
+    }
+
+
+def map_row(row: dict) -> dict:
+    """The `Maps` row with its pending update"""
+    pending = _pending_row("map", row["id"])
+    if pending is None:
+        return row
+    return {**row, **{column: pending[column] for column in MAP_COLUMNS}}
+
+
+def _quote(value) -> str:
+    return f"'{MySQLConverter.escape(str(value))}'"
+
+
+def _statements(query, rows: list) -> list:
+    size = write_buffer_config["MAX_ROWS"]
+    return [
+        query.format(" UNION ALL ".join(rows[start : start + size]))
+        for start in range(0, len(rows), size)
+    ]
+
+
+def _queries(players: dict, maps: dict) -> list:
+    return _statements(
+        surftimer.queries.sql_flushPlayerProfiles,
+        [
+            f"SELECT {int(player_id)} AS id, {_quote(pending['country'])} AS country, "
+            f"{int(pending['last_seen'])} AS last_seen, {int(pending['connections'])} AS connections"
+            for player_id, pending in sorted(players.items())
+        ],
+    ) + _statements(
+        surftimer.queries.sql_flushMaps,
+        [
+            f"SELECT {int(map_id)} AS id, {int(pending['last_played'])} AS last_played, "
+            f"{int(pending['stages'])} AS stages, {int(pending['bonuses'])} AS bonuses, "
+            f"{_quote(pending['author'])} AS author, {int(pending['tier'])} AS tier, "
+            f"{int(pending['ranked'])} AS ranked"
+            for map_id, pending in sorted(maps.items())
+        ],
+    )
+
+
+def _write(players: dict, maps: dict) -> tuple:
+    """Writes the rows in one transaction, one by one when MySQL rejects it\n
+    Returns the `(players, maps)` that are done, written or dropped, the rows written and the error that stopped
+    the flush or `None`
+    """
+    try:
+        executeTransaction(_queries(players, maps))
+        return (players, maps), (players, maps), None
+    except REJECTED_ERRORS:
+        pass
+    except Exception as e:
+        return ({}, {}), ({}, {}), e
+
+    done, written = ({}, {}), ({}, {})
+    for index, rows in enumerate((players, maps)):
+        for row_id, pending in sorted(rows.items()):
+            single = ({row_id: pending}, {}) if index == 0 else ({}, {row_id: pending})
+            try:
+                executeTransaction(_queries(*single))
+            except REJECTED_ERRORS:
+                WRITE_BUFFER_ROWS_DROPPED.inc()
+            except Exception as e:
+                return done, written, e
+            else:
+                written[index][row_id] = pending
+            done[index][row_id] = pending
+    return done, written, None
+
+
+def _acknowledge(kind: str, rows: dict):
+    """Removes the flushed rows from Redis, their changes since the flush stay pending"""
+    global _ack_script
+    if _ack_script is None:
+        _ack_script = redis_client.register_script(ACK_SCRIPT)
+    pipe = redis_client.pipeline(transaction=False)
+    for row_id, pending in rows.items():
+        columns = [
+            item
+            for column, value in pending.items()
+            if column != "connections"
+            for item in (column, value)
+        ]
+        _ack_script(
+            keys=[f"writebuffer:{kind}:{row_id}", f"writebuffer:{kind}s"],
+            args=[row_id, pending.get("connections", 0), *columns],
+            client=pipe,
+        )
+    pipe.execute()
+
+
+def _restore(players: dict, maps: dict):
+    """Puts rows that were not flushed back into this worker's buffer, updates that came in since are newer"""
+    for player_id, pending in players.items():
+        newer = _players.get(player_id)
+        if newer is not None:
+            newer["connections"] += pending["connections"]
+        else:
+            _players[player_id] = pending
+    for map_id, pending in maps.items():
+        _maps.setdefault(map_id, pending)
+
+
+def flush() -> int:
+    """Writes the pending rows in one transaction, returns the number of rows written"""
+    global _players, _maps, _unlock_script
+    if _shared():
+        token = uuid.uuid4().hex
+        if not redis_client.set("writebuffer:lock", token, nx=True, px=LOCK_MS):
+            # Another worker is flushing the same rows
+            return 0
+        try:
+            players, maps = _pending_rows("player"), _pending_rows("map")
+            if not players and not maps:
+                return 0
+            (done_players, done_maps), written, error = _write(players, maps)
+            _acknowledge("player", done_players)
+            _acknowledge("map", done_maps)
+        finally:
+            if _unlock_script is None:
+                _unlock_script = redis_client.register_script(UNLOCK_SCRIPT)
+            _unlock_script(keys=["writebuffer:lock"], args=[token])
+    else:
+        players, maps = _players, _maps
+        if not players and not maps:
+            return 0
+        _players, _maps = {}, {}
+        (done_players, done_maps), written, error = _write(players, maps)
+        _restore(
+            {key: row for key, row in players.items() if key not in done_players},
+            {key: row for key, row in maps.items() if key not in done_maps},
+        )
+
+    # Bump the versions so cached entries and `ETag`s depending on this data change
+    bump_versions(
+        *(f"player:{pending['steam_id']}" for pending in written[0].values()),
+        *(f"mapinfo:{pending['name']}" for pending in written[1].values()),
+    )
+    if error is not None:
+        WRITE_BUFFER_FLUSH_FAILURES.inc()
+        raise error
+    return len(written[0]) + len(written[1])
+
+
+async def flush_periodically():
+    """Flushes every `INTERVAL` seconds until cancelled"""
+    while True:
+        await asyncio.sleep(write_buffer_config["INTERVAL"])
+        try:
+            flush()
+        except Exception:
+            # Counted in `flush`, the rows are retried with the next one
+            pass